@@ -114,35 +114,56 @@ def alive_check(camera):
 
 
 def check_for_alive_cameras():
+    changed = False
     for cname, camera in camera_nodes.items():
         duration_since_last_heartbeat = datetime.now() - datetime.strptime(camera["last_heartbeat_check"], "%Y-%m-%d %H:%M:%S")
-        if duration_since_last_heartbeat.seconds > 10:
-            camera["is_active"] = False
-            print("{} DIED".format(cname))
-        else:
-            camera["is_active"] = True
-            print("{} ALIVE".format(cname))
+        is_active = duration_since_last_heartbeat.seconds <= 10
+        if is_active != camera["is_active"]:
+            changed = True
+        camera["is_active"] = is_active
+        print("{} {}".format(cname, "ALIVE" if is_active else "DIED"))
+    return changed
+
+
+def notify_topology_change():
+    # Cameras re-query their neighbors as soon as they receive this
+    notify_socket.send_string("TOPOLOGY_CHANGED")
 
 
 context = zmq.Context()
 socket = context.socket(zmq.REP)
 socket.bind("tcp://*:5555")
+notify_socket = context.socket(zmq.PUB)
+notify_socket.bind("tcp://*:5556")
 
 G = ox.graph_from_point((33.775259139909664, -84.39705848693849), distance=500, network_type='drive')
 
 camera_nodes = {}
 inverse_camera_nodes = {}
 
-t = RepeatingTimer(5.0, check_for_alive_cameras)
-t.start()
-
+# The liveness check runs in the request loop, so that camera_nodes and the
+# sockets are only used from one thread.
+poller = zmq.Poller()
+poller.register(socket, zmq.POLLIN)
+last_alive_check = time.time()
 
 while True:
+    if time.time() - last_alive_check > 5.0:
+        last_alive_check = time.time()
+        if check_for_alive_cameras():
+            notify_topology_change()
+
+    if not poller.poll(1000):
+        continue
+
     # receive join request from camera
     message = socket.recv_json()
     if message["request_type"] == "JOIN":
+        is_new = message["data"]["id"] not in camera_nodes
         response = add_camera_to_network(message["data"])
         socket.send_json(response)
+        if is_new:
+            notify_topology_change()
     elif message["request_type"] == "GET_NEIGHBOR_CAMS":
         response = get_neighbor_cams(message["data"])
         socket.send_json(response)
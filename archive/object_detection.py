@@ -5,23 +5,16 @@ import logging
 import os
 import glob
 import time
-import collections
+import sys
 
 #from edgetpu.detection.engine import DetectionEngine
 from PIL import Image
 from PIL import ImageDraw
 
-ODLogger = logging.getLogger('ObjectDetector')
+sys.path.append("..")  # NOQA: E402
+from monitoring.metrics import registry
 
-class FPS:
-    def __init__(self,avarageof=50):
-        self.frametimestamps = collections.deque(maxlen=avarageof)
-    def __call__(self):
-        self.frametimestamps.append(time.time())
-        if(len(self.frametimestamps) > 1):
-            return len(self.frametimestamps)/(self.frametimestamps[-1]-self.frametimestamps[0])
-        else:
-            return 0.0
+ODLogger = logging.getLogger('ObjectDetector')
 
 # Function to read labels from text files.
 def ReadLabelFile(file_path):
@@ -79,7 +72,8 @@ def main():
     engine = DetectionEngine(args.model)
     labels = ReadLabelFile(args.label) if args.label else None
 
-    fps = FPS()		
+    registry.enable()
+    fps = registry.meter('object_detection_frames')
     total = 0
     total_max = 100
     # Iterate images.
@@ -106,7 +100,8 @@ def main():
         # Measure latency
         ODLogger.info('-----------------------------------------')
         ODLogger.info('inference_time = %s milliseconds', engine.get_inference_time())
-        ODLogger.info('fps = %.2f', fps())
+        fps.mark()
+        ODLogger.info('fps = %.2f', fps.rate())
         ODLogger.info('load_image_time = %.3f seconds', load_image_time - start_time)
         ODLogger.info('detection_time = %.3f seconds', detection_time - load_image_time)
         ODLogger.info('display_time = %.3f seconds', end_time - detection_time)
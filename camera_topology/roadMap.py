@@ -1,5 +1,12 @@
-from typing import Tuple, List, Dict, Optional
+import hashlib
+import heapq
+import json
+import logging
+import os
+import pickle
+from typing import Tuple, List, Dict, Optional, Set
 
+import numpy as np
 import osmnx as ox
 
 
@@ -10,15 +17,334 @@ class BaseMap:
     Example edge attributes from osmnx:
     {'osmid': 9265808, 'name': 'Hemphill Avenue Northwest',
     'highway': 'tertiary', 'maxspeed': '25 mph', 'oneway': False,
-    'length': 28.716, 'geometry': ..., 'bearing': 321.6}
+    'length': 28.716, 'geometry': ..., 'bearing': 321.6,
+    'speed_kph': 40.2, 'travel_time': 2.6}
     """
 
-    def __init__(self, latlon: Tuple[float, float], dist: float):
+    # Bump when the processed graph or the snapshot layout changes
+    SNAPSHOT_FORMAT = 2
+    CSR_ARRAYS = ['node_ids', 'indptr', 'targets', 'keys', 'bearings',
+                  'lengths', 'travel_times', 'node_cameras', 'edge_cameras']
+
+    def __init__(self, latlon: Tuple[float, float], dist: float,
+                 snapshot: Optional[str] = None):
+        """
+        snapshot: directory of a snapshot written by save_snapshot. If it
+        exists and matches latlon, dist and the osmnx version, the graph is
+        loaded from it without network access. Otherwise the graph is
+        downloaded and the snapshot is (re)written.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.latlon = tuple(latlon)
+        self.dist = dist
+        self.csr = None
+        self.snapshot_path = snapshot
+        self.snapshot_loaded = False
+        if snapshot is not None and self._load_snapshot(snapshot):
+            self.snapshot_loaded = True
+            return
+
         ox.config(log_console=False, use_cache=True)
         G = ox.graph_from_point(latlon, dist=dist, network_type='drive')
         # Bearing represents angle in degrees (clockwise) between north
         # and the direction from the origin node to the destination node.
-        self.G = ox.bearing.add_edge_bearings(G)
+        G = ox.bearing.add_edge_bearings(G)
+        # speed_kph from maxspeed (imputed by highway type where missing)
+        # and travel_time in seconds.
+        G = ox.speed.add_edge_speeds(G)
+        self.G = ox.speed.add_edge_travel_times(G)
+        if snapshot is not None:
+            self.save_snapshot(snapshot)
+
+    def snapshot_hash(self) -> str:
+        # Normalised, so --dist 500 and 500.0 give the same snapshot
+        key = json.dumps([self.SNAPSHOT_FORMAT, [float(x) for x in self.latlon],
+                          float(self.dist), ox.__version__])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def save_snapshot(self, path: str):
+        """
+        Write the processed graph (and the CSR arrays if compiled) to the
+        directory path.
+        """
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        # Files are replaced rather than rewritten in place, the arrays of a
+        # loaded snapshot may still be mapped
+        graph_path = os.path.join(path, 'graph.pkl')
+        with open(graph_path + '.tmp', 'wb') as f:
+            pickle.dump(self.G, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(graph_path + '.tmp', graph_path)
+        for name in self.CSR_ARRAYS:
+            array_path = os.path.join(path, '%s.npy' % name)
+            if self.csr is not None:
+                with open(array_path + '.tmp', 'wb') as f:
+                    np.save(f, getattr(self.csr, name))
+                os.replace(array_path + '.tmp', array_path)
+            elif os.path.exists(array_path):
+                os.remove(array_path)
+        self._save_snapshot_extra(path)
+        # Written last, a snapshot without meta.json is never loaded
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'hash': self.snapshot_hash(),
+                       'format': self.SNAPSHOT_FORMAT,
+                       'latlon': list(self.latlon),
+                       'dist': self.dist,
+                       'osmnx': ox.__version__}, f)
+
+    def _save_snapshot_extra(self, path: str):
+        pass
+
+    def _load_snapshot(self, path: str) -> bool:
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return False
+        if meta.get('hash') != self.snapshot_hash():
+            self.logger.warning('Snapshot %s does not match the map, rebuilding' % path)
+            return False
+
+        with open(os.path.join(path, 'graph.pkl'), 'rb') as f:
+            self.G = pickle.load(f)
+        if os.path.exists(os.path.join(path, 'node_ids.npy')):
+            arrays = {}
+            for name in self.CSR_ARRAYS:
+                # The camera bitmaps change, they are copy-on-write
+                mode = 'c' if name.endswith('_cameras') else 'r'
+                arrays[name] = np.load(os.path.join(path, '%s.npy' % name),
+                                       mmap_mode=mode)
+            self.csr = self._CSRGraph.from_arrays(arrays)
+        self.logger.info('Loaded snapshot %s' % path)
+        return True
+
+    class _CSRGraph:
+        """
+        The road graph compiled into compressed sparse row arrays.
+
+        Nodes are indexed 0..n-1 (node_ids maps an index back to the OSM id).
+        The outgoing edges of node i are indptr[i]:indptr[i+1], in the order
+        of G.out_edges(node, keys=True), with their target node index, key,
+        bearing, length and travel time. node_cameras and edge_cameras flag the nodes and
+        edges equipped with cameras.
+
+        OSM ids are looked up with a binary search over the sorted node ids,
+        so a snapshot loads without building a dict over the whole graph.
+        """
+
+        def __init__(self, G=None):
+            self._sorted_ids = None
+            if G is None:
+                return
+            self.node_ids = np.array(list(G.nodes), dtype=np.int64)
+            node_index = {node: i for i, node in enumerate(self.node_ids.tolist())}
+            n = len(self.node_ids)
+            m = G.number_of_edges()
+            self.indptr = np.zeros(n + 1, dtype=np.int64)
+            self.targets = np.empty(m, dtype=np.int32)
+            self.keys = np.empty(m, dtype=np.int32)
+            self.bearings = np.empty(m, dtype=np.float64)
+            self.lengths = np.empty(m, dtype=np.float64)
+            self.travel_times = np.empty(m, dtype=np.float64)
+            e = 0
+            for i, node in enumerate(self.node_ids.tolist()):
+                for u, v, key, d in G.out_edges(node, keys=True, data=True):
+                    self.targets[e] = node_index[v]
+                    self.keys[e] = key
+                    # osmnx gives self loops a nan bearing
+                    self.bearings[e] = d.get('bearing', np.nan)
+                    self.lengths[e] = d['length']
+                    self.travel_times[e] = d['travel_time']
+                    e += 1
+                self.indptr[i + 1] = e
+            self.node_cameras = np.zeros(n, dtype=bool)
+            self.edge_cameras = np.zeros(m, dtype=bool)
+
+        @classmethod
+        def from_arrays(cls, arrays: Dict[str, np.ndarray]):
+            csr = cls()
+            for name, array in arrays.items():
+                setattr(csr, name, array)
+            return csr
+
+        @property
+        def num_nodes(self) -> int:
+            return len(self.node_ids)
+
+        def node_index(self, node: int) -> int:
+            """
+            Index of the OSM node id.
+            """
+            if self._sorted_ids is None:
+                order = np.argsort(self.node_ids, kind='stable')
+                self._sorted_ids = (self.node_ids[order], order)
+            ids, order = self._sorted_ids
+            i = int(np.searchsorted(ids, node))
+            if i == len(ids) or ids[i] != node:
+                raise KeyError(node)
+            return int(order[i])
+
+        def edge_index(self, edge: Tuple[int, int, int]) -> int:
+            """
+            Index of the OSM edge (u, v, key), among the out edges of u.
+            """
+            u, v, key = edge
+            i = self.node_index(u)
+            j = self.node_index(v)
+            for e in range(self.indptr[i], self.indptr[i + 1]):
+                if self.targets[e] == j and self.keys[e] == key:
+                    return int(e)
+            raise KeyError(edge)
+
+        def edge(self, u: int, e: int) -> Tuple[int, int, int]:
+            """
+            OSM (u, v, key) of edge e going out of node index u.
+            """
+            return (int(self.node_ids[u]), int(self.node_ids[self.targets[e]]),
+                    int(self.keys[e]))
+
+    def compile_csr(self):
+        """
+        Compile the road graph into CSR arrays, which the topology
+        traversals use instead of the networkx graph afterwards.
+        """
+        self.csr = self._CSRGraph(self.G)
+
+    class _SpatialIndex:
+        """
+        Uniform grid (in degrees) over the graph nodes and the segments of
+        the edge geometries, for nearest node/edge queries.
+
+        Distances follow osmnx: great circle meters for the nearest node
+        (ox.get_nearest_node) and euclidean degrees for the nearest edge
+        (ox.get_nearest_edge), so the registration thresholds are unchanged.
+        """
+
+        def __init__(self, G, cell: float = 0.002):
+            self.cell = cell
+            nodes = list(G.nodes(data=True))
+            self.node_ids = np.array([n for n, _ in nodes], dtype=np.int64)
+            self.node_lat = np.array([d['y'] for _, d in nodes])
+            self.node_lon = np.array([d['x'] for _, d in nodes])
+            self.node_grid = self._grid(self.node_lat, self.node_lon,
+                                        self.node_lat, self.node_lon)
+
+            self.edges = []
+            seg_edge, lat1, lon1, lat2, lon2 = [], [], [], [], []
+            for u, v, key, d in G.edges(keys=True, data=True):
+                if 'geometry' in d:
+                    coords = list(d['geometry'].coords)
+                else:
+                    coords = [(G.nodes[u]['x'], G.nodes[u]['y']),
+                              (G.nodes[v]['x'], G.nodes[v]['y'])]
+                for (x1, y1), (x2, y2) in zip(coords[:-1], coords[1:]):
+                    seg_edge.append(len(self.edges))
+                    lat1.append(y1)
+                    lon1.append(x1)
+                    lat2.append(y2)
+                    lon2.append(x2)
+                self.edges.append((u, v, key))
+            self.seg_edge = np.array(seg_edge, dtype=np.int64)
+            self.seg_lat1 = np.array(lat1)
+            self.seg_lon1 = np.array(lon1)
+            self.seg_lat2 = np.array(lat2)
+            self.seg_lon2 = np.array(lon2)
+            self.seg_grid = self._grid(np.minimum(self.seg_lat1, self.seg_lat2),
+                                       np.minimum(self.seg_lon1, self.seg_lon2),
+                                       np.maximum(self.seg_lat1, self.seg_lat2),
+                                       np.maximum(self.seg_lon1, self.seg_lon2))
+            self.max_ring = int(np.ceil(max(np.ptp(self.node_lat), np.ptp(self.node_lon))
+                                        / cell)) + 1
+
+        def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+            return (int(np.floor(lat / self.cell)), int(np.floor(lon / self.cell)))
+
+        def _grid(self, min_lat, min_lon, max_lat, max_lon) -> Dict:
+            grid = {}
+            for i in range(len(min_lat)):
+                r1, c1 = self._cell(min_lat[i], min_lon[i])
+                r2, c2 = self._cell(max_lat[i], max_lon[i])
+                for r in range(r1, r2 + 1):
+                    for c in range(c1, c2 + 1):
+                        grid.setdefault((r, c), []).append(i)
+            return {k: np.array(v, dtype=np.int64) for k, v in grid.items()}
+
+        def _ring(self, grid: Dict, center: Tuple[int, int], ring: int) -> np.ndarray:
+            r0, c0 = center
+            found = []
+            for r in range(r0 - ring, r0 + ring + 1):
+                for c in range(c0 - ring, c0 + ring + 1):
+                    if max(abs(r - r0), abs(c - c0)) == ring and (r, c) in grid:
+                        found.append(grid[(r, c)])
+            if len(found) == 0:
+                return np.empty(0, dtype=np.int64)
+            return np.concatenate(found)
+
+        def _search(self, grid, count, latlon, distance, min_dist_of_ring):
+            center = self._cell(*latlon)
+            best, best_dist = None, np.inf
+            for ring in range(self.max_ring + 1):
+                # Anything in this ring or further is at least this far
+                if best is not None and min_dist_of_ring(ring) > best_dist:
+                    break
+                candidates = self._ring(grid, center, ring)
+                if len(candidates) == 0:
+                    continue
+                dists = distance(candidates)
+                i = int(np.argmin(dists))
+                if dists[i] < best_dist:
+                    best, best_dist = candidates[i], float(dists[i])
+            if best is None and count > 0:
+                # Beyond the rings covering the graph, scan everything
+                candidates = np.arange(count)
+                dists = distance(candidates)
+                best = int(np.argmin(dists))
+                best_dist = float(dists[best])
+            return best, best_dist
+
+        def nearest_node(self, latlon: Tuple[float, float]) -> Tuple[int, float]:
+            lat, lon = latlon
+
+            def distance(idx):
+                return ox.distance.great_circle_vec(lat, lon, self.node_lat[idx],
+                                                    self.node_lon[idx])
+
+            # Lower bound of the great circle distance of a cell offset
+            meters = 6371009 * np.pi / 180 * np.cos(np.radians(min(abs(lat) + 1, 89)))
+            best, dist = self._search(self.node_grid, len(self.node_ids), latlon,
+                                      distance, lambda ring: (ring - 1) * self.cell * meters)
+            if best is None:
+                return None, np.inf
+            return int(self.node_ids[best]), dist
+
+        def nearest_edge(self, latlon: Tuple[float, float]) -> Tuple[int, int, int, float]:
+            lat, lon = latlon
+
+            def distance(idx):
+                # point to segment distance in (lon, lat) degrees
+                x1, y1 = self.seg_lon1[idx], self.seg_lat1[idx]
+                dx, dy = self.seg_lon2[idx] - x1, self.seg_lat2[idx] - y1
+                norm = dx * dx + dy * dy
+                t = np.where(norm > 0, ((lon - x1) * dx + (lat - y1) * dy)
+                             / np.where(norm > 0, norm, 1), 0)
+                t = np.clip(t, 0, 1)
+                return np.hypot(lon - (x1 + t * dx), lat - (y1 + t * dy))
+
+            best, dist = self._search(self.seg_grid, len(self.seg_edge), latlon,
+                                      distance, lambda ring: (ring - 1) * self.cell)
+            if best is None:
+                return None, None, None, np.inf
+            u, v, key = self.edges[self.seg_edge[best]]
+            return u, v, key, dist
+
+    @property
+    def spatial_index(self):
+        # The road graph does not change, the index is built on first use
+        if getattr(self, '_spatial_index', None) is None:
+            self._spatial_index = self._SpatialIndex(self.G)
+        return self._spatial_index
 
     def plot_graph_routes(self, routes: List[List], **kwargs):
         # ox.plot_graph_routes can not print one route
@@ -38,6 +364,51 @@ class CameraOverlay(BaseMap):
         super(CameraOverlay, self).__init__(*args, **kwargs)
         self.node_camera = self._NodeCamera(self.G)
         self.edge_camera = self._EdgeCamera(self.G)
+        self.downstream_index = None
+        if self.snapshot_loaded:
+            self._load_cameras(self.snapshot_path)
+
+    def _save_snapshot_extra(self, path: str):
+        # The camera placements are stored on the graph, the camera maps are
+        # written next to it. The snapshot written while the base map is
+        # constructed has no cameras yet.
+        node = {}
+        edge = {}
+        if hasattr(self, 'node_camera'):
+            node = self.node_camera.camera_to_node
+            edge = self.edge_camera.camera_to_edge
+        with open(os.path.join(path, 'cameras.json'), 'w') as f:
+            json.dump({'info': self.cameraInfo, 'node': node, 'edge': edge}, f)
+
+    def _load_cameras(self, path: str):
+        try:
+            with open(os.path.join(path, 'cameras.json')) as f:
+                cameras = json.load(f)
+        except FileNotFoundError:
+            return
+        for name, info in cameras['info'].items():
+            self.cameraInfo[name] = {'latlon': tuple(info['latlon']),
+                                     'meta': info['meta']}
+        self.node_camera.camera_to_node.update(cameras['node'])
+        for name, edge in cameras['edge'].items():
+            self.edge_camera.camera_to_edge[name] = tuple(edge)
+
+    def compile_csr(self):
+        super(CameraOverlay, self).compile_csr()
+        for name in self.cameraInfo:
+            self._update_csr_cameras(name)
+
+    def _update_csr_cameras(self, name: str):
+        if self.csr is None:
+            return
+        if name in self.node_camera.camera_to_node:
+            node = self.node_camera.camera_to_node[name]
+            self.csr.node_cameras[self.csr.node_index(node)] = \
+                self.node_camera.is_equipped_cameras(node)
+        elif name in self.edge_camera.camera_to_edge:
+            edge = self.edge_camera.camera_to_edge[name]
+            self.csr.edge_cameras[self.csr.edge_index(edge)] = \
+                self.edge_camera.is_equipped_cameras(edge)
 
     class _NodeCamera:
         """
@@ -157,27 +528,217 @@ class CameraOverlay(BaseMap):
             self.remove_camera(name)
 
         success = False
-        nearest_node, dist = ox.get_nearest_node(self.G, latlon, return_dist=True)
+        nearest_node, dist = self.spatial_index.nearest_node(latlon)
         if dist < max_intersection_dist:
             self.node_camera.add_camera(nearest_node, name)
             success = True
         else:
-            u, v, key, dist = ox.get_nearest_edge(self.G, latlon, return_dist=True)
+            u, v, key, dist = self.spatial_index.nearest_edge(latlon)
             if dist < max_lane_dist:
                 self.edge_camera.add_camera((u, v, key), name, latlon)
                 success = True
 
         if success:
             self.cameraInfo[name] = {'latlon': latlon, 'meta': metadata}
+            self._update_csr_cameras(name)
+            if self.downstream_index is not None:
+                self.downstream_index.invalidate(self._camera_nodes(name))
+                self.downstream_index.add_camera(name)
         return success, success
 
+    def update_cameras(self, cameras: Dict[str, Tuple[float, float]],
+                       **kwargs) -> Dict[str, bool]:
+        """
+        Register many cameras at once, {name: latlon}. The downstream index
+        (if built) is rebuilt once at the end instead of after every camera.
+        kwargs are passed to update_camera.
+
+        return {name: whether the camera is added to the road network}
+        """
+        index = self.downstream_index
+        self.downstream_index = None
+        result = {}
+        for name, latlon in cameras.items():
+            result[name], _ = self.update_camera(name, tuple(latlon), **kwargs)
+        if index is not None:
+            self.build_downstream_index(index.max_dfs, index.max_bearing)
+        return result
+
+    def load_cameras_config(self, path: str, **kwargs) -> Dict[str, bool]:
+        """
+        Register the cameras of a config/cameras.json style file.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        return self.update_cameras({name: c['location'] for name, c in config.items()},
+                                   **kwargs)
+
     def remove_camera(self, name: str):
         """
         Remove a specific camera from the topology.
         """
+        nodes = self._camera_nodes(name)
+        node = self.node_camera.camera_to_node.get(name)
+        edge = self.edge_camera.camera_to_edge.get(name)
         self.cameraInfo.pop(name, None)
         self.node_camera.remove_camera(name)
         self.edge_camera.remove_camera(name)
+        if self.csr is not None and node is not None:
+            self.csr.node_cameras[self.csr.node_index(node)] = \
+                self.node_camera.is_equipped_cameras(node)
+        if self.csr is not None and edge is not None:
+            self.csr.edge_cameras[self.csr.edge_index(edge)] = \
+                self.edge_camera.is_equipped_cameras(edge)
+        if self.downstream_index is not None:
+            self.downstream_index.remove_camera(name)
+            self.downstream_index.invalidate(nodes)
+
+    def _camera_nodes(self, name: str) -> Set[int]:
+        """
+        The graph nodes where the camera is deployed (both ends for an edge).
+        """
+        if name in self.node_camera.camera_to_node:
+            return set([self.node_camera.camera_to_node[name]])
+        elif name in self.edge_camera.camera_to_edge:
+            return set(self.edge_camera.camera_to_edge[name][0:2])
+        return set()
+
+    class _DownstreamIndex:
+        """
+        Precomputed downstream cameras, with their path lengths, of every
+        camera. A direction only matters through the choice it makes: the
+        first edge of the search from a node camera, or the side of the edge
+        of an edge camera. Entries are kept per choice (None is the
+        undirectional search), so a lookup returns exactly what the search
+        with that direction returns.
+
+        Every entry remembers the nodes its search depended on, so that a
+        camera change at a node (or edge) only recomputes the entries whose
+        search region contains it.
+        """
+
+        def __init__(self, overlay, max_dfs: int, max_bearing: float):
+            self.overlay = overlay
+            self.max_dfs = max_dfs
+            self.max_bearing = max_bearing
+            self.entries = {}
+            self.regions = {}
+            self.node_entries = {}
+            # camera -> {choice: direction searched for the entry}
+            self.choices = {}
+
+        def build(self):
+            for name in self.overlay.cameraInfo:
+                self.add_camera(name)
+
+        def add_camera(self, name: str):
+            self.remove_camera(name)
+            self.choices[name] = self._choices(name)
+            for choice in self.choices[name]:
+                self._compute((name, choice))
+
+        def remove_camera(self, name: str):
+            for choice in self.choices.pop(name, {}):
+                self._remove((name, choice))
+
+        def invalidate(self, nodes: Set[int]):
+            keys = set()
+            for node in nodes:
+                keys |= self.node_entries.get(node, set())
+            for key in keys:
+                self._compute(key)
+
+        def get(self, name: str, direction: float) -> Dict[str, float]:
+            if name not in self.overlay.cameraInfo:
+                return {}
+            if name not in self.choices:
+                self.add_camera(name)
+            key = (name, self.choice(name, direction))
+            if key[1] == 'none':
+                return {}
+            if key not in self.entries:
+                self._compute(key)
+            return self.entries.get(key, {})
+
+        def choice(self, name: str, direction: float):
+            """
+            What the search from the camera does with direction: None
+            (undirectional), 'none' (no way in that direction), the first
+            edge (u, v, key) from a node camera, or 'forward'/'backward'
+            along the edge of an edge camera. Follows
+            get_downstream_cameras_from_node/_from_edge.
+            """
+            if direction < 0 or direction > 360:
+                return None
+            overlay = self.overlay
+            if name in overlay.node_camera.camera_to_node:
+                node = overlay.node_camera.camera_to_node[name]
+                best, best_deviation = 'none', np.inf
+                for u, v, key, d in overlay.G.out_edges(node, keys=True, data=True):
+                    deviation = abs(d.get('bearing', np.nan) - direction)
+                    # nan for self loops, never chosen
+                    if deviation < best_deviation:
+                        best, best_deviation = (u, v, key), deviation
+                if best_deviation > self.max_bearing:
+                    return 'none'
+                return best
+            edge = overlay.edge_camera.camera_to_edge[name]
+            bearing = overlay.G.edges[edge]['bearing']
+            if abs(bearing - direction) < self.max_bearing:
+                return 'forward'
+            elif abs((bearing + 180) % 360 - direction) < self.max_bearing:
+                return 'backward'
+            return 'none'
+
+        def _choices(self, name: str) -> Dict:
+            """
+            The choices of the camera with a direction making each of them.
+            """
+            overlay = self.overlay
+            choices = {None: -1}
+            if name in overlay.node_camera.camera_to_node:
+                node = overlay.node_camera.camera_to_node[name]
+                for _, _, d in overlay.G.out_edges(node, data=True):
+                    direction = d.get('bearing', np.nan)
+                    if not np.isnan(direction):
+                        choices.setdefault(self.choice(name, direction), direction)
+            elif name in overlay.edge_camera.camera_to_edge:
+                bearing = overlay.G.edges[overlay.edge_camera.camera_to_edge[name]]['bearing']
+                for direction in (bearing, (bearing + 180) % 360):
+                    choices.setdefault(self.choice(name, direction), direction)
+            choices.pop('none', None)
+            return choices
+
+        def _compute(self, key: Tuple[str, object]):
+            name, choice = key
+            direction = self.choices.get(name, {}).get(choice)
+            if direction is None:
+                return
+            region = set()
+            lengths = {}
+            res, _ = self.overlay._downstream(name, direction, self.max_dfs,
+                                              self.max_bearing, False,
+                                              region, lengths)
+            self._remove(key)
+            self.entries[key] = {c: lengths.get(c) for c in res if c != name}
+            self.regions[key] = region
+            for node in region:
+                self.node_entries.setdefault(node, set()).add(key)
+
+        def _remove(self, key: Tuple[str, object]):
+            self.entries.pop(key, None)
+            for node in self.regions.pop(key, ()):
+                self.node_entries[node].discard(key)
+
+    def build_downstream_index(self, max_dfs: int = 5, max_bearing: float = 90):
+        """
+        Precompute the downstream cameras of every camera. Afterwards
+        get_downstream_cameras with the same max_dfs and max_bearing is a
+        lookup, which returns what the search returns for any direction.
+        The index is updated by update_camera and remove_camera.
+        """
+        self.downstream_index = self._DownstreamIndex(self, max_dfs, max_bearing)
+        self.downstream_index.build()
 
     class _DFSStack:
 
@@ -203,6 +764,13 @@ class CameraOverlay(BaseMap):
             self.in_stack.add(x[0])
 
     def _draw_routes(self, start_camera, routes, filename):
+        nc, ec = self._route_colors(start_camera)
+        self.plot_graph_routes(routes=routes,
+                               node_color=nc, node_zorder=3,
+                               edge_color=ec, bgcolor='w', show=False,
+                               save=True, filepath=filename)
+
+    def _route_colors(self, start_camera):
         start_node = None
         if start_camera in self.node_camera.camera_to_node:
             start_node = self.node_camera.camera_to_node[start_camera]
@@ -220,35 +788,89 @@ class CameraOverlay(BaseMap):
                 ec.append('r')
             else:
                 ec.append('#999999')
-        self.plot_graph_routes(routes=routes,
-                               node_color=nc, node_zorder=3,
-                               edge_color=ec, bgcolor='w', show=False,
-                               save=True, filepath=filename)
+        return nc, ec
+
+    def downstream_routes(self, name: str, direction: float = -1,
+                          max_dfs: int = 5,
+                          max_bearing: float = 90) -> Optional[Dict]:
+        """
+        The keyword arguments of plot_graph_routes drawing the routes to the
+        downstream cameras of name, or None without downstream cameras. Only
+        this part reads the camera placements: a caller guarding the overlay
+        with a lock can render the plot after releasing it.
+        """
+        res, routes = self._downstream(name, direction, max_dfs, max_bearing,
+                                       True)
+        if len(res) == 0:
+            return None
+        nc, ec = self._route_colors(name)
+        return dict(routes=routes, node_color=nc, node_zorder=3,
+                    edge_color=ec, bgcolor='w', show=False, save=True)
 
     def get_downstream_cameras(self, name: str, direction: float = -1,
                                max_dfs: int = 5,
                                max_bearing: float = 90,
-                               debug: bool = False) -> List[str]:
+                               debug: bool = False,
+                               plot_path: Optional[str] = None) -> List[str]:
+        """
+        With debug, the routes to the downstream cameras are plotted to
+        plot_path (default: <name>.png).
+        """
+        index = self.downstream_index
+        if not debug and index is not None and index.max_dfs == max_dfs \
+                and index.max_bearing == max_bearing:
+            return list(index.get(name, direction))
+
+        res, routes = self._downstream(name, direction, max_dfs, max_bearing,
+                                       debug)
+        if debug and len(res) > 0:
+            self._draw_routes(name, routes, plot_path or '%s.png' % name)
+        return res
+
+    def get_downstream_cameras_with_lengths(self, name: str,
+                                            direction: float = -1,
+                                            max_dfs: int = 5,
+                                            max_bearing: float = 90) \
+            -> Dict[str, float]:
+        """
+        The downstream cameras with the length in meters of the path found to
+        each of them.
+        """
+        index = self.downstream_index
+        if index is not None and index.max_dfs == max_dfs \
+                and index.max_bearing == max_bearing:
+            return dict(index.get(name, direction))
+
+        lengths = {}
+        res, _ = self._downstream(name, direction, max_dfs, max_bearing,
+                                  False, None, lengths)
+        return {c: lengths.get(c) for c in res if c != name}
+
+    def _downstream(self, name: str, direction: float, max_dfs: int,
+                    max_bearing: float, debug: bool,
+                    region: Optional[Set[int]] = None,
+                    lengths: Optional[Dict[str, float]] = None) \
+            -> Tuple[List[str], List[int]]:
         res = []
         routes = None
         if name in self.node_camera.camera_to_node:
             node = self.node_camera.camera_to_node[name]
             res, routes = self.get_downstream_cameras_from_node(node, direction,
                                                                 max_dfs, max_bearing,
-                                                                debug)
+                                                                debug, region, lengths)
         elif name in self.edge_camera.camera_to_edge:
             res, routes = self.get_downstream_cameras_from_edge(name, direction,
                                                                 max_dfs, max_bearing,
-                                                                debug)
-        if debug and len(res) > 0:
-            self._draw_routes(name, routes, '%s.png' % name)
-        return res
+                                                                debug, region, lengths)
+        return res, routes
 
     def get_downstream_cameras_from_edge(self, name: str,
                                          direction: float = -1,
                                          max_dfs: int = 5,
                                          max_bearing: float = 90,
-                                         debug: bool = False) \
+                                         debug: bool = False,
+                                         region: Optional[Set[int]] = None,
+                                         lengths: Optional[Dict[str, float]] = None) \
             -> Tuple[List[str], List[int]]:
         """
         When the camera is in the middle of the edge, then if it is surrounded
@@ -256,6 +878,7 @@ class CameraOverlay(BaseMap):
         So we only need to handle, when the camera is the first or the last on
         the edge. And it can be solved by doing DFS from the close node and
         remove the self.
+        region and lengths are filled as in get_downstream_cameras_from_node.
         """
         if direction < 0 or direction > 360:
             undirectional = True
@@ -267,15 +890,25 @@ class CameraOverlay(BaseMap):
         c_list = self.edge_camera.get_cameras(edge)
         idx = c_list.index(name)
         routes = None
+        if region is not None:
+            region.update(edge[0:2])
+        if lengths is None:
+            lengths = {}
+        # Cameras on the same edge, by the distance between the cameras
+        latlon = self.cameraInfo[name]['latlon']
+        for other in c_list:
+            if other != name:
+                lengths[other] = ox.distance.great_circle_vec(
+                    *latlon, *self.cameraInfo[other]['latlon'])
         if undirectional:
             if idx > 0 and idx < len(c_list) - 1:
-                res = [clist[idx-1], clist[idx+1]]
+                res = [c_list[idx-1], c_list[idx+1]]
             elif len(c_list) == 1:
                 # DFS both directions and remove self
                 res, routes = self.get_downstream_cameras_from_node(
-                    edge[0], -1, max_dfs, max_bearing, debug)
+                    edge[0], -1, max_dfs, max_bearing, debug, region, lengths)
                 res1, routes1 = self.get_downstream_cameras_from_node(
-                    edge[1], -1, max_dfs, max_bearing, debug)
+                    edge[1], -1, max_dfs, max_bearing, debug, region, lengths)
                 res += res1
                 routes += routes1
                 res = list(filter(lambda x: x != name, res))
@@ -283,13 +916,13 @@ class CameraOverlay(BaseMap):
                 # DFS from u, the reason is the DFS to v will stop after
                 # reaching the next camera on the edge.
                 res, routes = self.get_downstream_cameras_from_node(
-                    edge[0], -1, max_dfs, max_bearing, debug)
+                    edge[0], -1, max_dfs, max_bearing, debug, region, lengths)
                 res.remove(name)
                 res.append(c_list[1])
             else:
                 # DFS from v
                 res, routes = self.get_downstream_cameras_from_node(
-                    edge[1], -1, max_dfs, max_bearing, debug)
+                    edge[1], -1, max_dfs, max_bearing, debug, region, lengths)
                 res.remove(name)
                 res.append(c_list[-2])
         else:
@@ -299,7 +932,7 @@ class CameraOverlay(BaseMap):
                 # last one
                 if idx == len(c_list) - 1:
                     res, routes = self.get_downstream_cameras_from_node(
-                        edge[1], -1, max_dfs, max_bearing, debug)
+                        edge[1], -1, max_dfs, max_bearing, debug, region, lengths)
                     res.remove(name)
                 else:
                     res = [c_list[idx+1]]
@@ -308,7 +941,7 @@ class CameraOverlay(BaseMap):
                 # first one
                 if idx == 0:
                     res, routes = self.get_downstream_cameras_from_node(
-                        edge[0], -1, max_dfs, max_bearing, debug)
+                        edge[0], -1, max_dfs, max_bearing, debug, region, lengths)
                     res.remove(name)
                 else:
                     res = [c_list[idx-1]]
@@ -332,15 +965,26 @@ class CameraOverlay(BaseMap):
                                          direction: float = -1,
                                          max_dfs: int = 5,
                                          max_bearing: float = 90,
-                                         debug: bool = False) \
+                                         debug: bool = False,
+                                         region: Optional[Set[int]] = None,
+                                         lengths: Optional[Dict[str, float]] = None) \
             -> Tuple[List[str], List[int]]:
         """
         direction is similar to the bearing in osmnx, angle in degrees
         (clockwise) between north and the direction.
         If direction is not valid [0, 360], it is ignored
         (i.e., DFS for all outgoing edges).
+        If region is given, every node whose camera state can change the
+        result (visited nodes and the nodes they reach) is added to it.
+        If lengths is given, the length in meters of the DFS path to every
+        downstream camera is stored in it.
         """
 
+        if self.csr is not None:
+            return self._csr_downstream_cameras_from_node(node, direction,
+                                                          max_dfs, max_bearing,
+                                                          debug, region, lengths)
+
         if direction < 0 or direction > 360:
             undirectional = True
         else:
@@ -353,10 +997,16 @@ class CameraOverlay(BaseMap):
         start_node = node
         stack = self._DFSStack([(start_node, 0)])
         first_edge = True
+        if region is None:
+            region = set()
+        if lengths is None:
+            lengths = {}
+        path_length = {start_node: 0.0}
 
         while len(stack) != 0:
             node, dist = stack.pop()
             visited.add(node)
+            region.add(node)
 
             outgoing_edges = self.G.out_edges(node, keys=True, data=True)
 
@@ -367,14 +1017,17 @@ class CameraOverlay(BaseMap):
                 if abs(outgoing_edges[0][3]['bearing'] - direction) \
                         > max_bearing:
                     # no outgoing edge found
-                    return []
+                    return [], []
                 else:
                     outgoing_edges = outgoing_edges[0:1]
                     first_edge = False
 
             for u, v, key, d in outgoing_edges:
+                region.add(v)
                 if self.edge_camera.is_equipped_cameras((u, v, key)):
-                    res.append(self.edge_camera.get_cameras((u, v, key))[0])
+                    camera = self.edge_camera.get_cameras((u, v, key))[0]
+                    res.append(camera)
+                    lengths.setdefault(camera, path_length[u])
                     dest_nodes.append(u)
                     continue
 
@@ -384,10 +1037,13 @@ class CameraOverlay(BaseMap):
                 if self.node_camera.is_equipped_cameras(v):
                     parent_node[v] = u
                     res += self.node_camera.get_cameras(v)
+                    for camera in self.node_camera.get_cameras(v):
+                        lengths.setdefault(camera, path_length[u] + d['length'])
                     dest_nodes.append(v)
                     visited.add(v)
                 elif dist + 1 <= max_dfs and v not in stack:
                     parent_node[v] = u
+                    path_length[v] = path_length[u] + d['length']
                     stack.append((v, dist + 1))
 
         routes = []
@@ -396,6 +1052,216 @@ class CameraOverlay(BaseMap):
 
         return res, routes
 
+    def _csr_downstream_cameras_from_node(self, node: int,
+                                          direction: float = -1,
+                                          max_dfs: int = 5,
+                                          max_bearing: float = 90,
+                                          debug: bool = False,
+                                          region: Optional[Set[int]] = None,
+                                          lengths: Optional[Dict[str, float]] = None) \
+            -> Tuple[List[str], List[int]]:
+        """
+        get_downstream_cameras_from_node on the CSR arrays. Node indices are
+        mapped back to OSM ids for the cameras, region and routes.
+        """
+        csr = self.csr
+        undirectional = direction < 0 or direction > 360
+        if region is None:
+            region = set()
+        if lengths is None:
+            lengths = {}
+
+        res = []
+        parent = {}
+        dest = []
+        # The walk stays within max_dfs hops, so its state is kept in sets
+        # and dicts sized to the nodes reached rather than in per-query
+        # arrays over the whole graph
+        visited = set()
+        in_stack = set()
+        start = csr.node_index(node)
+        path_length = {start: 0.0}
+        stack = [(start, 0)]
+        in_stack.add(start)
+
+        while len(stack) != 0:
+            u, dist = stack.pop()
+            in_stack.discard(u)
+            visited.add(u)
+            region.add(int(csr.node_ids[u]))
+
+            edges = range(csr.indptr[u], csr.indptr[u + 1])
+            if not undirectional and u == start:
+                if len(edges) == 0:
+                    return [], []
+                deviation = np.abs(csr.bearings[edges.start:edges.stop] - direction)
+                deviation[np.isnan(deviation)] = np.inf
+                best = int(np.argmin(deviation))
+                if deviation[best] > max_bearing:
+                    # no outgoing edge found
+                    return [], []
+                edges = [edges.start + best]
+
+            for e in edges:
+                v = int(csr.targets[e])
+                region.add(int(csr.node_ids[v]))
+                if csr.edge_cameras[e]:
+                    camera = self.edge_camera.get_cameras(csr.edge(u, e))[0]
+                    res.append(camera)
+                    lengths.setdefault(camera, float(path_length[u]))
+                    dest.append(u)
+                    continue
+
+                if v in visited:
+                    continue
+
+                if csr.node_cameras[v]:
+                    parent[v] = u
+                    cameras = self.node_camera.get_cameras(int(csr.node_ids[v]))
+                    res += cameras
+                    for camera in cameras:
+                        lengths.setdefault(camera, float(path_length[u] + csr.lengths[e]))
+                    dest.append(v)
+                    visited.add(v)
+                elif dist + 1 <= max_dfs and v not in in_stack:
+                    parent[v] = u
+                    path_length[v] = path_length[u] + csr.lengths[e]
+                    stack.append((v, dist + 1))
+                    in_stack.add(v)
+
+        routes = []
+        if debug:
+            routes = self._generate_routes(dest, start, parent)
+            routes = [[int(csr.node_ids[i]) for i in route] for route in routes]
+
+        return res, routes
+
+    def get_downstream_cameras_by_travel(self, name: str,
+                                         direction: float = -1,
+                                         max_time: Optional[float] = None,
+                                         max_length: Optional[float] = None,
+                                         max_bearing: float = 90) \
+            -> List[Tuple[str, float, float]]:
+        """
+        Downstream cameras by Dijkstra on the edge travel times (from
+        maxspeed), bounded by a travel time budget in seconds and/or a
+        distance budget in meters instead of a number of hops. Like the DFS,
+        the search does not continue past a camera.
+
+        return [(camera, travel time, distance)] ordered by travel time.
+        Runs on the CSR arrays, which are compiled on first use.
+        """
+        if self.csr is None:
+            self.compile_csr()
+        csr = self.csr
+
+        found = {}
+        sources = []
+        if name in self.node_camera.camera_to_node:
+            sources.append((self.node_camera.camera_to_node[name], 0.0, 0.0))
+        elif name in self.edge_camera.camera_to_edge:
+            edge = self.edge_camera.camera_to_edge[name]
+            c_list = self.edge_camera.get_cameras(edge)
+            idx = c_list.index(name)
+            e = csr.edge_index(edge)
+            speed = csr.lengths[e] / max(csr.travel_times[e], 1e-6)
+            latlon = self.cameraInfo[name]['latlon']
+            undirectional = direction < 0 or direction > 360
+            forward = not undirectional and \
+                abs(self.G.edges[edge]['bearing'] - direction) < max_bearing
+            backward = not undirectional and \
+                abs((self.G.edges[edge]['bearing'] + 180) % 360 - direction) < max_bearing
+            # (end node, neighbor camera on the edge towards that end)
+            ends = []
+            if undirectional or forward:
+                ends.append((edge[1], c_list[idx + 1] if idx < len(c_list) - 1 else None))
+            if undirectional or backward:
+                ends.append((edge[0], c_list[idx - 1] if idx > 0 else None))
+            for node, neighbor in ends:
+                if neighbor is not None:
+                    d = ox.distance.great_circle_vec(*latlon, *self.cameraInfo[neighbor]['latlon'])
+                    found[neighbor] = (d / speed, d)
+                else:
+                    d = ox.distance.great_circle_vec(*latlon, self.G.nodes[node]['y'],
+                                                     self.G.nodes[node]['x'])
+                    sources.append((node, d / speed, d))
+            # The search starts at the edge ends, the direction is settled
+            direction = -1
+
+        for node, time0, dist0 in sources:
+            for camera, cost in self._csr_dijkstra(node, time0, dist0, direction,
+                                                   max_time, max_length,
+                                                   max_bearing).items():
+                if camera != name and (camera not in found or cost[0] < found[camera][0]):
+                    found[camera] = cost
+        return sorted([(c, t, d) for c, (t, d) in found.items()], key=lambda x: x[1])
+
+    def _csr_dijkstra(self, node: int, time0: float, dist0: float,
+                      direction: float, max_time: Optional[float],
+                      max_length: Optional[float], max_bearing: float) \
+            -> Dict[str, Tuple[float, float]]:
+        csr = self.csr
+        max_time = np.inf if max_time is None else max_time
+        max_length = np.inf if max_length is None else max_length
+        start = csr.node_index(node)
+        # The search is bounded by the budgets, tentative costs are only kept
+        # for the nodes reached
+        times = {start: time0}
+        dists = {start: dist0}
+        done = set()
+        heap = [(time0, start)]
+        found = {}
+
+        def reach(camera, t, d):
+            if t <= max_time and d <= max_length and \
+                    (camera not in found or t < found[camera][0]):
+                found[camera] = (t, d)
+
+        while len(heap) != 0:
+            t, u = heapq.heappop(heap)
+            if u in done:
+                continue
+            done.add(u)
+
+            edges = range(csr.indptr[u], csr.indptr[u + 1])
+            if u == start and 0 <= direction <= 360:
+                if len(edges) == 0:
+                    break
+                deviation = np.abs(csr.bearings[edges.start:edges.stop] - direction)
+                deviation[np.isnan(deviation)] = np.inf
+                best = int(np.argmin(deviation))
+                if deviation[best] > max_bearing:
+                    break
+                edges = [edges.start + best]
+
+            for e in edges:
+                v = int(csr.targets[e])
+                if csr.edge_cameras[e]:
+                    u_id, v_id, key = csr.edge(u, e)
+                    camera = self.edge_camera.get_cameras((u_id, v_id, key))[0]
+                    # Partial edge up to the camera
+                    d = ox.distance.great_circle_vec(self.G.nodes[u_id]['y'],
+                                                     self.G.nodes[u_id]['x'],
+                                                     *self.cameraInfo[camera]['latlon'])
+                    d = min(d, csr.lengths[e])
+                    frac = d / csr.lengths[e] if csr.lengths[e] > 0 else 0.0
+                    reach(camera, t + frac * csr.travel_times[e], dists[u] + d)
+                    continue
+
+                nt = t + csr.travel_times[e]
+                nd = dists[u] + csr.lengths[e]
+                if v in done or nt > max_time or nd > max_length or nt >= times.get(v, np.inf):
+                    continue
+                times[v] = nt
+                dists[v] = nd
+                if csr.node_cameras[v]:
+                    # Do not search past a camera
+                    for camera in self.node_camera.get_cameras(int(csr.node_ids[v])):
+                        reach(camera, nt, nd)
+                else:
+                    heapq.heappush(heap, (nt, v))
+        return found
+
 
 def main():
     camera_layer = CameraOverlay(
@@ -423,6 +1289,37 @@ def main():
     assert (camera_layer.get_downstream_cameras('ferst_crc', debug=False)
             == ['ferst_hemphill'])
 
+    latlon = (33.775426, -84.402559)
+    assert (camera_layer.spatial_index.nearest_node(latlon)[0]
+            == ox.get_nearest_node(camera_layer.G, latlon))
+    assert (camera_layer.spatial_index.nearest_edge(latlon)[:3]
+            == ox.get_nearest_edge(camera_layer.G, latlon)[:3])
+
+    camera_layer.compile_csr()
+    assert (set(camera_layer.get_downstream_cameras('ferst_hemphill'))
+            == set(['ferst_state', 'ferst_crc']))
+    assert (camera_layer.get_downstream_cameras('ferst_hemphill', direction=90)
+            == ['ferst_state'])
+
+    by_travel = camera_layer.get_downstream_cameras_by_travel('ferst_hemphill',
+                                                              max_time=120)
+    assert ('ferst_state' in [c for c, _, _ in by_travel])
+
+    camera_layer.build_downstream_index()
+    assert (camera_layer.get_downstream_cameras('ferst_hemphill', direction=90)
+            == ['ferst_state'])
+    # The index agrees with the search for any direction
+    index = camera_layer.downstream_index
+    for name in camera_layer.cameraInfo:
+        for direction in [-1] + list(range(0, 360, 15)):
+            camera_layer.downstream_index = None
+            expected = camera_layer.get_downstream_cameras_with_lengths(name, direction)
+            camera_layer.downstream_index = index
+            assert (camera_layer.get_downstream_cameras_with_lengths(name, direction)
+                    == expected)
+    assert (set(camera_layer.get_downstream_cameras_with_lengths('ferst_state'))
+            == set(['ferst_hemphill', 'ferst_atlantic']))
+
     camera_layer.remove_camera('ferst_state')
 
     assert (set(camera_layer.get_downstream_cameras('ferst_hemphill', debug=False))
@@ -0,0 +1,265 @@
+import argparse
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, Optional
+
+import zmq
+
+from roadMap import CameraOverlay
+
+
+class TopologyServer:
+    """
+    Camera topology service on top of a CameraOverlay.
+
+    Requests arrive on a ROUTER socket and are served by a pool of worker
+    threads. The request protocol is the one of
+    archive/cameraTop/camera_topology_server.py (JOIN, ALIVE,
+    GET_NEIGHBOR_CAMS). The downstream cameras come from the downstream index
+    of the overlay, which update_camera/remove_camera keep up to date, and
+    the neighbors of every camera are cached until the topology changes. A
+    camera whose heartbeat stops is removed from the overlay until its next
+    heartbeat, and every topology change is published on the notification
+    socket.
+
+    With a snapshot directory, the overlay is saved there whenever a camera
+    joins, and the cameras of a loaded snapshot are served until their
+    heartbeat times out.
+    """
+
+    WORKERS_ADDR = 'inproc://topology-workers'
+
+    def __init__(self, overlay: CameraOverlay,
+                 addr: str = 'tcp://*:5555',
+                 notify_addr: str = 'tcp://*:5556',
+                 workers: int = 4,
+                 alive_timeout: float = 10,
+                 plot_dir: Optional[str] = None,
+                 snapshot: Optional[str] = None):
+        self.logger = logging.getLogger(__name__)
+        self.overlay = overlay
+        self.alive_timeout = alive_timeout
+        self.plot_dir = plot_dir
+        self.snapshot = snapshot
+
+        # Guards the overlay, cameras and the caches
+        self.lock = threading.RLock()
+        self.cameras = {}
+        self._neighbors = {}
+        if overlay.downstream_index is None:
+            overlay.build_downstream_index()
+        # Cameras which joined before the snapshot was saved
+        for name, info in overlay.cameraInfo.items():
+            meta = info.get('meta') or {}
+            if "pubsub_addr" in meta:
+                self.cameras[name] = {"latlon": tuple(info['latlon']),
+                                      "pubsub_addr": meta["pubsub_addr"],
+                                      "last_heartbeat": time.time(),
+                                      "is_active": True}
+
+        self.context = zmq.Context()
+        self.frontend = self.context.socket(zmq.ROUTER)
+        self.frontend.bind(addr)
+        self.backend = self.context.socket(zmq.DEALER)
+        self.backend.bind(self.WORKERS_ADDR)
+        self.notify_lock = threading.Lock()
+        self.notify_socket = self.context.socket(zmq.PUB)
+        self.notify_socket.bind(notify_addr)
+
+        self.workers = [threading.Thread(target=self.worker, daemon=True)
+                        for _ in range(workers)]
+        self.alive_thread = threading.Thread(target=self.alive_loop, daemon=True)
+        self.plot_queue = queue.Queue()
+        self.plot_pending = set()
+        self.plot_thread = threading.Thread(target=self.plot_loop, daemon=True)
+
+    def run(self):
+        for thread in self.workers:
+            thread.start()
+        self.alive_thread.start()
+        if self.plot_dir is not None:
+            self.plot_thread.start()
+        zmq.proxy(self.frontend, self.backend)
+
+    # Request handling
+
+    def worker(self):
+        socket = self.context.socket(zmq.REP)
+        socket.connect(self.WORKERS_ADDR)
+        while True:
+            message = socket.recv_json()
+            try:
+                response = self.handle(message)
+            except Exception as e:
+                self.logger.error('Failed to handle %s: %s' % (message, e))
+                response = {"response": "Error: %s" % e}
+            socket.send_json(response)
+
+    def handle(self, message: Dict) -> Dict:
+        request_type = message.get("request_type")
+        camera = message.get("data", {})
+        if request_type == "JOIN":
+            return self.join(camera)
+        elif request_type == "ALIVE":
+            return self.alive(camera)
+        elif request_type == "GET_NEIGHBOR_CAMS":
+            return {"response": self.neighbor_cams(camera["id"])}
+        else:
+            return {"response": "Invalid request"}
+
+    def join(self, camera: Dict) -> Dict:
+        name = camera["id"]
+        latlon = (float(camera["latitude"]), float(camera["longitude"]))
+        with self.lock:
+            self.cameras[name] = {"latlon": latlon,
+                                  "pubsub_addr": camera["pubsub_addr"],
+                                  "last_heartbeat": time.time(),
+                                  "is_active": True}
+            success, changed = self.overlay.update_camera(
+                name, latlon, {"pubsub_addr": camera["pubsub_addr"]})
+            if changed:
+                self._invalidate()
+                self.save_snapshot()
+        if changed:
+            self.notify()
+        if not success:
+            return {"response": "{} is too far from the road network".format(name)}
+        return {"response": "{} added successfully".format(name)}
+
+    def alive(self, camera: Dict) -> Dict:
+        name = camera["id"]
+        changed = False
+        with self.lock:
+            if name not in self.cameras:
+                return self.join(camera)
+            info = self.cameras[name]
+            info["last_heartbeat"] = time.time()
+            if not info["is_active"]:
+                info["is_active"] = True
+                _, changed = self.overlay.update_camera(
+                    name, info["latlon"], {"pubsub_addr": info["pubsub_addr"]})
+                if changed:
+                    self._invalidate()
+        if changed:
+            self.logger.info('%s is alive again' % name)
+            self.notify()
+        return {"response": "{} alive".format(name)}
+
+    def neighbor_cams(self, name: str) -> Dict:
+        """
+        The cameras whose downstream cameras contain the given camera, i.e.
+        the cameras it has to subscribe to. Cameras of the overlay which
+        have not joined (e.g. loaded from a config) have nothing to subscribe
+        to and are skipped.
+        """
+        computed = False
+        with self.lock:
+            if name not in self._neighbors:
+                neighbors = {}
+                for other in self.overlay.cameraInfo:
+                    if other == name or other not in self.cameras:
+                        continue
+                    if name in self.overlay.get_downstream_cameras(other):
+                        neighbors[other] = {"pubsub_addr": self.cameras[other]["pubsub_addr"]}
+                self._neighbors[name] = neighbors
+                computed = True
+            neighbors = self._neighbors[name]
+        # Only re-plot when the topology has changed
+        if computed and self.plot_dir is not None:
+            self.request_plot(name)
+        return neighbors
+
+    def _invalidate(self):
+        self._neighbors.clear()
+
+    def save_snapshot(self):
+        if self.snapshot is None:
+            return
+        with self.lock:
+            try:
+                self.overlay.save_snapshot(self.snapshot)
+            except Exception as e:
+                self.logger.error('Failed to save snapshot %s: %s' % (self.snapshot, e))
+
+    def notify(self):
+        with self.notify_lock:
+            self.notify_socket.send_string("TOPOLOGY_CHANGED")
+
+    # Liveness
+
+    def alive_loop(self, delay: float = 5):
+        while True:
+            time.sleep(delay)
+            died = []
+            with self.lock:
+                now = time.time()
+                for name, info in self.cameras.items():
+                    if info["is_active"] and now - info["last_heartbeat"] > self.alive_timeout:
+                        info["is_active"] = False
+                        self.overlay.remove_camera(name)
+                        died.append(name)
+                if len(died) > 0:
+                    self._invalidate()
+            if len(died) > 0:
+                self.logger.info('%s died' % died)
+                self.notify()
+
+    # Plotting, off the request path
+
+    def request_plot(self, name: str):
+        with self.lock:
+            if name in self.plot_pending:
+                return
+            self.plot_pending.add(name)
+        self.plot_queue.put(name)
+
+    def plot_loop(self):
+        while True:
+            name = self.plot_queue.get()
+            try:
+                # Only the routes are computed under the lock, the rendering
+                # does not hold up the requests
+                with self.lock:
+                    self.plot_pending.discard(name)
+                    plot = self.overlay.downstream_routes(name)
+                if plot is not None:
+                    self.overlay.plot_graph_routes(
+                        filepath=os.path.join(self.plot_dir, '%s.png' % name), **plot)
+            except Exception as e:
+                self.logger.error('Failed to plot %s: %s' % (name, e))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--addr", nargs="?", default="tcp://*:5555")
+    parser.add_argument("--notify_addr", nargs="?", default="tcp://*:5556")
+    parser.add_argument("--workers", nargs="?", type=int, default=4)
+    parser.add_argument("--lat", nargs="?", type=float, default=33.775259139909664)
+    parser.add_argument("--lon", nargs="?", type=float, default=-84.39705848693849)
+    parser.add_argument("--dist", nargs="?", type=float, default=500)
+    parser.add_argument("--plot_dir", nargs="?", default=None)
+    # Directory of the road network snapshot with the cameras, written on
+    # the first start and whenever a camera joins
+    parser.add_argument("--snapshot", nargs="?", default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+    overlay = CameraOverlay(latlon=(args.lat, args.lon), dist=args.dist,
+                            snapshot=args.snapshot)
+    compiled = overlay.csr is None
+    if compiled:
+        # Compiled once, later starts map the arrays of the snapshot
+        overlay.compile_csr()
+    server = TopologyServer(overlay, args.addr, args.notify_addr,
+                            args.workers, plot_dir=args.plot_dir,
+                            snapshot=args.snapshot)
+    if compiled:
+        server.save_snapshot()
+    server.run()
+
+
+if __name__ == '__main__':
+    main()
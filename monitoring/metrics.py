@@ -0,0 +1,269 @@
+"""
+Metrics shared by the camera pipeline components: counters, gauges, meters
+(events per second, what FPS used to compute) and HDR-style histograms.
+
+All metrics live in a Registry, usually the module-level `registry`. Every
+metric is backed by preallocated storage and checks registry.enabled before
+doing anything, so instrumented code costs one attribute lookup while the
+registry is disabled (the default). Updates take no lock: with several
+writer threads an increment can occasionally be lost, which is fine for
+monitoring.
+
+    frames = registry.meter('rpi1_frames')
+    frames.mark()
+    registry.gauge('stage_pending', fn=lambda: stage.pending.qsize())
+    registry.enable()
+    registry.serve(9100)  # http://host:9100/metrics
+"""
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+
+MLogger = logging.getLogger(__name__)
+
+
+class Counter:
+    def __init__(self, registry):
+        self.registry = registry
+        self.value = 0
+
+    def inc(self, n=1):
+        if self.registry.enabled:
+            self.value += n
+
+    def snapshot(self):
+        return {"value": self.value}
+
+
+class Gauge:
+    """
+    Either set, or computed by fn when a snapshot is taken, which keeps
+    things like queue depths off the hot path entirely.
+    """
+
+    def __init__(self, registry, fn=None):
+        self.registry = registry
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        if self.registry.enabled:
+            self.value = value
+
+    def snapshot(self):
+        if self.fn is not None:
+            try:
+                return {"value": self.fn()}
+            except Exception as e:
+                MLogger.debug("Gauge failed: %s" % e)
+                return {"value": None}
+        return {"value": self.value}
+
+
+class Meter:
+    """
+    Rate of events per second over the last `window` events, in a
+    preallocated ring of timestamps.
+    """
+
+    def __init__(self, registry, window=64):
+        self.registry = registry
+        self.timestamps = np.zeros(window, dtype=np.float64)
+        self.count = 0
+
+    def mark(self):
+        if self.registry.enabled:
+            self.timestamps[self.count % len(self.timestamps)] = time.time()
+            self.count += 1
+
+    def rate(self):
+        count = self.count
+        n = min(count, len(self.timestamps))
+        if n < 2:
+            return 0.0
+        last = self.timestamps[(count - 1) % len(self.timestamps)]
+        first = self.timestamps[(count - n) % len(self.timestamps)]
+        return (n - 1) / (last - first) if last > first else 0.0
+
+    def snapshot(self):
+        return {"count": self.count, "rate": self.rate()}
+
+
+class Histogram:
+    """
+    HDR-style histogram: values are counted in units of `unit` (1 us by
+    default for latencies in seconds) into log-linear buckets with
+    2 ** sub_bits buckets per power of two, i.e. a relative error below
+    2 ** -(sub_bits - 1). Values above `highest` go into the last bucket.
+    """
+
+    def __init__(self, registry, unit=1e-6, highest=1000.0, sub_bits=5):
+        self.registry = registry
+        self.unit = unit
+        self.sub_bits = sub_bits
+        self.sub_count = 1 << sub_bits
+        self.half = self.sub_count >> 1
+        self.counts = np.zeros(self._index(int(highest / unit)) + 1, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+
+    def _index(self, v):
+        if v < self.sub_count:
+            return v
+        e = v.bit_length() - self.sub_bits
+        return self.sub_count + (e - 1) * self.half + (v >> e) - self.half
+
+    def _value(self, i):
+        # Middle of the bucket, in units
+        if i < self.sub_count:
+            return i
+        e = (i - self.sub_count) // self.half + 1
+        m = (i - self.sub_count) % self.half + self.half
+        return ((m << e) + ((m + 1) << e)) / 2
+
+    def record(self, value):
+        if self.registry.enabled:
+            i = self._index(max(int(value / self.unit), 0))
+            self.counts[min(i, len(self.counts) - 1)] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        counts = self.counts.copy()
+        total = counts.sum()
+        if total == 0:
+            return None
+        i = int(np.searchsorted(np.cumsum(counts), q * total))
+        return self._value(i) * self.unit
+
+    def snapshot(self):
+        snapshot = {"count": self.count, "sum": self.sum}
+        for q in (0.5, 0.95, 0.99):
+            snapshot["p%d" % round(q * 100)] = self.quantile(q)
+        return snapshot
+
+
+class Registry:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def _get(self, cls, name, labels, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = cls(self, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("%s is already registered as a %s" % (name, type(metric).__name__))
+        return metric
+
+    def counter(self, name, labels=None):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, labels=None, fn=None):
+        gauge = self._get(Gauge, name, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def meter(self, name, labels=None, window=64):
+        return self._get(Meter, name, labels, window=window)
+
+    def histogram(self, name, labels=None, **kwargs):
+        return self._get(Histogram, name, labels, **kwargs)
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.items())
+        snapshot = []
+        for (name, labels), metric in metrics:
+            snapshot.append(dict(name=name, type=type(metric).__name__.lower(),
+                                 labels=dict(labels), **metric.snapshot()))
+        return snapshot
+
+    def dump(self, path):
+        """
+        Append a snapshot as a JSON line.
+        """
+        with open(path, "a") as f:
+            f.write(json.dumps({"timestamp": time.time(), "metrics": self.snapshot()}) + "\n")
+
+    def start_dump(self, path, interval=10):
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except Exception as e:
+                    MLogger.error("Unable to dump the metrics to %s: %s" % (path, e))
+        threading.Thread(target=dump_loop, daemon=True).start()
+
+    def prometheus_text(self):
+        lines = []
+        for m in self.snapshot():
+            labels = ",".join('%s="%s"' % item for item in sorted(m["labels"].items()))
+
+            def sample(suffix, value, extra=None):
+                all_labels = ",".join(x for x in (labels, extra) if x)
+                lines.append("%s%s%s %s" % (m["name"], suffix,
+                                            "{%s}" % all_labels if all_labels else "",
+                                            "NaN" if value is None else value))
+
+            if m["type"] in ("counter", "gauge"):
+                lines.append("# TYPE %s %s" % (m["name"], m["type"]))
+                sample("", m["value"])
+            elif m["type"] == "meter":
+                lines.append("# TYPE %s_total counter" % m["name"])
+                sample("_total", m["count"])
+                lines.append("# TYPE %s_rate gauge" % m["name"])
+                sample("_rate", m["rate"])
+            else:
+                lines.append("# TYPE %s summary" % m["name"])
+                for q in (50, 95, 99):
+                    sample("", m["p%d" % q], 'quantile="%s"' % (q / 100))
+                sample("_sum", m["sum"])
+                sample("_count", m["count"])
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        """
+        Serve /metrics (Prometheus text) and /metrics.json on port from a
+        daemon thread.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = registry.prometheus_text().encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(registry.snapshot()).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                MLogger.debug(format % args)
+
+        server = HTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+registry = Registry()
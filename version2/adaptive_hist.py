@@ -13,6 +13,61 @@ def bhattacharyya(a, b):
         raise ValueError("a and b must be of the same size")
     return -math.log(sum((math.sqrt(u * w) for u, w in zip(a, b))))
 
+
+class QuantizedHist:
+    """
+    Histogram stored as unsigned integer codes with a scale, i.e.
+    hist ~= codes * scale. uint8 codes take 1/8 of the float64 bins.
+    """
+
+    def __init__(self, codes, scale):
+        self.codes = codes
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + 4
+
+    def dequantize(self):
+        return self.codes.astype(np.float32) * self.scale
+
+
+def quantize_hist(hist, dtype=np.uint8):
+    hist = np.asarray(hist, dtype=np.float32)
+    levels = np.iinfo(dtype).max
+    peak = float(hist.max())
+    scale = peak / levels if peak > 0 else 1.0
+    codes = np.rint(hist / scale).astype(dtype)
+    return QuantizedHist(codes, scale)
+
+
+def bhattacharyya_quantized(a, b):
+    """
+    Bhattacharyya distance computed on the quantized codes:
+    sum(sqrt(a * b)) = sqrt(scale_a * scale_b) * sum(sqrt(codes_a * codes_b))
+    """
+    if not len(a) == len(b):
+        raise ValueError("a and b must be of the same size")
+    products = a.codes.astype(np.float32) * b.codes
+    bc = math.sqrt(a.scale * b.scale) * float(np.sqrt(products).sum())
+    if bc <= 0:
+        return math.inf
+    return -math.log(bc)
+
+
+def distance(a, b):
+    """
+    Bhattacharyya distance of two histograms, either both float or both
+    QuantizedHist.
+    """
+    if isinstance(a, QuantizedHist):
+        return bhattacharyya_quantized(a, b)
+    return bhattacharyya(a, b)
+
+
 def adaptive_hist(image):
     """
     image is opencv image format. I.e. image = cv2.imread(path).
@@ -2,26 +2,45 @@ import threading
 import logging
 import time
 
-from adaptive_hist import bhattacharyya as distance
+from adaptive_hist import distance, quantize_hist, QuantizedHist
 
 class CandidatePool:
     
-    def __init__(self):
+    def __init__(self, quantize=None, cleanup_thread=True):
+        """
+        quantize: None to keep float histograms, or numpy.uint8/numpy.uint16
+        to store the histograms as quantized codes.
+        cleanup_thread: start the cleanup loop in its own thread. Disable it
+        if cleanup is called by an event loop.
+        """
         self.pool = []
+        self.quantize = quantize
         self.logger = logging.getLogger("CandidatePool") 
         self.lock = threading.Lock()
-        clean_thread = threading.Thread(target=self.cleanup_loop, args=(10,10))
-        clean_thread.start()
+        if cleanup_thread:
+            clean_thread = threading.Thread(target=self.cleanup_loop, args=(10,10))
+            clean_thread.start()
+
+    def _convert(self, hist):
+        if self.quantize is None:
+            return hist.dequantize() if isinstance(hist, QuantizedHist) else hist
+        if isinstance(hist, QuantizedHist) and hist.codes.dtype == self.quantize:
+            return hist
+        if isinstance(hist, QuantizedHist):
+            hist = hist.dequantize()
+        return quantize_hist(hist, self.quantize)
 
     def push(self, event):
+        event["hist"] = self._convert(event["hist"])
         with self.lock:
             self.pool.append(event)
 
     def matching(self, target_hist, threshold):
         results = []
+        target_hist = self._convert(target_hist)
         with self.lock:
             for index in range(len(self.pool)):
-                d = distance(target_hist, e["hist"])
+                d = distance(target_hist, self.pool[index]["hist"])
                 if d < threshold:
                     self.pool[index]["matched"] = True
                     results.append((self.pool[index]["vertexid"], d))
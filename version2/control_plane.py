@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import sys
+import threading
+
+import zmq
+import zmq.asyncio
+
+from camera_topology_client import Camera
+from event_func import parse_event
+
+
+class AsyncControlPlane:
+    """
+    Control plane of a camera node on a single asyncio loop: joining the
+    network, heartbeats and neighbor queries (with timeouts), topology change
+    notifications, event subscription and candidate pool maintenance.
+
+    The loop runs in its own thread, the frame path keeps running on the
+    caller's thread. It offers the publishing interface of PubSub, so it can be
+    used wherever a PubSub is expected.
+    """
+
+    def __init__(self, cname, pubsub_addr, pool,
+                 config='../config/cameras.json', top_addr='tcp://130.207.122.57:5555',
+                 top_notify_addr=None, interval=5.0, request_timeout=2.0,
+                 cleanup_delay=10, cleanup_threshold=10):
+        self.logger = logging.getLogger(__name__)
+
+        try:
+            with open(config) as f:
+                cameraconfig = json.load(f)
+            lat, lon = cameraconfig[cname]['location']
+        except Exception as e:
+            self.logger.fatal(e)
+            sys.exit(-1)
+
+        self.cname = cname
+        self.pubsub_addr = pubsub_addr
+        self.pool = pool
+        self.top_addr = top_addr
+        self.top_notify_addr = top_notify_addr
+        self.interval = interval
+        self.request_timeout = request_timeout
+        self.cleanup_delay = cleanup_delay
+        self.cleanup_threshold = cleanup_threshold
+        self.top_client = Camera(cname, lat, lon, pubsub_addr)
+
+        self.connect_urls = set()
+        self.subscribe_to = set()
+
+        self.loop = asyncio.new_event_loop()
+        self.main_task = None
+        # Set by run() once the sockets and the main task exist, so publishing
+        # and close() can be called as soon as the constructor returns
+        self.ready = threading.Event()
+        self.startup_error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.startup_error is not None:
+            # e.g. the PUB socket could not bind, raised to the caller
+            self.thread.join()
+            raise self.startup_error
+
+    def run(self):
+        # The asyncio sockets are created on the loop's thread
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.context = zmq.asyncio.Context()
+            self.pub_socket = self.context.socket(zmq.PUB)
+            self.pub_socket.bind('tcp://*:%s' % self.pubsub_addr.split(':')[2])
+            self.sub_socket = self.context.socket(zmq.SUB)
+            self.top_socket = None
+            self.main_task = self.loop.create_task(self.main())
+        except Exception as e:
+            self.startup_error = e
+            return
+        finally:
+            # Never leave the constructor waiting, even if the bind failed
+            self.ready.set()
+        try:
+            self.loop.run_until_complete(self.main_task)
+        except asyncio.CancelledError:
+            self.logger.info('Control plane stopped')
+
+    async def main(self):
+        await self.join()
+        await asyncio.gather(self.topology_loop(),
+                             self.subscription_loop(),
+                             self.pool_loop())
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.main_task.cancel)
+        self.thread.join()
+
+    # Topology
+
+    def _reset_top_socket(self):
+        # A REQ socket that timed out waits for a reply forever, start over
+        if self.top_socket is not None:
+            self.top_socket.close(linger=0)
+        self.top_socket = self.context.socket(zmq.REQ)
+        self.top_socket.connect(self.top_addr)
+
+    async def request(self, request_type):
+        if self.top_socket is None:
+            self._reset_top_socket()
+        await self.top_socket.send_json({"request_type": request_type,
+                                         "data": self.top_client.get_json_object()})
+        try:
+            return await asyncio.wait_for(self.top_socket.recv_json(), self.request_timeout)
+        except asyncio.TimeoutError:
+            self._reset_top_socket()
+            raise
+
+    async def join(self):
+        while True:
+            try:
+                response = await self.request("JOIN")
+            except asyncio.TimeoutError:
+                self.logger.warning('No response from the topology server, retrying')
+                continue
+            self.logger.info('Joined the camera network: %s' % response)
+            return
+
+    async def topology_loop(self):
+        notify_socket = None
+        if self.top_notify_addr is not None:
+            notify_socket = self.context.socket(zmq.SUB)
+            notify_socket.connect(self.top_notify_addr)
+            notify_socket.setsockopt_string(zmq.SUBSCRIBE, '')
+
+        while True:
+            try:
+                await self.request("ALIVE")
+                response = (await self.request("GET_NEIGHBOR_CAMS"))['response']
+                self.apply_neighbors(response)
+            except asyncio.TimeoutError:
+                self.logger.warning('Topology request timed out')
+            except Exception as e:
+                self.logger.error('Topology check failed: %s' % e)
+
+            if notify_socket is None:
+                await asyncio.sleep(self.interval)
+                continue
+            try:
+                await asyncio.wait_for(notify_socket.recv(), self.interval)
+                self.logger.debug('Topology change notified')
+            except asyncio.TimeoutError:
+                pass
+
+    def apply_neighbors(self, response):
+        target_topics = set(response)
+        target_urls = set([response[t]['pubsub_addr'] for t in target_topics])
+
+        for url in target_urls - self.connect_urls:
+            self.sub_socket.connect(url)
+        for url in self.connect_urls - target_urls:
+            self.sub_socket.disconnect(url)
+        for topic in target_topics - self.subscribe_to:
+            self.sub_socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+        for topic in self.subscribe_to - target_topics:
+            self.sub_socket.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+
+        if target_urls != self.connect_urls or target_topics != self.subscribe_to:
+            self.logger.info('Neighbors changed: %s %s' % (sorted(target_topics), sorted(target_urls)))
+        self.connect_urls = target_urls
+        self.subscribe_to = target_topics
+
+    # Events
+
+    async def subscription_loop(self):
+        while True:
+            frames = await self.sub_socket.recv_multipart(copy=False)
+            try:
+                topic, event = parse_event(frames)
+            except Exception as e:
+                self.logger.error('Unable to parse the received event. Error: %s' % e)
+                continue
+            self.pool.push(event)
+            self.logger.debug('Recevied event %s-%s' % (topic, event['vehid']))
+
+    async def pool_loop(self):
+        while True:
+            self.pool.cleanup(self.cleanup_threshold)
+            await asyncio.sleep(self.cleanup_delay)
+
+    # Publishing, called from the frame path
+
+    def publishMessage(self, message):
+        self.publishMultipart(['%s|%s' % (self.cname, message)], topic=False)
+
+    def publishMultipart(self, frames, topic=True):
+        if topic:
+            frames = [self.cname.encode()] + frames
+        frames = [f.encode() if isinstance(f, str) else f for f in frames]
+        self.loop.call_soon_threadsafe(self.pub_socket.send_multipart, frames)
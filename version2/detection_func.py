@@ -2,34 +2,28 @@ import io
 import json
 import logging
 import time
-import collections
 import numpy as np
 import zmq
+import sys
+sys.path.append("..")
 
-from PIL import Image
-from HttpUtil import *
+from PIL import Image  # NOQA: E402
+from HttpUtil import *  # NOQA: E402
+from monitoring.metrics import registry  # NOQA: E402
 
 DFLogger = logging.getLogger("Detection_Func")
 
 
-class FPS:
-    def __init__(self, avarageof=10):
-        self.frametimestamps = collections.deque(maxlen=avarageof)
-
-    def __call__(self):
-        self.frametimestamps.append(time.time())
-        if(len(self.frametimestamps) > 1):
-            return len(self.frametimestamps)/(self.frametimestamps[-1]-self.frametimestamps[0])
-        else:
-            return 0.0
-
-
 def timing(f):
+    latency = registry.histogram('function_seconds', {'function': f.__qualname__})
+
     def _decorator(*args, **kwargs):
-        time1 = time.time()
+        time1 = time.perf_counter()
         ret = f(*args, **kwargs)
-        time2 = time.time()
-        DFLogger.debug("%s function took %.3f ms" % (f.__name__, (time2 - time1) * 1000.0))
+        elapsed = time.perf_counter() - time1
+        latency.record(elapsed)
+        if DFLogger.isEnabledFor(logging.DEBUG):
+            DFLogger.debug("%s function took %.3f ms" % (f.__name__, elapsed * 1000.0))
         return ret
     return _decorator
 
@@ -105,6 +99,11 @@ def resize_frame(image, w, h):
     return image.resize((w, h), Image.NEAREST)
 
 
+@timing
+def crop_frame(image, rect):
+    return image.crop(rect)
+
+
 @timing
 def inference(engine, image):
     input_tensor = np.asarray(image).flatten()
@@ -113,7 +112,13 @@ def inference(engine, image):
 
 
 @timing
-def post_inference(raw_result, tensor_start_index, target_labelIds, threshold, top_k, w, h):
+def post_inference(raw_result, tensor_start_index, target_labelIds, threshold, top_k, w, h,
+                   x_offset=0, y_offset=0):
+    """
+    w, h are the size of the region fed into the model and (x_offset, y_offset)
+    is its top-left corner in the full frame, so boxes are returned in full-frame
+    coordinates when only a crop of the frame is used for inference.
+    """
     bbox_result = []
     num_candidates = raw_result[tensor_start_index[3]]
     for i in range(int(round(num_candidates))):
@@ -125,17 +130,112 @@ def post_inference(raw_result, tensor_start_index, target_labelIds, threshold, t
                 x1 = max(0.0, raw_result[tensor_start_index[0] + 4 * i + 1])
                 y2 = min(1.0, raw_result[tensor_start_index[0] + 4 * i + 2])
                 x2 = min(1.0, raw_result[tensor_start_index[0] + 4 * i + 3])
+                # Nothing left of the box inside the frame, SORT cannot match it
+                if x2 <= x1 or y2 <= y1:
+                    continue
 
-                bbox_result.append([x1 * w, y1 * h, x2 * w, y2 * h, score])
+                bbox_result.append([x1 * w + x_offset, y1 * h + y_offset,
+                                    x2 * w + x_offset, y2 * h + y_offset, score])
     bbox_result.sort(key=lambda x: -x[4])
     return bbox_result[:top_k]
 
 
+@timing
+def detect_regions(engine, image, regions, model_w, model_h, tensor_start_index,
+                   target_labelIds, threshold, top_k):
+    """
+    Run the model on every region (x1, y1, x2, y2) of the image and return the
+    detections in full-frame coordinates. Detections of overlapping regions
+    are merged with merge_tiles.
+    """
+    image_w, image_h = image.size
+    tile_bboxes = []
+    for x1, y1, x2, y2 in regions:
+        if (x1, y1, x2, y2) == (0, 0, image_w, image_h):
+            region_image = image
+        else:
+            region_image = crop_frame(image, (x1, y1, x2, y2))
+        resized_image = resize_frame(region_image, model_w, model_h)
+        raw_result = inference(engine, resized_image)
+        tile_bboxes.append(post_inference(raw_result, tensor_start_index, target_labelIds,
+                                          threshold, top_k, x2 - x1, y2 - y1, x1, y1))
+    if len(regions) > 1:
+        bboxes = merge_tiles(tile_bboxes, regions)
+    else:
+        bboxes = tile_bboxes[0]
+    bboxes.sort(key=lambda x: -x[4])
+    return bboxes[:top_k]
+
+
+def cut_by_seam(bbox, tile, outer, margin=2):
+    """
+    Whether the box touches a border of its tile which is not a border of
+    the whole tiled area, i.e. the vehicle may continue in the next tile.
+    """
+    x1, y1, x2, y2 = bbox[:4]
+    tx1, ty1, tx2, ty2 = tile
+    ox1, oy1, ox2, oy2 = outer
+    return (tx1 > ox1 and x1 <= tx1 + margin) or (tx2 < ox2 and x2 >= tx2 - margin) or \
+        (ty1 > oy1 and y1 <= ty1 + margin) or (ty2 < oy2 and y2 >= ty2 - margin)
+
+
+@timing
+def merge_tiles(tile_bboxes, regions, iou_threshold=0.5, cut_threshold=0.6):
+    """
+    Merge the [x1, y1, x2, y2, score] boxes of overlapping tiles. The boxes
+    of one tile are kept as the model returned them; a box is only
+    suppressed by a box of another tile, when their IoU is above
+    iou_threshold (a vehicle fully visible in both tiles) or, for a box cut
+    by a tile seam, when the intersection covers cut_threshold of the
+    smaller box. Uncut boxes are preferred, so a vehicle cut by a seam is
+    replaced by its full detection from the neighbouring tile, while
+    separate overlapping vehicles are left alone.
+    """
+    outer = (min(r[0] for r in regions), min(r[1] for r in regions),
+             max(r[2] for r in regions), max(r[3] for r in regions))
+    candidates = []
+    for t, bboxes in enumerate(tile_bboxes):
+        for bbox in bboxes:
+            candidates.append((cut_by_seam(bbox, regions[t], outer), t, bbox))
+    candidates.sort(key=lambda c: (c[0], -c[2][4]))
+
+    kept = []
+    for cut, t, bbox in candidates:
+        area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+        suppressed = False
+        for kept_cut, kept_t, other in kept:
+            if kept_t == t:
+                continue
+            w = min(bbox[2], other[2]) - max(bbox[0], other[0])
+            h = min(bbox[3], other[3]) - max(bbox[1], other[1])
+            if w <= 0 or h <= 0:
+                continue
+            inter = w * h
+            other_area = (other[2] - other[0]) * (other[3] - other[1])
+            if inter / max(area + other_area - inter, 1e-6) > iou_threshold or \
+                    ((cut or kept_cut) and inter / max(min(area, other_area), 1e-6) > cut_threshold):
+                suppressed = True
+                break
+        if not suppressed:
+            kept.append((cut, t, bbox))
+    return [bbox for _, _, bbox in kept]
+
+
+send_drops = registry.counter('rpi1_send_drops')
+
+
 # image is raw frame
 @timing
-def send_detection_results(socket, image, bboxes):
+def send_detection_results(socket, image, bboxes, trace=None):
     if socket is not None:
-        socket.send_pyobj((image, bboxes), flags=zmq.NOBLOCK)
+        try:
+            if trace is None:
+                socket.send_pyobj((image, bboxes), flags=zmq.NOBLOCK)
+            else:
+                socket.send_pyobj((image, bboxes, trace), flags=zmq.NOBLOCK)
+        except zmq.Again:
+            # RPi2 is not keeping up
+            send_drops.inc()
 
 
 # Below are utility functions
@@ -152,6 +252,83 @@ def get_target_labelIds(labelpath, target_labels=["car", "bus", "truck"]):
     return ret
 
 
+def load_camera_roi(cameras_config_path, camera_name):
+    """
+    Return the ROI polygon [[x, y], ...] of the camera in full-frame pixels,
+    or None if the camera has no ROI configured.
+    """
+    with open(cameras_config_path) as f:
+        cameraconfig = json.load(f)
+    return cameraconfig[camera_name].get("roi")
+
+
+def load_camera_tiling(cameras_config_path, camera_name):
+    """
+    Return the tile layout {"rows": .., "cols": .., "overlap": ..} of the
+    camera, or None if the camera has no tiling configured.
+    """
+    with open(cameras_config_path) as f:
+        cameraconfig = json.load(f)
+    return cameraconfig[camera_name].get("tiling")
+
+
+def tile_regions(rect, rows=1, cols=1, overlap=0.0):
+    """
+    Split rect (x1, y1, x2, y2) into rows x cols tiles. Neighbouring tiles
+    overlap by the given fraction of the tile size, so that vehicles on a tile
+    border are fully visible in at least one tile.
+    """
+    x1, y1, x2, y2 = rect
+    tile_w = (x2 - x1) / (cols - (cols - 1) * overlap)
+    tile_h = (y2 - y1) / (rows - (rows - 1) * overlap)
+    regions = []
+    for r in range(rows):
+        for c in range(cols):
+            tx1 = x1 + c * tile_w * (1 - overlap)
+            ty1 = y1 + r * tile_h * (1 - overlap)
+            regions.append((int(tx1), int(ty1),
+                            min(x2, int(round(tx1 + tile_w))),
+                            min(y2, int(round(ty1 + tile_h)))))
+    return regions
+
+
+def roi_bounding_rect(polygon, image_w, image_h):
+    """
+    Bounding rectangle (x1, y1, x2, y2) of the ROI polygon clipped to the frame.
+    """
+    if polygon is None:
+        return (0, 0, image_w, image_h)
+    xs = [p[0] for p in polygon]
+    ys = [p[1] for p in polygon]
+    x1 = max(0, int(min(xs)))
+    y1 = max(0, int(min(ys)))
+    x2 = min(image_w, int(round(max(xs))))
+    y2 = min(image_h, int(round(max(ys))))
+    return (x1, y1, x2, y2)
+
+
+def point_in_polygon(x, y, polygon):
+    # Ray casting
+    inside = False
+    n = len(polygon)
+    for i in range(n):
+        xi, yi = polygon[i]
+        xj, yj = polygon[i - 1]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+    return inside
+
+
+def filter_roi(bboxes, polygon):
+    """
+    Keep the boxes whose center lies inside the ROI polygon. The bounding
+    rectangle used for inference can include areas outside the polygon.
+    """
+    if polygon is None:
+        return bboxes
+    return [b for b in bboxes if point_in_polygon((b[0] + b[2]) / 2, (b[1] + b[3]) / 2, polygon)]
+
+
 def engine_info(engine):
     output_tensors_sizes = engine.get_all_output_tensors_sizes()
     tensor_start_index = [0]
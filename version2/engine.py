@@ -0,0 +1,200 @@
+"""
+Inference engines with the surface of the EdgeTPU BasicEngine used by
+detection_func: RunInference, get_all_output_tensors_sizes and
+get_input_tensor_shape.
+
+- CoralEngine: the EdgeTPU, only on the device
+- RecordingEngine: wraps an engine and records its outputs, to be replayed
+- ReplayEngine: replays recorded outputs, anywhere
+- SyntheticEngine: generated detections with a configurable latency
+"""
+import glob
+import os
+import time
+
+import numpy as np
+
+
+class CoralEngine:
+    def __init__(self, model):
+        # Imported here, so the other engines work without the edgetpu library
+        from edgetpu.basic.basic_engine import BasicEngine
+        self.engine = BasicEngine(model)
+
+    def get_all_output_tensors_sizes(self):
+        return self.engine.get_all_output_tensors_sizes()
+
+    def get_input_tensor_shape(self):
+        return self.engine.get_input_tensor_shape()
+
+    def RunInference(self, input_tensor):
+        return self.engine.RunInference(input_tensor)
+
+
+def chunk_path(path, chunk):
+    base = path[:-len(".npz")] if path.endswith(".npz") else path
+    return "%s-%06d.npz" % (base, chunk)
+
+
+def recording_paths(path):
+    """
+    The files of a recording: path itself, or the chunks written by
+    RecordingEngine for it, in order.
+    """
+    if os.path.exists(path):
+        return [path]
+    base = path[:-len(".npz")] if path.endswith(".npz") else path
+    return sorted(glob.glob(glob.escape(base) + "-[0-9]*.npz"))
+
+
+class RecordingEngine:
+    """
+    Records the latency and output of every inference of engine for
+    ReplayEngine. Every chunk_frames inferences are written to a chunk file
+    next to path (see chunk_path), so the memory used stays bounded and a
+    crash loses at most a chunk; save() writes the last one. With max_frames,
+    the inferences past the first max_frames are not recorded.
+    """
+
+    def __init__(self, engine, path, chunk_frames=500, max_frames=None):
+        self.engine = engine
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.max_frames = max_frames
+        self.recorded = 0
+        self.chunk = 0
+        self.latencies = []
+        self.outputs = []
+
+    def get_all_output_tensors_sizes(self):
+        return self.engine.get_all_output_tensors_sizes()
+
+    def get_input_tensor_shape(self):
+        return self.engine.get_input_tensor_shape()
+
+    def RunInference(self, input_tensor):
+        latency, raw_result = self.engine.RunInference(input_tensor)
+        if self.max_frames is None or self.recorded < self.max_frames:
+            self.latencies.append(latency)
+            self.outputs.append(np.array(raw_result, dtype=np.float32))
+            self.recorded += 1
+            if len(self.outputs) >= self.chunk_frames:
+                self.save()
+        return latency, raw_result
+
+    def save(self):
+        """
+        Write the inferences recorded since the last chunk.
+        """
+        if len(self.outputs) == 0:
+            return
+        np.savez_compressed(chunk_path(self.path, self.chunk),
+                            output_sizes=np.asarray(self.get_all_output_tensors_sizes()),
+                            input_shape=np.asarray(self.get_input_tensor_shape()),
+                            latencies=np.asarray(self.latencies, dtype=np.float64),
+                            outputs=np.stack(self.outputs))
+        self.chunk += 1
+        self.latencies = []
+        self.outputs = []
+
+
+class ReplayEngine:
+    """
+    Returns the recorded outputs in order, starting over at the end when
+    loop is set. With replay_latency, each inference also takes as long as
+    the recorded one did.
+    """
+
+    def __init__(self, path, loop=True, replay_latency=False):
+        paths = recording_paths(path)
+        if len(paths) == 0:
+            raise FileNotFoundError("No recording at %s" % path)
+        recordings = [np.load(p) for p in paths]
+        self.output_sizes = recordings[0]['output_sizes']
+        self.input_shape = recordings[0]['input_shape']
+        self.latencies = np.concatenate([r['latencies'] for r in recordings])
+        self.outputs = np.concatenate([r['outputs'] for r in recordings])
+        if len(self.outputs) == 0:
+            raise ValueError("%s has no recorded inference" % path)
+        self.loop = loop
+        self.replay_latency = replay_latency
+        self.calls = 0
+
+    def get_all_output_tensors_sizes(self):
+        return self.output_sizes
+
+    def get_input_tensor_shape(self):
+        return self.input_shape
+
+    def RunInference(self, input_tensor):
+        if self.calls >= len(self.outputs) and not self.loop:
+            raise IndexError("End of the recorded inferences")
+        i = self.calls % len(self.outputs)
+        self.calls += 1
+        latency = self.latencies[i]
+        if self.replay_latency:
+            # The recorded latency is in milliseconds, as BasicEngine reports it
+            time.sleep(latency / 1000)
+        return latency, self.outputs[i]
+
+
+class SyntheticEngine:
+    """
+    An SSD model whose every inference returns `vehicles` cars driving across
+    the frame, so they get tracked, leave and are re-identified. Each
+    inference takes at least latency seconds.
+    """
+
+    def __init__(self, vehicles=4, latency=0.0, label_id=2, max_detections=20,
+                 input_shape=(1, 300, 300, 3)):
+        self.vehicles = vehicles
+        self.latency = latency
+        self.label_id = label_id
+        self.max_detections = max_detections
+        self.input_shape = np.array(input_shape)
+        self.calls = 0
+
+    def get_all_output_tensors_sizes(self):
+        n = self.max_detections
+        return np.array([4 * n, n, n, 1])
+
+    def get_input_tensor_shape(self):
+        return self.input_shape
+
+    def RunInference(self, input_tensor):
+        start = time.perf_counter()
+        n = self.max_detections
+        boxes = np.zeros((n, 4), dtype=np.float32)
+        count = min(self.vehicles, n)
+        for k in range(count):
+            # Each car crosses the frame in 100 inferences, then reappears at
+            # the left edge. The boxes stay inside the frame, as the model's do.
+            x = 0.08 + 0.84 * ((self.calls + 37 * k) % 100) / 100
+            y = 0.08 + 0.84 * (k + 0.5) / count
+            boxes[k] = [y - 0.08, x - 0.08, y + 0.08, x + 0.08]
+        classes = np.full(n, self.label_id, dtype=np.float32)
+        scores = np.zeros(n, dtype=np.float32)
+        scores[:count] = 0.9
+        raw_result = np.concatenate([boxes.flatten(), classes, scores, [count]])
+        self.calls += 1
+        # Pad to the inference latency
+        remaining = self.latency - (time.perf_counter() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+        return (time.perf_counter() - start) * 1000, raw_result
+
+
+def make_engine(kind, model=None, replay=None, replay_latency=False, latency=0.0, vehicles=4):
+    """
+    kind: 'coral' (needs model), 'replay' (needs the recorded .npz path) or
+    'synthetic'.
+    """
+    if kind == 'coral':
+        return CoralEngine(model)
+    elif kind == 'replay':
+        if replay is None:
+            raise ValueError("The replay engine needs a recording")
+        return ReplayEngine(replay, replay_latency=replay_latency)
+    elif kind == 'synthetic':
+        return SyntheticEngine(vehicles, latency)
+    raise ValueError("Unknown engine %s" % kind)
@@ -3,12 +3,21 @@ import numpy as np
 import cv2
 import time
 import json
-import collections
+import random
+import queue
+import threading
+import struct
+import sys
+sys.path.append("..")
 
-from math import floor, ceil
-from sort.sort import *
+from concurrent.futures import ThreadPoolExecutor  # NOQA: E402
 
-from adaptive_hist import adaptive_hist
+from math import floor, ceil  # NOQA: E402
+from sort.sort import *  # NOQA: E402
+
+from adaptive_hist import adaptive_hist, quantize_hist, QuantizedHist  # NOQA: E402
+from monitoring.metrics import registry  # NOQA: E402
+from tracing import Tracer  # NOQA: E402
 
 SLogger = logging.getLogger('RPi2')
 
@@ -20,34 +29,76 @@ class NumpyEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-class FPS:
-    def __init__(self, avarageof=10):
-        self.frametimestamps = collections.deque(maxlen=avarageof)
+# Binary event: [topic, header, histogram bytes]
+# header: version, histogram dtype, number of bins, vertex id, vehicle id,
+# timestamp, scale of the quantized histogram codes
+EVENT_HEADER = struct.Struct('<BBHqqdf')
+EVENT_VERSION = 2
+HIST_DTYPES = {0: np.dtype('<f4'), 1: np.dtype('<f2'), 2: np.dtype('u1'), 3: np.dtype('<u2')}
+HIST_DTYPE_CODES = {v: k for k, v in HIST_DTYPES.items()}
 
-    def __call__(self):
-        self.frametimestamps.append(time.time())
-        if(len(self.frametimestamps) > 1):
-            return len(self.frametimestamps)/(self.frametimestamps[-1]-self.frametimestamps[0])
-        else:
-            return 0.0
+
+def encode_event(vertexid, vehid, timestamp, hist, dtype=np.float32):
+    """
+    Float dtypes send the histogram bins, unsigned integer dtypes send the
+    quantized codes and their scale.
+    """
+    dtype = np.dtype(dtype)
+    if isinstance(hist, QuantizedHist) and hist.codes.dtype != dtype:
+        hist = hist.dequantize()
+    if dtype.kind == 'u' and not isinstance(hist, QuantizedHist):
+        hist = quantize_hist(hist, dtype)
+    scale = 1.0
+    if isinstance(hist, QuantizedHist):
+        hist, scale = hist.codes, hist.scale
+    hist = np.ascontiguousarray(hist, dtype=dtype.newbyteorder('<'))
+    header = EVENT_HEADER.pack(EVENT_VERSION, HIST_DTYPE_CODES[hist.dtype], len(hist),
+                               vertexid, vehid, timestamp, scale)
+    return [header, hist.tobytes()]
+
+
+def decode_event(camera, header, payload):
+    """
+    header and payload are bytes-like objects (e.g. zmq.Frame.buffer). The
+    histogram is a read-only view on the payload, no copy is made.
+    """
+    version, dtype_code, bins, vertexid, vehid, timestamp, scale = EVENT_HEADER.unpack_from(header)
+    if version != EVENT_VERSION:
+        raise ValueError('Unsupported event version %d' % version)
+    hist = np.frombuffer(payload, dtype=HIST_DTYPES[dtype_code], count=bins)
+    if hist.dtype.kind == 'u':
+        hist = QuantizedHist(hist, scale)
+    return {'vertexid': vertexid,
+            'vehid': vehid,
+            'camera': camera,
+            'timestamp': timestamp,
+            'hist': hist}
 
 
 def timing(f):
+    latency = registry.histogram('function_seconds', {'function': f.__qualname__})
+
     def _decorator(*args, **kwargs):
-        time1 = time.time()
+        time1 = time.perf_counter()
         ret = f(*args, **kwargs)
-        time2 = time.time()
-        SLogger.debug("%s function took %.3f ms" % (f.__name__, (time2 - time1) * 1000.0))
+        elapsed = time.perf_counter() - time1
+        latency.record(elapsed)
+        if SLogger.isEnabledFor(logging.DEBUG):
+            SLogger.debug("%s function took %.3f ms" % (f.__name__, elapsed * 1000.0))
         return ret
     return _decorator
 
 
 def classtiming(f):
+    latency = registry.histogram('function_seconds', {'function': f.__qualname__})
+
     def _decorator(self, *args, **kwargs):
-        time1 = time.time()
+        time1 = time.perf_counter()
         ret = f(self, *args, **kwargs)
-        time2 = time.time()
-        SLogger.debug("%s's %s function took %.3f ms" % (type(self).__name__, f.__name__, (time2 - time1) * 1000.0))
+        elapsed = time.perf_counter() - time1
+        latency.record(elapsed)
+        if SLogger.isEnabledFor(logging.DEBUG):
+            SLogger.debug("%s's %s function took %.3f ms" % (type(self).__name__, f.__name__, elapsed * 1000.0))
         return ret
     return _decorator
 
@@ -59,13 +110,16 @@ def parse_load(socket):
         return None
 
     try:
-        rawimage, bboxes = obj
+        # RPi1 sends (rawimage, bboxes), or (rawimage, bboxes, trace) when tracing
+        rawimage, bboxes = obj[:2]
+        trace = obj[2] if len(obj) > 2 else None
         nparr = np.fromstring(rawimage, np.uint8)
         image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     except Exception as e:
         SLogger.error('Unable to parse the recevied object. Error: %s' % e)
-    else:
-        return (rawimage, image, bboxes)
+        # Raised, None is only the end of a replay
+        raise
+    return (rawimage, image, bboxes, trace)
 
 @timing
 def load_opencv_PIL(pil_image):
@@ -93,59 +147,199 @@ def edge_storage(tgraph, matched_vertices, target_vertex):
 
 @timing
 def feature_extraction_adaptive_histogram(tracklet):
-    # pick the median one
-    mid = int(len(tracklet.tracklet) / 2)
-    bbox = tracklet.tracklet[mid]
+    # use the aggregated feature if the tracklet has one
+    if tracklet.feature is not None:
+        return tracklet.feature
+    # pick the median one of the kept crops
+    bbox = tracklet.median_crop()
+    if bbox is None:
+        return None
     hist = adaptive_hist(bbox.bbox_image)
     return hist
 
 
 @timing
-def messaging(pubsub, vertexid, vehid, hist):
-    event = {'vertexid': vertexid,
-             'vehid': vehid,
-             'camera': pubsub.cname,
-             'timestamp': time.time(),
-             'hist': hist}
-    json_event = json.dumps(event, cls=NumpyEncoder)
-    pubsub.publishMessage(json_event)
+def messaging(pubsub, vertexid, vehid, hist, wire='json'):
+    """
+    wire: 'json' for the cname|json string, 'binary' or 'binary16' for the
+    multipart format with float32 or float16 histogram bins, 'uint8' or
+    'uint16' for the multipart format with quantized histogram codes.
+    """
+    if wire == 'json':
+        event = {'vertexid': vertexid,
+                 'vehid': vehid,
+                 'camera': pubsub.cname,
+                 'timestamp': time.time(),
+                 'hist': hist}
+        json_event = json.dumps(event, cls=NumpyEncoder)
+        pubsub.publishMessage(json_event)
+    else:
+        dtype = {'binary': np.float32, 'binary16': np.float16,
+                 'uint8': np.uint8, 'uint16': np.uint16}[wire]
+        pubsub.publishMultipart(encode_event(vertexid, vehid, time.time(), hist, dtype))
 
 
-def listener_func(pubsub, pool):
-    while True:
-        topic, message_data = pubsub.receiveData()
+def parse_event(frames):
+    """
+    Decode a received event, either a single cname|json frame or the binary
+    multipart format.
+    """
+    if len(frames) == 1:
+        topic, message_data = frames[0].bytes.decode().split("|", 1)
         event = json.loads(message_data)
         event["hist"] = np.asarray(event["hist"])
+    else:
+        topic = frames[0].bytes.decode()
+        event = decode_event(topic, frames[1].buffer, frames[2].buffer)
+    return topic, event
+
+
+def listener_func(pubsub, pool):
+    while True:
+        frames = pubsub.receiveFrames()
+        try:
+            topic, event = parse_event(frames)
+        except Exception as e:
+            SLogger.error('Unable to parse the received event. Error: %s' % e)
+            continue
         pool.push(event)
-        SLogger.debug('Recevied event %s-%s' % (topic, message_data))
+        SLogger.debug('Recevied event %s-%s' % (topic, event['vehid']))
+
+
+def crop_bbox(frame, bbox):
+    y1, y2 = max(0, floor(bbox[1])), min(frame.shape[0], ceil(bbox[3]))
+    x1, x2 = max(0, floor(bbox[0])), min(frame.shape[1], ceil(bbox[2]))
+    return frame[y1:y2, x1:x2]
+
+
+def crop_quality(frame, bbox, border_penalty=0.25):
+    """
+    Weight of a crop in the aggregated feature: the visible area, penalized
+    if the box touches the frame border (the vehicle is likely truncated).
+    """
+    h, w = frame.shape[:2]
+    area = max(0.0, min(w, bbox[2]) - max(0, bbox[0])) * max(0.0, min(h, bbox[3]) - max(0, bbox[1]))
+    if bbox[0] <= 0 or bbox[1] <= 0 or bbox[2] >= w or bbox[3] >= h:
+        area *= border_penalty
+    return area
+
 
 class BoundingBox:
 
     def __init__(self, frameid, frame, bbox):
         self.frameid = frameid
-        self.bbox_image = frame[floor(bbox[1]):ceil(bbox[3]), floor(bbox[0]):ceil(bbox[2])]
+        # Copy the crop out, so that the decoded frame can be released
+        self.bbox_image = crop_bbox(frame, bbox).copy()
         self.bbox = bbox
 
+    @property
+    def area(self):
+        return self.bbox_image.shape[0] * self.bbox_image.shape[1]
+
 
 class Tracklet:
     """
     A track object for every vehicle before it leaves the camera
+
+    The box of every frame is kept in a compact array, while only a bounded
+    set of crops is copied out of the frames:
+    - 'reservoir': uniform sample of max_crops crops over the whole track
+    - 'largest': the max_crops crops with the largest area
     """
 
-    def __init__(self, id):
+    def __init__(self, id, max_crops=8, crop_policy='reservoir'):
         self.id = id
-        self.tracklet = []
+        self.max_crops = max_crops
+        self.crop_policy = crop_policy
+        # frameid, x1, y1, x2, y2
+        self._boxes = np.empty((16, 5), np.float64)
+        self.length = 0
+        self.crops = []
+        # quality-weighted sum of the sampled histograms
+        self.hist_sum = None
+        self.weight_sum = 0.0
+
+    @property
+    def boxes(self):
+        return self._boxes[:self.length]
+
+    @property
+    def feature(self):
+        if self.hist_sum is None or self.weight_sum <= 0:
+            return None
+        return self.hist_sum / self.weight_sum
+
+    def aggregate_feature(self, frame, bbox):
+        crop = crop_bbox(frame, bbox)
+        weight = crop_quality(frame, bbox)
+        if crop.size == 0 or weight <= 0:
+            return
+        hist = adaptive_hist(crop)
+        if self.hist_sum is None:
+            self.hist_sum = weight * hist
+        else:
+            self.hist_sum += weight * hist
+        self.weight_sum += weight
 
     def update(self, frameid, frame, bbox):
-        if len(self.tracklet) == 0:
+        if self.length == 0:
             self.start_update = frameid
         self.last_update = frameid
-        self.tracklet.append(BoundingBox(frameid, frame, bbox))
+        if self.length == len(self._boxes):
+            self._boxes = np.resize(self._boxes, (2 * len(self._boxes), 5))
+        self._boxes[self.length, 0] = frameid
+        self._boxes[self.length, 1:] = bbox[0:4]
+        self.length += 1
+        self._keep_crop(frameid, frame, bbox)
+
+    def _keep_crop(self, frameid, frame, bbox):
+        if self.crop_policy == 'largest':
+            area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+            if len(self.crops) < self.max_crops:
+                self._append_crop(frameid, frame, bbox)
+            else:
+                index = min(range(len(self.crops)), key=lambda i: self.crops[i].area)
+                if area > self.crops[index].area:
+                    self._append_crop(frameid, frame, bbox, index)
+        else:
+            # Algorithm R, the crop is only copied if it is sampled
+            if len(self.crops) < self.max_crops:
+                self._append_crop(frameid, frame, bbox)
+            else:
+                index = random.randrange(self.length)
+                if index < self.max_crops:
+                    self._append_crop(frameid, frame, bbox, index)
+
+    def _append_crop(self, frameid, frame, bbox, index=None):
+        box = BoundingBox(frameid, frame, bbox)
+        if box.area == 0:
+            return
+        if index is None:
+            self.crops.append(box)
+        else:
+            self.crops[index] = box
+
+    def median_crop(self):
+        if len(self.crops) == 0:
+            return None
+        crops = sorted(self.crops, key=lambda b: b.frameid)
+        return crops[len(crops) // 2]
+
 
 class VehicleTracking:
 
-    def __init__(self, max_age=3, min_hits=1):
+    def __init__(self, max_age=3, min_hits=1, max_crops=8, crop_policy='reservoir',
+                 feature_interval=0):
+        """
+        feature_interval: every feature_interval-th box of a tracklet is added
+        to its aggregated histogram, on the frame thread. 0 (the default)
+        disables the aggregation, and the feature is extracted from the median
+        crop by the LeavingVehicleStage workers when the vehicle leaves.
+        """
         self.max_age = max_age
+        self.max_crops = max_crops
+        self.crop_policy = crop_policy
+        self.feature_interval = feature_interval
         self.mot_tracker = Sort(max_age, min_hits)
         self.tracklets = {}
 
@@ -159,8 +353,11 @@ class VehicleTracking:
         for t in self.trackers:
             vid = int(t[4])
             if vid not in self.tracklets:
-                self.tracklets[vid] = Tracklet(vid)
-            self.tracklets[vid].update(frameid, frame, t[0:4])
+                self.tracklets[vid] = Tracklet(vid, self.max_crops, self.crop_policy)
+            tlet = self.tracklets[vid]
+            tlet.update(frameid, frame, t[0:4])
+            if self.feature_interval > 0 and (tlet.length - 1) % self.feature_interval == 0:
+                tlet.aggregate_feature(frame, t[0:4])
 
         leaving_vehicle = []
         for tlet in self.tracklets.values():
@@ -170,3 +367,120 @@ class VehicleTracking:
         for tlet in leaving_vehicle:
             del self.tracklets[tlet.id]
         return leaving_vehicle
+
+
+class LeavingVehicleStage:
+    """
+    Process the leaving vehicles off the frame loop. Features are extracted by
+    a pool of worker threads, while a single recorder thread stores, publishes
+    and matches the vehicles in the order they left.
+    """
+
+    def __init__(self, cname, tgraph, pubsub, pool, dis_thres, workers=2, max_pending=32,
+                 wire='json', tracer=None):
+        self.cname = cname
+        self.tracer = tracer
+        self.wire = wire
+        self.tgraph = tgraph
+        self.pubsub = pubsub
+        self.pool = pool
+        self.dis_thres = dis_thres
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Bounded, so the frame loop is only held back when the stage falls
+        # more than max_pending vehicles behind.
+        self.pending = queue.Queue(maxsize=max_pending)
+        registry.gauge('leaving_vehicle_pending', fn=self.pending.qsize)
+        self.failures = registry.counter('leaving_vehicle_failures')
+        self.recorder = threading.Thread(target=self.record_loop)
+        self.recorder.start()
+
+    def submit(self, vehicle, trace=None):
+        """
+        trace is the one of the frame the vehicle left in, the re-ID of the
+        vehicle is recorded in it.
+        """
+        future = self.executor.submit(feature_extraction_adaptive_histogram, vehicle)
+        if self.pending.full():
+            SLogger.warning('Leaving vehicle stage is full, waiting for the recorder')
+        self.pending.put((vehicle, future, trace, time.perf_counter()))
+
+    def record_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            vehicle, future, trace, submitted = item
+            try:
+                hist = future.result()
+                start = time.perf_counter()
+                self.record(vehicle, hist)
+            except Exception as e:
+                SLogger.error('Unable to process vehicle %d. Error: %s' % (vehicle.id, e))
+                self.failures.inc()
+                continue
+            if self.tracer is not None:
+                end = time.perf_counter()
+                self.tracer.record('reid', trace, end - start)
+                self.tracer.record('leaving_vehicle', trace, end - submitted)
+
+    def record(self, vehicle, hist):
+        if hist is None:
+            SLogger.warning("Vehicle: %d has no usable crop" % vehicle.id)
+            return
+        vertexid = vertex_storage(self.tgraph, self.cname, vehicle)
+        messaging(self.pubsub, vertexid, vehicle.id, hist, self.wire)
+
+        res = self.pool.matching(hist, self.dis_thres)
+        SLogger.info("Re-Id for vehicle %d: %s" % (vehicle.id, res))
+        edge_storage(self.tgraph, res, vertexid)
+
+    def close(self):
+        self.pending.put(None)
+        self.recorder.join()
+        self.executor.shutdown()
+
+
+def tracking_loop(socket, vt, vstore, stage, cname, tracer=None, max_frames=None,
+                  stop_on_end=False):
+    """
+    Track the vehicles of the detection results received from RPi1, store
+    the frames and hand the leaving vehicles to the stage. With stop_on_end,
+    the loop ends when RPi1 sends None. return the number of frames processed.
+    """
+    if tracer is None:
+        tracer = Tracer(enabled=False)
+    frame_id = 0
+    frames = registry.meter('rpi2_frames')
+    parse_failures = registry.counter('rpi2_parse_failures')
+    while max_frames is None or frame_id < max_frames:
+        try:
+            start = time.perf_counter()
+            loaded = parse_load(socket)
+            if loaded is None and stop_on_end:
+                break
+            rawimage, image, bboxes, trace = loaded
+        except Exception as e:
+            SLogger.warning("Unable to parse: exception %s" % e)
+            parse_failures.inc()
+            continue
+        tracer.record('parse', trace, time.perf_counter() - start)
+
+        with tracer.span('tracking', trace):
+            tracked_bboxes = vt.sort_update(bboxes)
+        SLogger.info("Track result: %s" % tracked_bboxes)
+
+        with tracer.span('storage', trace):
+            frame_storage(vstore, cname, frame_id, rawimage, tracked_bboxes)
+        with tracer.span('status_update', trace):
+            leaving_vehicles = vt.status_update(frame_id, image)
+
+        for vehicle in leaving_vehicles:
+            SLogger.info("Vehicle: %d is leaving" % vehicle.id)
+            stage.submit(vehicle, trace)
+        if trace is not None:
+            # Includes the clock offset between the two boards
+            tracer.record('fetch_to_rpi2', trace, time.time() - trace[1])
+
+        frame_id += 1
+        frames.mark()
+    return frame_id
@@ -8,8 +8,20 @@ import sys
 from camera_topology_client import *
 
 class PubSub:
+    """
+    Publish events to and receive events from the downstream/upstream cameras.
+
+    One long-lived SUB socket is kept for the lifetime of the node. The control
+    thread owns the topology REQ socket: it sends heartbeats, queries the
+    neighbor cameras every interval seconds (or as soon as the topology server
+    pushes a change notification) and hands the new neighbor set to the
+    receiving thread, which applies the difference with connect/disconnect and
+    subscribe/unsubscribe on the SUB socket it owns.
+    """
+
     def __init__(self, cname, pubsub_addr,
-            context=zmq.Context(), config='../config/cameras.json', top_addr='tcp://130.207.122.57:5555'):
+            context=zmq.Context(), config='../config/cameras.json', top_addr='tcp://130.207.122.57:5555',
+            top_notify_addr=None, interval=5.0):
 
         self.logger = logging.getLogger(__name__)
 
@@ -23,60 +35,136 @@ class PubSub:
 
         self.cname = cname
         self.context = context
-        self.connect_urls = []
-        self.subscribe_to = []
+        self.interval = interval
+        # Neighbors applied on the SUB socket, only used by the receiving thread
+        self.connect_urls = set()
+        self.subscribe_to = set()
+        # Neighbors reported by the topology server, guarded by lock
         self.lock = threading.Lock()
+        self.target_urls = set()
+        self.target_topics = set()
+
         self.top_client = Camera(cname, lat, lon, pubsub_addr)
         self.top_socket = context.socket(zmq.REQ)
         self.top_socket.connect(top_addr)
         self.top_client.join_network(self.top_socket)
 
+        self.notify_socket = None
+        if top_notify_addr is not None:
+            self.notify_socket = context.socket(zmq.SUB)
+            self.notify_socket.connect(top_notify_addr)
+            self.notify_socket.setsockopt_string(zmq.SUBSCRIBE, '')
+
         self.pub_socket = context.socket(zmq.PUB)
         self.pub_socket.bind('tcp://*:%s' % pubsub_addr.split(':')[2])
-        self.sub_socket = None
+        self.sub_socket = context.socket(zmq.SUB)
+
+        # Wakes up the receiving thread when the neighbor set changes
+        ctrl_addr = 'inproc://pubsub-ctrl-%s' % id(self)
+        self.ctrl_recv = context.socket(zmq.PAIR)
+        self.ctrl_recv.bind(ctrl_addr)
+        self.ctrl_send = context.socket(zmq.PAIR)
+        self.ctrl_send.connect(ctrl_addr)
 
-        self.thread = RepeatingTimer(5.0, self.routine_check)
+        self.poller = zmq.Poller()
+        self.poller.register(self.sub_socket, zmq.POLLIN)
+        self.poller.register(self.ctrl_recv, zmq.POLLIN)
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.control_loop, daemon=True)
         self.thread.start()
 
-    def routine_check(self):
-        #self.lock.acquire()
+    def control_loop(self):
+        poller = zmq.Poller()
+        if self.notify_socket is not None:
+            poller.register(self.notify_socket, zmq.POLLIN)
+        next_check = 0
+        while not self.stopped.is_set():
+            timeout = max(0, next_check - time.time())
+            events = dict(poller.poll(timeout * 1000))
+            if self.notify_socket in events:
+                # Drain the notifications, one query covers all of them
+                while self.notify_socket.poll(0):
+                    self.notify_socket.recv()
+                self.logger.debug('Topology change notified')
+            elif time.time() < next_check:
+                continue
+            try:
+                self.routine_check()
+            except Exception as e:
+                self.logger.error('Topology check failed: %s' % e)
+            next_check = time.time() + self.interval
 
+    def routine_check(self):
         self.top_client.send_heartbeat(self.top_socket)
         response = self.top_client.get_neighbor_cams(self.top_socket)['response']
 
-        new_subscribe_to = sorted(list(response))
-        new_connect_urls = sorted(list([response[t]['pubsub_addr'] for t in new_subscribe_to]))
-
-        print(new_subscribe_to, new_connect_urls)
-
-        if new_connect_urls != self.connect_urls:
-            self.connect_urls = new_connect_urls
-            self.sub_socket = self.context.socket(zmq.SUB)
-            for url in self.connect_urls:
-                self.sub_socket.connect(url)
-
-        if new_subscribe_to != self.subscribe_to:
-            self.subscribe_to = new_subscribe_to
-            self.sub_socket.setsockopt_string(zmq.SUBSCRIBE, '')
-            for publisher in self.subscribe_to:
-                self.sub_socket.setsockopt_string(zmq.SUBSCRIBE, publisher)
-
-        #self.lock.release()
-
+        new_subscribe_to = set(response)
+        new_connect_urls = set([response[t]['pubsub_addr'] for t in new_subscribe_to])
+
+        with self.lock:
+            if new_connect_urls == self.target_urls and new_subscribe_to == self.target_topics:
+                return
+            self.target_urls = new_connect_urls
+            self.target_topics = new_subscribe_to
+        self.logger.info('Neighbors changed: %s %s' % (sorted(new_subscribe_to), sorted(new_connect_urls)))
+        self.ctrl_send.send(b'')
+
+    def apply_neighbors(self):
+        with self.lock:
+            target_urls = set(self.target_urls)
+            target_topics = set(self.target_topics)
+
+        for url in target_urls - self.connect_urls:
+            self.sub_socket.connect(url)
+        for url in self.connect_urls - target_urls:
+            self.sub_socket.disconnect(url)
+        for topic in target_topics - self.subscribe_to:
+            self.sub_socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+        for topic in self.subscribe_to - target_topics:
+            self.sub_socket.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+
+        self.connect_urls = target_urls
+        self.subscribe_to = target_topics
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
 
     def publishMessage(self, message):
         self.pub_socket.send_string('%s|%s' % (self.cname, message))
 
-    def receiveData(self):
-        #self.lock.acquire()
-        while self.sub_socket is None:
-            time.sleep(1)
-        received_data = self.sub_socket.recv_string()
-        #self.lock.release()
+    def publishMultipart(self, frames):
+        """
+        The camera name is sent as the first (topic) frame.
+        """
+        self.pub_socket.send_multipart([self.cname.encode()] + frames, copy=False)
+
+    def receiveFrames(self):
+        """
+        Receive the frames of the next message without copying them. A message
+        sent by publishMessage arrives as a single frame.
+        Must always be called from the same thread.
+        """
+        while True:
+            events = dict(self.poller.poll())
+            if self.ctrl_recv in events:
+                while self.ctrl_recv.poll(0):
+                    self.ctrl_recv.recv()
+                self.apply_neighbors()
+            if self.sub_socket in events:
+                return self.sub_socket.recv_multipart(copy=False)
+
+    def parseMessage(self, received_data):
         try:
-            topic, message_data = received_data.split("|")
+            # The camera name does not contain '|', the message might
+            topic, message_data = received_data.split("|", 1)
         except Exception as e:
             self.logger.error('Error when parsing received messages: %s' % e)
             self.logger.error(received_data)
-
+            raise
         return (topic, message_data)
+
+    def receiveData(self):
+        frames = self.receiveFrames()
+        return self.parseMessage(frames[0].bytes.decode())
@@ -0,0 +1,77 @@
+"""
+Measure the re-ID accuracy drop of quantized histograms against the bytes
+saved per event on the wire and in the candidate pool.
+
+The crops directory contains vehicle crops named <vehicle>_<anything>.jpg.
+Each crop is used as a query against all the other crops, and the rank-1
+accuracy is the fraction of queries whose nearest crop shows the same
+vehicle.
+
+python3 quantize_benchmark.py --crops crops/ [--threshold 0.1]
+"""
+import argparse
+import glob
+import json
+import os
+
+import cv2
+import numpy as np
+
+from adaptive_hist import adaptive_hist, distance, quantize_hist
+from event_func import encode_event
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--crops")
+    parser.add_argument("--threshold", nargs='?', type=float, default=0.1)
+    args = parser.parse_args()
+    return args
+
+
+def distance_matrix(hists):
+    n = len(hists)
+    d = np.full((n, n), np.inf)
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                d[i, j] = distance(hists[i], hists[j])
+    return d
+
+
+def evaluate(labels, d, threshold, reference=None):
+    nearest = d.argmin(axis=1)
+    result = {'rank1': float(np.mean(labels[nearest] == labels)),
+              'matches': int(np.sum(d < threshold))}
+    if reference is not None:
+        result['max_distance_error'] = float(np.max(np.abs(d - reference)[np.isfinite(reference)]))
+        result['threshold_agreement'] = float(np.mean((d < threshold) == (reference < threshold)))
+    return result
+
+
+def main():
+    args = arg_parse()
+    paths = sorted(glob.glob(os.path.join(args.crops, '*.jpg')))
+    labels = np.array([os.path.basename(p).split('_')[0] for p in paths])
+    hists = [adaptive_hist(cv2.imread(p)) for p in paths]
+
+    reference = distance_matrix(hists)
+    results = {'crops': len(paths),
+               'float64': dict(evaluate(labels, reference, args.threshold),
+                               pool_bytes=hists[0].astype(np.float64).nbytes,
+                               wire_bytes=len(json.dumps(hists[0].tolist())))}
+    for name, dtype in [('float32', np.float32), ('float16', np.float16)]:
+        converted = [h.astype(dtype) for h in hists]
+        results[name] = dict(evaluate(labels, distance_matrix(converted), args.threshold, reference),
+                             pool_bytes=converted[0].nbytes,
+                             wire_bytes=sum(len(f) for f in encode_event(0, 0, 0.0, hists[0], dtype)))
+    for name, dtype in [('uint16', np.uint16), ('uint8', np.uint8)]:
+        quantized = [quantize_hist(h, dtype) for h in hists]
+        results[name] = dict(evaluate(labels, distance_matrix(quantized), args.threshold, reference),
+                             pool_bytes=quantized[0].nbytes,
+                             wire_bytes=sum(len(f) for f in encode_event(0, 0, 0.0, hists[0], dtype)))
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
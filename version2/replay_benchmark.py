@@ -0,0 +1,284 @@
+"""
+Replay an image sequence through the two-RPi pipeline on one machine and
+report throughput, per-stage latency distributions, memory high-water marks
+and drops as JSON, to compare the pipeline between commits.
+
+RPi1 (detection_loop of rpi1_run) runs in this process with a synthetic or
+a replayed engine (see engine.py),
+RPi2 (tracking_loop of event_func) in a child process, connected by a zmq PAIR
+socket over TCP as on the boards. PubSub, the video storage and the
+trajectory graph are replaced by local stand-ins which count what they get;
+published events are fed back into the candidate pool so re-ID matching
+runs as well.
+
+python3 replay_benchmark.py [--imageSeq frames/%06d.jpeg] [--frames 500] [--output result.json]
+
+Exits non-zero when RPi2 failed, timed out, tracked no frame or could not
+parse some of them.
+"""
+import argparse
+import io
+import itertools
+import json
+import multiprocessing as mp
+import queue
+import resource
+import sys
+import time
+import traceback
+
+import numpy as np
+import zmq
+from PIL import Image
+
+from detection_func import ImageSequenceStream, get_target_labelIds
+from event_func import VehicleTracking, LeavingVehicleStage, parse_event, tracking_loop
+from candidatePool import CandidatePool
+from tracing import Tracer
+from engine import make_engine
+from rpi1_run import detection_loop
+from monitoring.metrics import registry
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--imageSeq", nargs='?', default=None)
+    parser.add_argument("--labels", nargs='?', default=None)
+    parser.add_argument("--frames", nargs='?', type=int, default=500)
+    # Frame rate of the replayed camera, 0 replays as fast as possible
+    parser.add_argument("--fps", nargs='?', type=float, default=0)
+    parser.add_argument("--port", nargs='?', type=int, default=5599)
+    parser.add_argument("--engine", nargs='?', default='synthetic', choices=['synthetic', 'replay'])
+    # Inference outputs recorded on the device by rpi1_run.py --record
+    parser.add_argument("--replay", nargs='?', default=None)
+    # Replay the recorded inference latencies as well
+    parser.add_argument("--replay_latency", action='store_true')
+    parser.add_argument("--vehicles", nargs='?', type=int, default=4)
+    parser.add_argument("--inference_latency", nargs='?', type=float, default=0.0)
+    parser.add_argument("--workers", nargs='?', type=int, default=2)
+    parser.add_argument("--wire", nargs='?', default='json',
+                        choices=['json', 'binary', 'binary16', 'uint8', 'uint16'])
+    parser.add_argument("--output", nargs='?', default=None)
+    # Seconds the whole replay may take before RPi2 is given up on
+    parser.add_argument("--timeout", nargs='?', type=float, default=600)
+    args = parser.parse_args()
+    if args.engine == 'replay' and args.replay is None:
+        parser.error("--engine replay needs --replay")
+    return args
+
+
+class SyntheticStream:
+    """
+    A stream of frames frames cycling over a few random JPEG images, for when
+    no image sequence is given.
+    """
+
+    def __init__(self, frames, width=1280, height=960, images=8):
+        rng = np.random.RandomState(0)
+        self.images = []
+        for _ in range(images):
+            array = rng.randint(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+            image = Image.fromarray(array).resize((width, height), Image.BILINEAR)
+            buf = io.BytesIO()
+            image.save(buf, "JPEG", quality=80)
+            self.images.append(buf.getvalue())
+        self.frames = frames
+        self.frameId = 0
+
+    def fetch_frame(self):
+        if self.frameId >= self.frames:
+            raise StopIteration
+        frame = self.images[self.frameId % len(self.images)]
+        self.frameId += 1
+        return frame
+
+
+class PacedStream:
+    def __init__(self, stream, fps):
+        self.stream = stream
+        self.interval = 1.0 / fps
+        self.next = time.perf_counter()
+
+    def fetch_frame(self):
+        delay = self.next - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next = max(self.next + self.interval, time.perf_counter())
+        return self.stream.fetch_frame()
+
+
+class LocalPubSub:
+    def __init__(self, cname, pool):
+        self.cname = cname
+        self.pool = pool
+        self.events = 0
+        self.bytes = 0
+
+    def publishMessage(self, message):
+        self.publish([('%s|%s' % (self.cname, message)).encode()])
+
+    def publishMultipart(self, frames):
+        self.publish([self.cname.encode()] + frames)
+
+    def publish(self, frames):
+        self.events += 1
+        self.bytes += sum(len(f) for f in frames)
+        # Fed back as if received from an upstream camera
+        _, event = parse_event([zmq.Frame(f) for f in frames])
+        self.pool.push(event)
+
+
+class LocalVideoStore:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def push_frame(self, camera_name, frame_id, frame, bboxes):
+        self.frames += 1
+        self.bytes += len(frame)
+
+
+class LocalTrajectoryGraph:
+    def __init__(self):
+        self.ids = itertools.count()
+        self.detections = 0
+        self.links = 0
+
+    def addDetection(self, vehId, camId, timestamp, index):
+        self.detections += 1
+        return next(self.ids)
+
+    def linkDetection(self, src, dest, confidence):
+        self.links += 1
+
+
+def rpi2_process(addr, args, ready, results):
+    registry.enable()
+    context = zmq.Context()
+    socket = context.socket(zmq.PAIR)
+    socket.bind(addr)
+    ready.set()
+
+    cname = 'replay'
+    pool = CandidatePool(cleanup_thread=False)
+    pubsub = LocalPubSub(cname, pool)
+    vstore = LocalVideoStore()
+    tgraph = LocalTrajectoryGraph()
+    tracer = Tracer()
+    stage = LeavingVehicleStage(cname, tgraph, pubsub, pool, 0.1, args.workers,
+                                wire=args.wire, tracer=tracer)
+    vt = VehicleTracking()
+
+    start = time.perf_counter()
+    try:
+        frames = tracking_loop(socket, vt, vstore, stage, cname, tracer, stop_on_end=True)
+    except Exception:
+        results.put({"error": traceback.format_exc()})
+        raise
+    finally:
+        # The recorder thread is not a daemon, the process would not exit
+        stage.close()
+        socket.close()
+        context.term()
+    elapsed = time.perf_counter() - start
+
+    results.put({"frames": frames,
+                 "parse_failures": registry.counter('rpi2_parse_failures').value,
+                 "elapsed_s": elapsed,
+                 "fps": frames / elapsed if elapsed > 0 else 0.0,
+                 "stages": tracer.summary(),
+                 "metrics": registry.snapshot(),
+                 "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 "video_storage": {"frames": vstore.frames, "bytes": vstore.bytes},
+                 "events": {"published": pubsub.events, "bytes": pubsub.bytes},
+                 "graph": {"detections": tgraph.detections, "links": tgraph.links}})
+
+
+def check_alive(process, deadline):
+    if not process.is_alive():
+        raise RuntimeError("The RPi2 process died (exit code %s)" % process.exitcode)
+    if time.monotonic() > deadline:
+        process.terminate()
+        raise RuntimeError("The RPi2 process timed out")
+
+
+def main():
+    args = arg_parse()
+    addr = 'tcp://127.0.0.1:%d' % args.port
+    deadline = time.monotonic() + args.timeout
+
+    ready = mp.Event()
+    results = mp.Queue()
+    # Daemonic, so a failure here does not wait on RPi2 at exit
+    rpi2 = mp.Process(target=rpi2_process, args=(addr, args, ready, results), daemon=True)
+    rpi2.start()
+    while not ready.wait(1):
+        check_alive(rpi2, deadline)
+
+    registry.enable()
+    if args.imageSeq is not None:
+        stream = ImageSequenceStream(args.imageSeq)
+    else:
+        stream = SyntheticStream(args.frames)
+    if args.fps > 0:
+        stream = PacedStream(stream, args.fps)
+    target_labelIds = get_target_labelIds(args.labels) if args.labels is not None else {2: 'car'}
+    engine = make_engine(args.engine, replay=args.replay, replay_latency=args.replay_latency,
+                         latency=args.inference_latency, vehicles=args.vehicles)
+
+    context = zmq.Context()
+    socket = context.socket(zmq.PAIR)
+    # Nothing left to deliver if RPi2 died
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(addr)
+    tracer = Tracer()
+
+    start = time.perf_counter()
+    frames = detection_loop(stream, engine, socket, target_labelIds, tracer=tracer,
+                            max_frames=args.frames)
+    elapsed = time.perf_counter() - start
+    # End of the replay, waiting for room so it is never dropped
+    while not socket.poll(1000, zmq.POLLOUT):
+        check_alive(rpi2, deadline)
+    socket.send_pyobj(None)
+
+    while True:
+        try:
+            rpi2_results = results.get(timeout=1)
+            break
+        except queue.Empty:
+            check_alive(rpi2, deadline)
+    rpi2.join()
+    socket.close()
+    context.term()
+    if "error" in rpi2_results:
+        raise RuntimeError("The RPi2 process failed:\n%s" % rpi2_results["error"])
+
+    send_drops = registry.counter('rpi1_send_drops').value
+    report = {"config": vars(args),
+              "throughput_fps": rpi2_results["frames"] / max(elapsed, rpi2_results["elapsed_s"]),
+              "rpi1": {"frames": frames,
+                       "elapsed_s": elapsed,
+                       "fps": frames / elapsed if elapsed > 0 else 0.0,
+                       "stages": tracer.summary(),
+                       "metrics": registry.snapshot(),
+                       "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+              "rpi2": rpi2_results,
+              "drops": {"rpi1_send": send_drops,
+                        "lost": frames - send_drops - rpi2_results["frames"]}}
+    output = json.dumps(report, indent=4)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+    if rpi2_results["frames"] == 0 or rpi2_results["parse_failures"] > 0:
+        print("RPi2 tracked %d frames with %d parse failures"
+              % (rpi2_results["frames"], rpi2_results["parse_failures"]), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
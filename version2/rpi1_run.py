@@ -2,27 +2,105 @@ import argparse
 import zmq
 import signal
 import sys
+import time
 
 from detection_func import *
-from edgetpu.basic.basic_engine import BasicEngine
+from tracing import Tracer, new_trace
+from engine import RecordingEngine, make_engine
+
+sys.path.append("..")
+from monitoring.metrics import registry  # NOQA: E402
 
 def arg_parse():
     parser = argparse.ArgumentParser()
     parser.add_argument("--labels")
     parser.add_argument("--model")
+    # The EdgeTPU, a replay of recorded inference outputs, or synthetic detections
+    parser.add_argument("--engine", nargs='?', default='coral', choices=['coral', 'replay', 'synthetic'])
+    parser.add_argument("--replay", nargs='?', default=None)
+    # Record the inference outputs into chunks of this .npz path, for --engine replay
+    parser.add_argument("--record", nargs='?', default=None)
+    # Inferences recorded at most, the run goes on past them
+    parser.add_argument("--record_frames", nargs='?', type=int, default=None)
     parser.add_argument("--imageSeq", nargs='?', default=None)
     parser.add_argument("--live", nargs='?', default=None)
     parser.add_argument("--cameraconfig", nargs='?', default=None)
     parser.add_argument("--userconfig", nargs='?', default=None)
     parser.add_argument("--output", nargs='?', default=None)
+    # Camera whose ROI in --cameraconfig restricts the detection area
+    parser.add_argument("--roi", nargs='?', default=None)
+    # Camera whose tile layout in --cameraconfig is used for tiled inference
+    parser.add_argument("--tiling", nargs='?', default=None)
+
+    # Per-stage latency tracing, the trace of a frame is sent along to RPi2
+    parser.add_argument("--trace", action='store_true')
+    parser.add_argument("--trace_dump", nargs='?', default=None)
+    parser.add_argument("--trace_port", nargs='?', type=int, default=None)
+    # Metrics registry, enabled by either of these
+    parser.add_argument("--metrics_dump", nargs='?', default=None)
+    parser.add_argument("--metrics_port", nargs='?', type=int, default=None)
 
     parser.add_argument("--threshold", nargs='?', default=0.2)
     parser.add_argument("--top_k", nargs='?', default=10)
     
     args = parser.parse_args()
+    if args.engine == 'replay' and args.replay is None:
+        parser.error("--engine replay needs --replay")
+    if args.engine == 'coral' and args.model is None:
+        parser.error("--engine coral needs --model")
     return args
 
 
+def detection_loop(stream, engine, socket, target_labelIds, threshold=0.2, top_k=10,
+                   roi=None, tiling=None, tracer=None, max_frames=None):
+    """
+    Detect the vehicles of every frame of the stream and send the results to
+    RPi2, until the stream ends or max_frames frames are processed.
+    return the number of frames processed.
+    """
+    if tracer is None:
+        tracer = Tracer(enabled=False)
+    model_w, model_h, tensor_start_index = engine_info(engine)
+    frames = registry.meter('rpi1_frames')
+    detection_latency = registry.histogram('rpi1_detection_seconds')
+    count = 0
+    while max_frames is None or count < max_frames:
+        start = time.perf_counter()
+        try:
+            frame = stream.fetch_frame()
+        except:
+            break
+        trace = new_trace() if tracer.enabled else None
+        tracer.record('fetch', trace, time.perf_counter() - start)
+
+        detection_start = time.perf_counter()
+        with tracer.span('detection', trace):
+            image = load_frame(frame)
+            image_w, image_h = image.size
+            rect = roi_bounding_rect(roi, image_w, image_h)
+            if tiling is not None:
+                regions = tile_regions(rect, **tiling)
+            else:
+                regions = [rect]
+            bboxes = detect_regions(engine, image, regions,
+                                    model_w, model_h,
+                                    tensor_start_index,
+                                    target_labelIds,
+                                    threshold,
+                                    top_k)
+            bboxes = filter_roi(bboxes, roi)
+        detection_latency.record(time.perf_counter() - detection_start)
+        logging.info("Detection result: %s" % bboxes)
+    
+        if socket is not None:
+            with tracer.span('send', trace):
+                send_detection_results(socket, frame, bboxes, trace)
+
+        frames.mark()
+        count += 1
+    return count
+
+
 def main():
     import logging.config
     logging.config.fileConfig('logging_config.ini', disable_existing_loggers=False)
@@ -33,8 +111,9 @@ def main():
 
     if args.imageSeq is not None or args.live is not None:
         target_labelIds = get_target_labelIds(args.labels)
-        engine = BasicEngine(args.model)
-        model_w, model_h, tensor_start_index = engine_info(engine)
+        engine = make_engine(args.engine, model=args.model, replay=args.replay)
+        if args.record is not None:
+            engine = RecordingEngine(engine, args.record, max_frames=args.record_frames)
     else:
         logging.fatal("No valid stream input source")
 
@@ -52,7 +131,21 @@ def main():
         stream.login()
         logging.info("Successfully login into Campus Camera Stream --- %s" % args.live)
 
+    roi = None
+    if args.roi is not None:
+        roi = load_camera_roi(args.cameraconfig or '../config/cameras.json', args.roi)
+        if roi is None:
+            logging.warning("No ROI configured for %s, detecting on the full frame" % args.roi)
+        else:
+            logging.info("Detection restricted to ROI %s" % roi)
+    tiling = None
+    if args.tiling is not None:
+        tiling = load_camera_tiling(args.cameraconfig or '../config/cameras.json', args.tiling)
+        logging.info("Tiled inference with layout %s" % tiling)
+
     def cleanup():
+        if args.record is not None:
+            engine.save()
         if args.live is not None:
             stream.logout()
         if socket is not None:
@@ -64,27 +157,21 @@ def main():
         sys.exit(0)
     signal.signal(signal.SIGINT, signal_handler)
 
-    fps = FPS()
-    while True:
-        try:
-            frame = stream.fetch_frame()
-        except:
-            break
-        image = load_frame(frame)
-        image_w, image_h = image.size
-        resized_image = resize_frame(image, model_w, model_h)
-        raw_result = inference(engine, resized_image)
-        bboxes = post_inference(raw_result,
-                                tensor_start_index,
-                                target_labelIds,
-                                args.threshold,
-                                args.top_k, image_w, image_h)
-        logging.info("Detection result: %s" % bboxes)
-    
-        if socket is not None:
-            send_detection_results(socket, frame, bboxes)
-
-        logging.debug("FPS: %.2f" % fps())
+    tracer = Tracer(enabled=args.trace)
+    if args.trace_dump is not None:
+        tracer.start_dump(args.trace_dump)
+    if args.trace_port is not None:
+        tracer.serve(args.trace_port)
+
+    if args.metrics_dump is not None or args.metrics_port is not None:
+        registry.enable()
+    if args.metrics_dump is not None:
+        registry.start_dump(args.metrics_dump)
+    if args.metrics_port is not None:
+        registry.serve(args.metrics_port)
+
+    detection_loop(stream, engine, socket, target_labelIds, args.threshold, args.top_k,
+                   roi, tiling, tracer)
 
     cleanup()
 
@@ -1,25 +1,50 @@
 import argparse
 import zmq
 import threading
+import time
 
 from event_func import *
 from trajectoryGraph import TrajectoryGraph
 from pubsub import PubSub
 from candidatePool import CandidatePool
+from control_plane import AsyncControlPlane
+from tracing import Tracer
 
 from coldstart import coldstart
 
 import sys
-sys.path.append("..")  # NOQA: E402
-from video_storage.video_storage import VideoStorageClient
+sys.path.append("..")
+from video_storage.video_storage import VideoStorageClient, ReliableVideoStorageClient  # NOQA: E402
+from monitoring.metrics import registry  # NOQA: E402
 
 def arg_parse():
     parser = argparse.ArgumentParser()
     parser.add_argument("--port")
     parser.add_argument("--pubsub")
+    # Topology change notifications, e.g. tcp://130.207.122.57:5556
+    parser.add_argument("--top_notify", nargs='?', default=None)
+    # Run topology, heartbeat, subscription and pool maintenance on one asyncio loop
+    parser.add_argument("--async_control", action='store_true')
     parser.add_argument("--video_storage_addr")
+    # Spool the frames and pace them to the acknowledgments of the video storage
+    parser.add_argument("--video_storage_reliable", action='store_true')
+    parser.add_argument("--video_storage_spill", nargs='?', default=None)
     parser.add_argument("--cname")
     parser.add_argument("--dis_thres", nargs='?', default=0.1)
+    parser.add_argument("--max_crops", nargs='?', type=int, default=8)
+    parser.add_argument("--crop_policy", nargs='?', default='reservoir', choices=['reservoir', 'largest'])
+    # Aggregate the histogram of every n-th box of a tracklet, 0 uses the median crop
+    parser.add_argument("--feature_interval", nargs='?', type=int, default=0)
+    parser.add_argument("--workers", nargs='?', type=int, default=2)
+    parser.add_argument("--wire", nargs='?', default='json',
+                        choices=['json', 'binary', 'binary16', 'uint8', 'uint16'])
+    parser.add_argument("--pool_quantize", nargs='?', default=None, choices=['uint8', 'uint16'])
+    # Per-stage latency of the frames traced by RPi1
+    parser.add_argument("--trace_dump", nargs='?', default=None)
+    parser.add_argument("--trace_port", nargs='?', type=int, default=None)
+    # Metrics registry, enabled by either of these
+    parser.add_argument("--metrics_dump", nargs='?', default=None)
+    parser.add_argument("--metrics_port", nargs='?', type=int, default=None)
     
     args = parser.parse_args()
     return args
@@ -36,45 +61,49 @@ def main():
     socket.bind('tcp://*:%s' % args.port)
 
     # No clean up code
-    vstore = VideoStorageClient(args.video_storage_addr, context)
-    pubsub = PubSub(args.cname, args.pubsub, context)
+    if args.video_storage_reliable:
+        vstore = ReliableVideoStorageClient(args.video_storage_addr, context,
+                                            spill_dir=args.video_storage_spill)
+    else:
+        vstore = VideoStorageClient(args.video_storage_addr, context)
     tgraph = TrajectoryGraph()
-    vt = VehicleTracking()
-    pool = CandidatePool()
-
-    listen_thread = threading.Thread(target=listener_func, args=(pubsub, pool))
-    listen_thread.start()
+    vt = VehicleTracking(max_crops=args.max_crops, crop_policy=args.crop_policy,
+                         feature_interval=args.feature_interval)
+    pool_quantize = None if args.pool_quantize is None else np.dtype(args.pool_quantize)
+    if args.async_control:
+        pool = CandidatePool(quantize=pool_quantize, cleanup_thread=False)
+        pubsub = AsyncControlPlane(args.cname, args.pubsub, pool, top_notify_addr=args.top_notify)
+    else:
+        pool = CandidatePool(quantize=pool_quantize)
+        pubsub = PubSub(args.cname, args.pubsub, context, top_notify_addr=args.top_notify)
+        listen_thread = threading.Thread(target=listener_func, args=(pubsub, pool))
+        listen_thread.start()
 
     coldstart(tgraph)
 
-    frame_id = 0
-    fps = FPS()
-    while True:
-        try:
-            rawimage, image, bboxes = parse_load(socket)
-        except Exception as e:
-            logging.warn("Unable to parse: exception %s" % e)
-            continue
-                
-        tracked_bboxes = vt.sort_update(bboxes)
-        logging.info("Track result: %s" % tracked_bboxes)
-        
-        frame_storage(vstore, args.cname, frame_id, rawimage, tracked_bboxes)
-        leaving_vehicles = vt.status_update(frame_id, image)
-
-        for vehicle in leaving_vehicles:
-            logging.info("Vehicle: %d is leaving" % vehicle.id)
-            hist = feature_extraction_adaptive_histogram(vehicle)
-            vertexid = vertex_storage(tgraph, args.cname, vehicle)
-            messaging(pubsub, vertexid, vehicle.id, hist)
-
-            res = pool.matching(hist, args.dis_thres)
-            logging.info("Re-Id for vehicle %d: %s" % (vehicle.id, res))
-            edge_storage(tgraph, res, vertexid)
-
-
-        frame_id += 1
-        logging.debug("FPS: %.2f" % fps())
+    tracer = Tracer()
+    if args.trace_dump is not None:
+        tracer.start_dump(args.trace_dump)
+    if args.trace_port is not None:
+        tracer.serve(args.trace_port)
+
+    stage = LeavingVehicleStage(args.cname, tgraph, pubsub, pool, args.dis_thres, args.workers,
+                                wire=args.wire, tracer=tracer)
+
+    if args.metrics_dump is not None or args.metrics_port is not None:
+        registry.enable()
+    if args.metrics_dump is not None:
+        registry.start_dump(args.metrics_dump)
+    if args.metrics_port is not None:
+        registry.serve(args.metrics_port)
+    registry.gauge('candidate_pool_size', fn=lambda: len(pool.pool))
+    if args.video_storage_reliable:
+        for key in ['dropped', 'spool', 'spill', 'resent']:
+            registry.gauge('video_storage_client_%s' % key, fn=lambda key=key: vstore.stats()[key])
+    else:
+        registry.gauge('video_storage_client_dropped', fn=lambda: vstore.dropped)
+
+    tracking_loop(socket, vt, vstore, stage, args.cname, tracer)
 
     cleanup()
 
@@ -0,0 +1,114 @@
+"""
+Compare full-frame and tiled inference on an image sequence.
+
+Reports the frames per second of each mode and, if a ground truth file is
+given, the recall of the vehicle detections. The ground truth file is a JSON
+object mapping the frame index to a list of [x1, y1, x2, y2] boxes in
+full-frame pixels.
+
+python3 tiling_benchmark.py --model model.tflite --labels labels.txt \
+    --imageSeq 'frames/%06d.jpg' --camera ferst_state --frames 200
+"""
+import argparse
+import json
+import time
+
+from detection_func import *
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--labels")
+    parser.add_argument("--model")
+    parser.add_argument("--imageSeq")
+    parser.add_argument("--camera")
+    parser.add_argument("--cameraconfig", nargs='?', default='../config/cameras.json')
+    parser.add_argument("--groundtruth", nargs='?', default=None)
+    parser.add_argument("--frames", nargs='?', type=int, default=100)
+    parser.add_argument("--threshold", nargs='?', type=float, default=0.2)
+    parser.add_argument("--top_k", nargs='?', type=int, default=50)
+    parser.add_argument("--iou", nargs='?', type=float, default=0.5)
+    args = parser.parse_args()
+    return args
+
+
+def iou(a, b):
+    w = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    h = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = w * h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def count_matched(gt_bboxes, bboxes, iou_threshold):
+    matched = 0
+    used = set()
+    for gt in gt_bboxes:
+        for i, b in enumerate(bboxes):
+            if i not in used and iou(gt, b) >= iou_threshold:
+                used.add(i)
+                matched += 1
+                break
+    return matched
+
+
+def run_mode(args, engine, images, groundtruth, regions_of):
+    model_w, model_h, tensor_start_index = engine_info(engine)
+    target_labelIds = get_target_labelIds(args.labels)
+
+    total_gt = 0
+    total_matched = 0
+    start = time.time()
+    for index, image in enumerate(images):
+        regions = regions_of(image)
+        bboxes = detect_regions(engine, image, regions, model_w, model_h,
+                                tensor_start_index, target_labelIds,
+                                args.threshold, args.top_k)
+        if groundtruth is not None and str(index) in groundtruth:
+            gt_bboxes = groundtruth[str(index)]
+            total_gt += len(gt_bboxes)
+            total_matched += count_matched(gt_bboxes, bboxes, args.iou)
+    elapsed = time.time() - start
+
+    recall = total_matched / total_gt if total_gt > 0 else None
+    return {"fps": len(images) / elapsed, "recall": recall}
+
+
+def main():
+    from edgetpu.basic.basic_engine import BasicEngine
+
+    args = arg_parse()
+    engine = BasicEngine(args.model)
+
+    groundtruth = None
+    if args.groundtruth is not None:
+        with open(args.groundtruth) as f:
+            groundtruth = json.load(f)
+
+    # Decode once, so that only the inference path is measured
+    stream = ImageSequenceStream(args.imageSeq)
+    images = []
+    for _ in range(args.frames):
+        try:
+            images.append(load_frame(stream.fetch_frame()))
+        except Exception:
+            break
+
+    tiling = load_camera_tiling(args.cameraconfig, args.camera)
+    if tiling is None:
+        tiling = {"rows": 2, "cols": 2, "overlap": 0.1}
+
+    def full_frame(image):
+        return [(0, 0) + image.size]
+
+    def tiled(image):
+        return tile_regions((0, 0) + image.size, **tiling)
+
+    results = {"frames": len(images), "tiling": tiling,
+               "full_frame": run_mode(args, engine, images, groundtruth, full_frame),
+               "tiled": run_mode(args, engine, images, groundtruth, tiled)}
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
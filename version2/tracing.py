@@ -0,0 +1,165 @@
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+
+TLogger = logging.getLogger(__name__)
+
+
+def new_trace():
+    """
+    A trace is created for every frame when RPi1 fetches it and travels with
+    the frame: (trace id, fetch time). The fetch time is the wall clock of
+    RPi1, so latencies measured from it on RPi2 include the clock offset
+    between the two boards.
+    """
+    return (next(_trace_ids), time.time())
+
+
+# Random start, so the ids of different runs and boards hardly collide
+_trace_ids = itertools.count(random.getrandbits(48) << 15)
+
+
+class _Ring:
+    """
+    Fixed size ring of the latest spans of a stage. A stage is only recorded
+    by one thread: the writer fills the slot before publishing the new count
+    and readers copy the arrays, so no lock is needed.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.trace_ids = np.zeros(capacity, dtype=np.int64)
+        self.durations = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+
+    def record(self, trace_id, duration):
+        i = self.count % self.capacity
+        self.trace_ids[i] = trace_id
+        self.durations[i] = duration
+        self.count += 1
+
+    def snapshot(self):
+        count = self.count
+        return self.durations[:min(count, self.capacity)].copy(), count
+
+
+class Tracer:
+    """
+    Per-stage latency spans of the frames, kept in a ring of the latest
+    capacity spans per stage. A disabled tracer records nothing.
+
+        with tracer.span('detection', trace):
+            ...
+        tracer.record('end_to_end', trace, time.time() - trace[1])
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, capacity=4096, enabled=True):
+        self.capacity = capacity
+        self.enabled = enabled
+        self.rings = {}
+        # Only taken to add a stage
+        self.lock = threading.Lock()
+
+    def _ring(self, stage):
+        ring = self.rings.get(stage)
+        if ring is None:
+            with self.lock:
+                ring = self.rings.setdefault(stage, _Ring(self.capacity))
+        return ring
+
+    def record(self, stage, trace, duration):
+        if not self.enabled or trace is None:
+            return
+        self._ring(stage).record(trace[0], duration)
+
+    def span(self, stage, trace):
+        return _Span(self, stage, trace)
+
+    def summary(self):
+        """
+        {stage: {"count", "mean", "p50", "p95", "p99"}} in seconds, over the
+        spans still in the rings.
+        """
+        summary = {}
+        for stage, ring in list(self.rings.items()):
+            durations, count = ring.snapshot()
+            if len(durations) == 0:
+                continue
+            quantiles = np.quantile(durations, self.QUANTILES)
+            summary[stage] = {"count": count, "mean": float(durations.mean())}
+            for q, value in zip(self.QUANTILES, quantiles):
+                summary[stage]["p%d" % round(q * 100)] = float(value)
+        return summary
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump({"timestamp": time.time(), "stages": self.summary()}, f, indent=4)
+
+    def prometheus_text(self, name="stage_latency_seconds"):
+        lines = ["# TYPE %s summary" % name]
+        for stage, s in self.summary().items():
+            for q in self.QUANTILES:
+                lines.append('%s{stage="%s",quantile="%s"} %.6f'
+                             % (name, stage, q, s["p%d" % round(q * 100)]))
+            lines.append('%s_count{stage="%s"} %d' % (name, stage, s["count"]))
+        return "\n".join(lines) + "\n"
+
+    def start_dump(self, path, interval=10):
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except Exception as e:
+                    TLogger.error("Unable to dump the traces to %s: %s" % (path, e))
+        threading.Thread(target=dump_loop, daemon=True).start()
+
+    def serve(self, port):
+        """
+        Serve prometheus_text on http://*:port/metrics from a daemon thread.
+        """
+        tracer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = tracer.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                TLogger.debug(format % args)
+
+        server = HTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class _Span:
+    __slots__ = ("tracer", "stage", "trace", "start")
+
+    def __init__(self, tracer, stage, trace):
+        self.tracer = tracer
+        self.stage = stage
+        self.trace = trace
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.stage, self.trace, time.perf_counter() - self.start)
+        return False
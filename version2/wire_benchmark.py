@@ -0,0 +1,83 @@
+"""
+Compare the size and the encode/decode cost of a re-ID event in the JSON
+and in the binary multipart wire formats.
+
+python3 wire_benchmark.py [--image crop.jpeg] [--repeat 10000]
+"""
+import argparse
+import json
+import time
+
+import cv2
+import numpy as np
+
+from adaptive_hist import adaptive_hist
+from event_func import NumpyEncoder, encode_event, decode_event
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", nargs='?', default="coldstart.jpeg")
+    parser.add_argument("--repeat", nargs='?', type=int, default=10000)
+    args = parser.parse_args()
+    return args
+
+
+def bench(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def json_format(hist, repeat):
+    cname = 'ferst_state'
+
+    def encode():
+        event = {'vertexid': 4104, 'vehid': 17, 'camera': cname,
+                 'timestamp': time.time(), 'hist': hist}
+        return '%s|%s' % (cname, json.dumps(event, cls=NumpyEncoder))
+
+    message = encode().encode()
+
+    def decode():
+        topic, message_data = message.decode().split('|', 1)
+        event = json.loads(message_data)
+        event['hist'] = np.asarray(event['hist'])
+        return event
+
+    return {'bytes': len(message),
+            'encode_us': bench(encode, repeat),
+            'decode_us': bench(decode, repeat)}
+
+
+def binary_format(hist, repeat, dtype):
+    cname = 'ferst_state'
+
+    def encode():
+        return [cname.encode()] + encode_event(4104, 17, time.time(), hist, dtype)
+
+    frames = encode()
+
+    def decode():
+        return decode_event(frames[0].decode(), frames[1], frames[2])
+
+    return {'bytes': sum(len(f) for f in frames),
+            'encode_us': bench(encode, repeat),
+            'decode_us': bench(decode, repeat),
+            'max_abs_error': float(np.max(np.abs(decode()['hist'] - hist)))}
+
+
+def main():
+    args = arg_parse()
+    hist = adaptive_hist(cv2.imread(args.image))
+
+    results = {'bins': len(hist),
+               'json': json_format(hist, args.repeat),
+               'binary': binary_format(hist, args.repeat, np.float32),
+               'binary16': binary_format(hist, args.repeat, np.float16)}
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
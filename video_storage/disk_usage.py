@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Report the disk usage per hour of video of every camera in a video store,
+for the storage mode(s) found: JPEG per file (draw and raw modes), segments
+and video segments. The index of the segment modes records the size of the
+received JPEG frames, which gives the JPEG per file usage of the same video
+for comparison.
+
+python3 disk_usage.py [--dir videoStore]
+"""
+import argparse
+import json
+import os
+
+from video_storage import ANNOTATION_FILE, ANNOTATION_INDEX_FILE, SegmentStore, VideoSegmentStore
+
+
+def usage(total_bytes, start, end, frames):
+    hours = (end - start) / 3600 if frames > 1 else 0
+    return {'bytes': total_bytes,
+            'frames': frames,
+            'hours': hours,
+            'bytes_per_hour': total_bytes / hours if hours > 0 else None}
+
+
+def jpeg_usage(frame_dir):
+    paths = [os.path.join(frame_dir, f) for f in os.listdir(frame_dir) if f.endswith('.jpeg')]
+    if len(paths) == 0:
+        return None
+    mtimes = [os.path.getmtime(p) for p in paths]
+    return usage(sum(os.path.getsize(p) for p in paths), min(mtimes), max(mtimes), len(paths))
+
+
+def segment_usage(store, camera_name):
+    segments = store.segments.get(camera_name, [])
+    timestamps = [t for segment in segments for t in segment.timestamps]
+    if len(timestamps) == 0:
+        return None, None
+    stored = sum(os.path.getsize(segment.path + store.DATA_EXT) for segment in segments)
+    received = sum(sum(segment.lengths) for segment in segments)
+    return (usage(stored, min(timestamps), max(timestamps), len(timestamps)),
+            usage(received, min(timestamps), max(timestamps), len(timestamps)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", nargs="?", default="videoStore", help="Base directory of the stored video")
+    args = parser.parse_args()
+
+    stores = {'segment': SegmentStore(args.dir), 'video': VideoSegmentStore(args.dir)}
+    results = {}
+    for camera_name in sorted(os.listdir(args.dir)):
+        frame_dir = os.path.join(args.dir, camera_name)
+        if not os.path.isdir(frame_dir):
+            continue
+        result = {}
+        jpeg = jpeg_usage(frame_dir)
+        if jpeg is not None:
+            result['jpeg'] = jpeg
+        for mode, store in stores.items():
+            stored, received = segment_usage(store, camera_name)
+            if stored is None:
+                continue
+            result[mode] = stored
+            for segment in store.segments[camera_name]:
+                for ext in (store.ANNOTATION_EXT, store.ANNOTATION_INDEX_EXT):
+                    if os.path.exists(segment.path + ext):
+                        result['annotation_bytes'] = result.get('annotation_bytes', 0) + \
+                            os.stat(segment.path + ext).st_blocks * 512
+            result.setdefault('jpeg_equivalent', received)
+            if stored['bytes'] > 0:
+                result[mode]['jpeg_ratio'] = received['bytes'] / stored['bytes']
+        for name in (ANNOTATION_FILE, ANNOTATION_INDEX_FILE):
+            annotations = os.path.join(frame_dir, name)
+            if os.path.exists(annotations):
+                # Blocks in use, the index is sparse
+                result['annotation_bytes'] = result.get('annotation_bytes', 0) + \
+                    os.stat(annotations).st_blocks * 512
+        results[camera_name] = result
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
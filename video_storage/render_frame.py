@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Render the boxes of frames stored by a VideoStorageServer in raw, segment or video mode.
+
+python3 render_frame.py --camera ferst_state --frame_id 10 [--frame_id 11 ...] --out out/
+"""
+import argparse
+import os
+
+from video_storage import SegmentStore, VideoSegmentStore, render_frame
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", nargs="?", default="videoStore", help="Base directory of the stored video")
+    parser.add_argument("--camera")
+    parser.add_argument("--frame_id", type=int, action="append")
+    parser.add_argument("--mode", nargs="?", default="raw", choices=["raw", "segment", "video"],
+                        help="Storage mode of the video")
+    parser.add_argument("--out", nargs="?", default=".", help="Directory of the rendered frames")
+    args = parser.parse_args()
+
+    store = None
+    if args.mode == "segment":
+        store = SegmentStore(args.dir)
+    elif args.mode == "video":
+        store = VideoSegmentStore(args.dir)
+    for frame_id in args.frame_id:
+        image = render_frame(args.dir, args.camera, frame_id, store=store)
+        image.save(os.path.join(args.out, "%s_%06d.jpeg" % (args.camera, frame_id)), "JPEG")
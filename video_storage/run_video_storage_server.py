@@ -4,6 +4,7 @@ import signal
 import sys
 
 from video_storage import VideoStorageServer
+from monitoring.metrics import registry
 
 if __name__ == '__main__':
     import logging
@@ -14,14 +15,43 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--addr", nargs="?", default="tcp://*:1429", help="IP:PORT the server should listen on")
     parser.add_argument("--dir", nargs="?", default="videoStore", help="Base directory to store the video")
-    parser.add_argument("--threads", nargs="?", default=1, help="Number of worker threads")
+    parser.add_argument("--workers", nargs="?", type=int, default=2, help="Number of worker processes")
+    parser.add_argument("--queue_size", nargs="?", type=int, default=64, help="Frames queued per worker")
+    parser.add_argument("--mode", nargs="?", default="draw", choices=["draw", "raw", "segment", "video"],
+                        help="Draw the boxes into the frames, or keep the frames raw with sidecar annotations, "
+                             "as a file per frame, appended to segments or encoded into video segments")
+    parser.add_argument("--segment_seconds", nargs="?", type=int, default=60, help="Seconds of video per segment")
+    parser.add_argument("--retention", nargs="?", type=int, default=None, help="Seconds of video kept per camera")
+    parser.add_argument("--codec", nargs="?", default="h264", choices=["h264", "mjpeg"], help="Codec of the video mode")
+    parser.add_argument("--bitrate", nargs="?", default="1M", help="Bitrate of the h264 codec")
+    parser.add_argument("--fps", nargs="?", type=int, default=10, help="Frame rate of the video segments")
+    parser.add_argument("--backend", nargs="?", default="ffmpeg", choices=["ffmpeg", "opencv"],
+                        help="Encoder of the video mode")
+    parser.add_argument("--query_addr", nargs="?", default="tcp://*:1430",
+                        help="IP:PORT of the frame retrieval queries, 'none' to disable")
+    parser.add_argument("--cache_mb", nargs="?", type=int, default=256, help="Frame cache of the retrieval queries")
+    parser.add_argument("--metrics_dump", nargs="?", default=None, help="File the metrics are appended to")
+    parser.add_argument("--metrics_port", nargs="?", type=int, default=None, help="Port of the metrics HTTP endpoint")
     args = parser.parse_args()
 
-    vserver = VideoStorageServer(addr=args.addr, basedir=args.dir)
+    if args.metrics_dump is not None or args.metrics_port is not None:
+        registry.enable()
+    if args.metrics_dump is not None:
+        registry.start_dump(args.metrics_dump)
+    if args.metrics_port is not None:
+        registry.serve(args.metrics_port)
+
+    vserver = VideoStorageServer(addr=args.addr, basedir=args.dir, queue_size=args.queue_size,
+                                 mode=args.mode, segment_seconds=args.segment_seconds,
+                                 retention=args.retention,
+                                 video={"codec": args.codec, "bitrate": args.bitrate,
+                                        "fps": args.fps, "backend": args.backend},
+                                 query_addr=None if args.query_addr == "none" else args.query_addr,
+                                 cache_bytes=args.cache_mb * 1024 * 1024)
 
     def signal_handler(sig, frame):
         print("VideoStorageServer is exiting...")
         vserver.exit()
     signal.signal(signal.SIGINT, signal_handler)
 
-    vserver.run(threads = args.threads)
+    vserver.run(workers=args.workers)
@@ -5,31 +5,39 @@ import os
 import io
 import sys
 import collections
+import pickle
+import struct
+import shutil
+import tempfile
+import zlib
+import multiprocessing as mp
+import mmap
+import bisect
+import json
+import subprocess
+import uuid
 
+import cv2
+import numpy as np
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
-from threading import Thread
+from threading import Thread, Condition, Lock
 
-
-class FPS:
-    def __init__(self, avarageof=50):
-        self.frametimestamps = collections.deque(maxlen=avarageof)
-
-    def __call__(self):
-        self.frametimestamps.append(time.time())
-        if(len(self.frametimestamps) > 1):
-            return len(self.frametimestamps)/(self.frametimestamps[-1]-self.frametimestamps[0])
-        else:
-            return 0.0
+sys.path.append("..")
+from monitoring.metrics import registry  # NOQA: E402
 
 
 def timing(f):
+    latency = registry.histogram('function_seconds', {'function': f.__qualname__})
+
     def _decorator(self, *args, **kwargs):
-        time1 = time.time()
+        time1 = time.perf_counter()
         ret = f(self, *args, **kwargs)
-        time2 = time.time()
-        self.logger.debug("%s function took %.3f ms" % (f.__name__, (time2 - time1) * 1000.0))
+        elapsed = time.perf_counter() - time1
+        latency.record(elapsed)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("%s function took %.3f ms" % (f.__name__, elapsed * 1000.0))
         return ret
     return _decorator
 
@@ -40,106 +48,1218 @@ class VideoStorageClient:
         self.socket = context.socket(zmq.DEALER)
         self.socket.connect(addr)
 
+        self.dropped = 0
+
+    def push_frame(self, camera_name, frame_id, frame, bboxes):
+        # The camera name goes first, so the server can route the frame
+        # without unpickling it
+        try:
+            self.socket.send_multipart([camera_name.encode(),
+                                        pickle.dumps((camera_name, frame_id, frame, bboxes))],
+                                       flags=zmq.NOBLOCK)
+        except zmq.Again:
+            self.dropped += 1
+            self.logger.debug("Dropped frame %d, %d dropped" % (frame_id, self.dropped))
+
+
+class ReliableVideoStorageClient:
+    """
+    push_frame only appends the frame to a bounded spool and never blocks. A
+    sender thread owns the socket and keeps at most credit frames sent but not
+    acknowledged by the server; the server acknowledges a frame once a storage
+    worker queue has taken it, so the sending rate follows what the server
+    can store. Frames without an acknowledgment after ack_timeout are sent
+    again with their sequence number, e.g. after the server restarted; the
+    server drops the copies of a frame it already took, but after a server
+    restart a frame may be stored twice (at-least-once).
+
+    When the memory spool is full the frames are spilled to spill_dir (if
+    given, up to spill_frames), after that new frames are dropped. The
+    spill files are written and read by the sender thread, push_frame only
+    hands the frames over in memory (up to spool_frames more). The counters
+    are in stats().
+    """
+
+    def __init__(self, addr, context=zmq.Context(), credit=8, spool_frames=64,
+                 spill_dir=None, spill_frames=1024, ack_timeout=5.0):
+        self.logger = logging.getLogger(__name__)
+        self.addr = addr
+        self.context = context
+        self.credit = credit
+        self.spool_frames = spool_frames
+        self.spill_dir = spill_dir
+        self.spill_frames = spill_frames
+        self.ack_timeout = ack_timeout
+        if spill_dir is not None:
+            createDir(spill_dir, self.logger)
+
+        # Guards the spool, the spill and the counters
+        self.cond = Condition(Lock())
+        self.spool = collections.deque()
+        # Frames to be spilled by the sender thread, they go after the spill
+        self.to_spill = collections.deque()
+        # Taken from to_spill and being written
+        self.spilling = 0
+        self.spill_first = 0
+        self.spill_next = 0
+        self.counters = {"pushed": 0, "sent": 0, "acked": 0, "resent": 0,
+                         "spilled": 0, "dropped": 0}
+
+        self.stopped = False
+        self.thread = Thread(target=self.send_loop, daemon=True)
+        self.thread.start()
+
     def push_frame(self, camera_name, frame_id, frame, bboxes):
-        self.socket.send_pyobj((camera_name, frame_id, frame, bboxes), flags=zmq.NOBLOCK)
+        with self.cond:
+            self.counters["pushed"] += 1
+            spilled = self.spill_next - self.spill_first + self.spilling + len(self.to_spill)
+            # Once frames are spilled the new ones go after them, to keep the order
+            if len(self.spool) < self.spool_frames and spilled == 0:
+                self.spool.append((camera_name, frame_id, frame, bboxes))
+            elif self.spill_dir is not None and len(self.to_spill) < self.spool_frames \
+                    and spilled < self.spill_frames:
+                self.to_spill.append((camera_name, frame_id, frame, bboxes))
+            else:
+                self.counters["dropped"] += 1
+                return False
+            self.cond.notify()
+        return True
+
+    def _spill_path(self, i):
+        return os.path.join(self.spill_dir, "%012d.pkl" % i)
+
+    def _spill(self):
+        """
+        Write the frames handed over by push_frame to the spill, in the
+        sender thread and without holding the lock.
+        """
+        while True:
+            with self.cond:
+                if len(self.to_spill) == 0:
+                    return
+                obj = self.to_spill.popleft()
+                self.spilling += 1
+                i = self.spill_next
+            try:
+                with open(self._spill_path(i), "wb") as f:
+                    pickle.dump(obj, f)
+                failed = False
+            except OSError as e:
+                self.logger.error("Failed to spill a frame: %s" % e)
+                failed = True
+            with self.cond:
+                self.spilling -= 1
+                if failed:
+                    self.counters["dropped"] += 1
+                else:
+                    self.spill_next += 1
+                    self.counters["spilled"] += 1
+
+    def _next(self):
+        """
+        The next frame to send: from the spool, then from the spill and then
+        the frames not spilled yet. The spill is read without the lock.
+        """
+        with self.cond:
+            if len(self.spool) > 0:
+                return self.spool.popleft()
+            if self.spill_first == self.spill_next:
+                if len(self.to_spill) > 0:
+                    return self.to_spill.popleft()
+                return None
+            path = self._spill_path(self.spill_first)
+            self.spill_first += 1
+        try:
+            with open(path, "rb") as f:
+                obj = pickle.load(f)
+            os.remove(path)
+            return obj
+        except (OSError, pickle.UnpicklingError) as e:
+            self.logger.error("Failed to read a spilled frame: %s" % e)
+            with self.cond:
+                self.counters["dropped"] += 1
+        return None
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats["spool"] = len(self.spool)
+            stats["spill"] = self.spill_next - self.spill_first + self.spilling + len(self.to_spill)
+        return stats
+
+    def close(self):
+        self.stopped = True
+        with self.cond:
+            self.cond.notify()
+        self.thread.join()
+
+    def send_loop(self):
+        socket = self.context.socket(zmq.DEALER)
+        # Kept across reconnections, the server tells the resent frames apart
+        # by identity and sequence number
+        socket.setsockopt(zmq.IDENTITY, b"vs-" + uuid.uuid4().hex.encode())
+        socket.connect(self.addr)
+        seq = 0
+        # seq -> (time sent, message) of the frames not acknowledged yet
+        in_flight = collections.OrderedDict()
+        while not self.stopped:
+            while len(in_flight) < self.credit:
+                with self.cond:
+                    if len(in_flight) == 0 and len(self.spool) == 0 and len(self.to_spill) == 0 \
+                            and self.spill_first == self.spill_next:
+                        self.cond.wait(0.1)
+                obj = self._next()
+                if obj is None:
+                    break
+                message = [obj[0].encode(), pickle.dumps(obj)]
+                seq += 1
+                socket.send_multipart(message + [b"%d" % seq])
+                in_flight[seq] = (time.time(), message)
+                with self.cond:
+                    self.counters["sent"] += 1
+
+            # Out of credit, what push_frame handed over goes to disk
+            if self.spill_dir is not None:
+                self._spill()
+
+            if len(in_flight) > 0 and socket.poll(100):
+                while True:
+                    try:
+                        acked = int(socket.recv(flags=zmq.NOBLOCK))
+                    except zmq.Again:
+                        break
+                    if in_flight.pop(acked, None) is not None:
+                        with self.cond:
+                            self.counters["acked"] += 1
+
+            # The oldest frame is the first to time out
+            now = time.time()
+            if len(in_flight) > 0 and now - next(iter(in_flight.values()))[0] > self.ack_timeout:
+                self.logger.warning("No acknowledgment for %d frames, sending them again" % len(in_flight))
+                for key in list(in_flight):
+                    _, message = in_flight.pop(key)
+                    socket.send_multipart(message + [b"%d" % key])
+                    in_flight[key] = (now, message)
+                with self.cond:
+                    self.counters["resent"] += len(in_flight)
+        socket.close(linger=0)
+
+
+# Sidecar annotations: a record per frame, the frame header followed by its boxes
+ANNOTATION_HEADER = struct.Struct('<qI')  # frame_id, number of boxes
+ANNOTATION_BOX = struct.Struct('<ffffq')  # x1, y1, x2, y2, vehicle id
+ANNOTATION_FILE = "annotations.bin"
+# The offset + 1 of the last record of a frame in ANNOTATION_FILE, at
+# frame_id * size (0 when the frame has none), so a frame is found with one
+# seek. The frame ids of a camera are consecutive, holes stay sparse.
+ANNOTATION_INDEX = struct.Struct('<Q')
+ANNOTATION_INDEX_FILE = "annotations.aidx"
+
+colorNames = ['aqua', 'black', 'blue', 'fuchsia',
+              'gray', 'green', 'lime', 'maroon',
+              'navy', 'olive', 'purple', 'red',
+              'silver', 'teal', 'white', 'yellow']
+
+
+def draw_bboxes(image, bboxes, font):
+    draw = ImageDraw.Draw(image)
+    for bbox in bboxes:
+        x1, y1, x2, y2, vid = bbox
+        color = colorNames[int(vid) % len(colorNames)]
+        draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
+        draw.text([x1, y1], str(vid), fill="red", font=font)
+    return image
+
+
+def encode_annotations(frame_id, bboxes):
+    record = [ANNOTATION_HEADER.pack(frame_id, len(bboxes))]
+    for x1, y1, x2, y2, vid in bboxes:
+        record.append(ANNOTATION_BOX.pack(x1, y1, x2, y2, int(vid)))
+    return b''.join(record)
+
+
+def read_annotations(path):
+    """
+    Read a sidecar annotation file into {frame_id: bboxes}. A frame written
+    twice keeps its last boxes, a truncated last record is ignored.
+    """
+    annotations = {}
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + ANNOTATION_HEADER.size <= len(data):
+        frame_id, count = ANNOTATION_HEADER.unpack_from(data, offset)
+        end = offset + ANNOTATION_HEADER.size + count * ANNOTATION_BOX.size
+        if end > len(data):
+            break
+        annotations[frame_id] = [list(b) for b in ANNOTATION_BOX.iter_unpack(
+            data[offset + ANNOTATION_HEADER.size:end])]
+        offset = end
+    return annotations
+
+
+def read_frame_annotations(frame_dir, frame_id):
+    """
+    The boxes of a frame, looked up through the annotation index of the
+    camera directory frame_dir. Sidecars written without an index are read
+    whole.
+    """
+    index_path = os.path.join(frame_dir, ANNOTATION_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return read_annotations(os.path.join(frame_dir, ANNOTATION_FILE)).get(frame_id, [])
+    return read_indexed_annotations(os.path.join(frame_dir, ANNOTATION_FILE), index_path, frame_id)
+
+
+def read_indexed_annotations(path, index_path, i):
+    """
+    The boxes of entry i of the annotation index index_path, whose records
+    are in path.
+    """
+    with open(index_path, "rb") as f:
+        f.seek(i * ANNOTATION_INDEX.size)
+        entry = f.read(ANNOTATION_INDEX.size)
+    if len(entry) < ANNOTATION_INDEX.size or ANNOTATION_INDEX.unpack(entry)[0] == 0:
+        return []
+    with open(path, "rb") as f:
+        f.seek(ANNOTATION_INDEX.unpack(entry)[0] - 1)
+        header = f.read(ANNOTATION_HEADER.size)
+        if len(header) < ANNOTATION_HEADER.size:
+            return []
+        _, count = ANNOTATION_HEADER.unpack(header)
+        data = f.read(count * ANNOTATION_BOX.size)
+    if len(data) < count * ANNOTATION_BOX.size:
+        return []
+    return [list(b) for b in ANNOTATION_BOX.iter_unpack(data)]
+
+
+def render_frame(basedir, camera_name, frame_id, font="./FiraCode-Regular.otf",
+                 annotations=None, store=None):
+    """
+    Draw the boxes of a frame stored in raw or segment mode, the latter
+    needs the SegmentStore of basedir. The boxes are looked up in the
+    annotation index, unless annotations (from read_annotations) are passed.
+    """
+    frame_dir = os.path.join(basedir, camera_name)
+    bboxes = None
+    if annotations is not None:
+        bboxes = annotations.get(frame_id, [])
+    elif store is not None:
+        bboxes = store.get_annotations(camera_name, frame_id)
+    if bboxes is None:
+        # Raw mode, or segments written before they had their annotations
+        bboxes = read_frame_annotations(frame_dir, frame_id)
+    if store is None:
+        image = Image.open(os.path.join(frame_dir, "%06d.jpeg" % frame_id))
+    else:
+        image = Image.open(io.BytesIO(store.get(camera_name, frame_id)))
+    return draw_bboxes(image, bboxes, ImageFont.truetype(font, 24))
+
+
+class SegmentStore:
+    """
+    Append-only frame store. The frames of a camera are appended to segment
+    files, a new one every segment_seconds, named after their start time:
+
+        <basedir>/<camera>/<start>.seg   frames, back to back
+        <basedir>/<camera>/<start>.idx   a SEGMENT_INDEX record per frame
+        <basedir>/<camera>/<start>.ann   the annotation records of the frames
+        <basedir>/<camera>/<start>.aidx  an ANNOTATION_INDEX entry per frame
+
+    The indexes are kept in memory to find a frame by frame_id or the frames
+    of a time range, which are read through mmap. Retention deletes whole
+    segments, annotations included. A camera must only be written by one SegmentStore at a time;
+    readers in other processes call reload to see the new frames.
+    """
+
+    SEGMENT_INDEX = struct.Struct('<qdQI')  # frame_id, timestamp, offset, length
+    DATA_EXT = ".seg"
+    INDEX_EXT = ".idx"
+    ANNOTATION_EXT = ".ann"
+    ANNOTATION_INDEX_EXT = ".aidx"
+    CONTINUE_SEGMENTS = True
+
+    class _Segment:
+        def __init__(self, path, start):
+            self.path = path
+            self.start = start
+            self.frame_ids = []
+            self.timestamps = []
+            self.offsets = []
+            self.lengths = []
+            self.index_size = 0
+            self.size = 0
+            self.mmap = None
+
+        def add(self, frame_id, timestamp, offset, length):
+            self.frame_ids.append(frame_id)
+            self.timestamps.append(timestamp)
+            self.offsets.append(offset)
+            self.lengths.append(length)
+            self.size = max(self.size, offset + length)
+
+        def read(self, i):
+            offset, length = self.offsets[i], self.lengths[i]
+            # The active segment grows, map it again when needed
+            if self.mmap is None or len(self.mmap) < offset + length:
+                self.close()
+                with open(self.path + SegmentStore.DATA_EXT, "rb") as f:
+                    self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self.mmap)[offset:offset + length]
+
+        def close(self):
+            if self.mmap is not None:
+                try:
+                    self.mmap.close()
+                except BufferError:
+                    # Still referenced by a returned frame, dropped with it
+                    pass
+                self.mmap = None
+
+    def __init__(self, basedir="videoStore", segment_seconds=60, retention=None):
+        self.logger = logging.getLogger(__name__)
+        self.basedir = basedir
+        self.segment_seconds = segment_seconds
+        # Seconds of video kept per camera, None keeps everything
+        self.retention = retention
+        self.segments = {}
+        self.frames = {}
+        self.writers = {}
+        self.reload()
+
+    def cameras(self):
+        return sorted(self.segments)
+
+    def reload(self, camera_name=None):
+        """
+        Load the segments written since the last call, of a camera or of all
+        the cameras in basedir.
+        """
+        if camera_name is not None:
+            names = [camera_name]
+        elif os.path.isdir(self.basedir):
+            names = [d for d in os.listdir(self.basedir)
+                     if os.path.isdir(os.path.join(self.basedir, d))]
+        else:
+            names = []
+        for name in names:
+            frame_dir = os.path.join(self.basedir, name)
+            if not os.path.isdir(frame_dir):
+                continue
+            starts = sorted(int(f[:-len(self.INDEX_EXT)]) for f in os.listdir(frame_dir)
+                            if f.endswith(self.INDEX_EXT))
+            segments = self.segments.setdefault(name, [])
+            known = {segment.start: segment for segment in segments}
+            for start in starts:
+                if start not in known:
+                    segment = self._Segment(os.path.join(frame_dir, str(start)), start)
+                    starts_loaded = [x.start for x in segments]
+                    segments.insert(bisect.bisect(starts_loaded, start), segment)
+                    known[start] = segment
+                self._load_index(name, known[start])
+            # Segments deleted by the retention of the writer
+            for segment in [x for x in segments if x.start not in starts]:
+                self._drop(name, segment)
+
+    def _load_index(self, camera_name, segment):
+        with open(segment.path + self.INDEX_EXT, "rb") as f:
+            f.seek(segment.index_size)
+            data = f.read()
+        # Ignore a record that is still being written
+        usable = len(data) - len(data) % self.SEGMENT_INDEX.size
+        frames = self.frames.setdefault(camera_name, {})
+        for frame_id, timestamp, offset, length in self.SEGMENT_INDEX.iter_unpack(data[:usable]):
+            frames[frame_id] = (segment, len(segment.frame_ids))
+            segment.add(frame_id, timestamp, offset, length)
+        segment.index_size += usable
+
+    def append(self, camera_name, frame_id, frame, timestamp=None, annotations=None):
+        """
+        annotations: the encode_annotations record of the frame, if any.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        writer = self.writers.get(camera_name)
+        if writer is None or timestamp >= writer[0].start + self.segment_seconds:
+            writer = self._roll(camera_name, int(timestamp))
+        segment, data, index, ann, ann_index = writer
+        offset, length = self._write_data(segment, data, frame)
+        if annotations is not None:
+            # Before the index record, which makes the frame visible
+            ann_offset = ann.tell()
+            ann.write(annotations)
+            ann.flush()
+            ann_index.seek(len(segment.frame_ids) * ANNOTATION_INDEX.size)
+            ann_index.write(ANNOTATION_INDEX.pack(ann_offset + 1))
+            ann_index.flush()
+        index.write(self.SEGMENT_INDEX.pack(frame_id, timestamp, offset, length))
+        index.flush()
+        self.frames.setdefault(camera_name, {})[frame_id] = (segment, len(segment.frame_ids))
+        segment.add(frame_id, timestamp, offset, length)
+        segment.index_size += self.SEGMENT_INDEX.size
+
+    def _roll(self, camera_name, start):
+        self._close_writer(camera_name)
+        frame_dir = os.path.join(self.basedir, camera_name)
+        if not os.path.isdir(frame_dir):
+            createDir(frame_dir, self.logger)
+        segments = self.segments.setdefault(camera_name, [])
+        segment = None
+        # A restart within the time span of the last segment (or a clock set
+        # back before it)
+        if len(segments) > 0 and start < segments[-1].start + self.segment_seconds:
+            if self.CONTINUE_SEGMENTS:
+                segment = segments[-1]
+            else:
+                start = max(start, segments[-1].start + 1)
+        if segment is None:
+            segment = self._Segment(os.path.join(frame_dir, str(start)), start)
+            segments.append(segment)
+        # Drop a partially written last frame of a previous run
+        with open(segment.path + self.INDEX_EXT, "ab") as index:
+            index.truncate(segment.index_size)
+        ann_index_path = segment.path + self.ANNOTATION_INDEX_EXT
+        writer = (segment, self._open_data(segment), open(segment.path + self.INDEX_EXT, "ab"),
+                  open(segment.path + self.ANNOTATION_EXT, "ab"),
+                  open(ann_index_path, "r+b" if os.path.exists(ann_index_path) else "w+b"))
+        self.writers[camera_name] = writer
+        if self.retention is not None:
+            self.delete_before(start - self.retention, camera_name)
+        self.logger.debug("New segment %s" % segment.path)
+        return writer
+
+    def _close_writer(self, camera_name):
+        writer = self.writers.pop(camera_name, None)
+        if writer is not None:
+            self._close_data(writer[1])
+            for f in writer[2:]:
+                f.close()
+
+    # The segment data, overridden by VideoSegmentStore
+
+    def _open_data(self, segment):
+        with open(segment.path + self.DATA_EXT, "ab") as data:
+            data.truncate(segment.size)
+        return open(segment.path + self.DATA_EXT, "ab")
+
+    def _write_data(self, segment, data, frame):
+        offset = segment.size
+        data.write(frame)
+        data.flush()
+        return offset, len(frame)
+
+    def _close_data(self, data):
+        data.close()
+
+    def _read(self, segment, i):
+        return segment.read(i)
+
+    def get(self, camera_name, frame_id):
+        """
+        The bytes of a frame (a memoryview of the segment), or None.
+        """
+        found = self.frames.get(camera_name, {}).get(frame_id)
+        if found is None:
+            return None
+        segment, i = found
+        return self._read(segment, i)
+
+    def get_annotations(self, camera_name, frame_id):
+        """
+        The boxes of a frame, or None when the frame or its segment has no
+        annotations.
+        """
+        found = self.frames.get(camera_name, {}).get(frame_id)
+        if found is None:
+            return None
+        segment, i = found
+        if not os.path.exists(segment.path + self.ANNOTATION_INDEX_EXT):
+            return None
+        return read_indexed_annotations(segment.path + self.ANNOTATION_EXT,
+                                        segment.path + self.ANNOTATION_INDEX_EXT, i)
+
+    def range(self, camera_name, start, end):
+        """
+        Iterate over (frame_id, timestamp, frame) of the frames with
+        start <= timestamp < end, in the order they were written.
+        """
+        for segment in self.segments.get(camera_name, []):
+            if segment.start >= end or segment.start + self.segment_seconds <= start:
+                continue
+            for i, timestamp in enumerate(segment.timestamps):
+                if start <= timestamp < end:
+                    yield segment.frame_ids[i], timestamp, self._read(segment, i)
+
+    def delete_before(self, timestamp, camera_name=None):
+        """
+        Delete the segments which only contain frames older than timestamp.
+        The segment being written is never deleted.
+        """
+        names = self.cameras() if camera_name is None else [camera_name]
+        for name in names:
+            writer = self.writers.get(name)
+            for segment in list(self.segments.get(name, [])):
+                if writer is not None and segment is writer[0]:
+                    continue
+                if segment.start + self.segment_seconds > timestamp:
+                    continue
+                self._drop(name, segment)
+                for ext in (self.INDEX_EXT, self.DATA_EXT,
+                            self.ANNOTATION_INDEX_EXT, self.ANNOTATION_EXT):
+                    try:
+                        os.remove(segment.path + ext)
+                    except FileNotFoundError:
+                        pass
+                self.logger.info("Deleted segment %s" % segment.path)
+
+    def _drop(self, camera_name, segment):
+        self.segments[camera_name].remove(segment)
+        frames = self.frames.get(camera_name, {})
+        for frame_id in segment.frame_ids:
+            if frames.get(frame_id, (None,))[0] is segment:
+                del frames[frame_id]
+        segment.close()
+
+    def close(self):
+        for name in list(self.writers):
+            self._close_writer(name)
+        for segments in self.segments.values():
+            for segment in segments:
+                segment.close()
+
+
+class VideoSegmentStore(SegmentStore):
+    """
+    SegmentStore whose segments are video files (matroska, which stays
+    readable when the writer dies) encoded by ffmpeg through a pipe or by
+    cv2.VideoWriter. The index keeps the frame number of every frame in its
+    segment, so the frames are still found by frame_id and time range; they
+    are decoded and returned as JPEG bytes.
+
+    codec 'h264' encodes with libx264 at bitrate, 'mjpeg' stores the received
+    JPEG frames as they are (the ffmpeg backend copies them without
+    re-encoding). The opencv backend ignores the bitrate. Frames are read back
+    from finished segments only.
+    """
+
+    DATA_EXT = ".mkv"
+    INDEX_EXT = ".vidx"
+    ANNOTATION_EXT = ".vann"
+    ANNOTATION_INDEX_EXT = ".vaidx"
+    # A video file can not be appended to after a restart
+    CONTINUE_SEGMENTS = False
+
+    def __init__(self, basedir="videoStore", segment_seconds=60, retention=None,
+                 codec="h264", bitrate="1M", fps=10, backend="ffmpeg"):
+        self.codec = codec
+        self.bitrate = bitrate
+        self.fps = fps
+        self.backend = backend
+        self.captures = {}
+        super().__init__(basedir, segment_seconds, retention)
+
+    def _open_data(self, segment):
+        if self.backend == "opencv":
+            # Opened on the first frame, which gives the frame size
+            return [None]
+        cmd = ["ffmpeg", "-loglevel", "error", "-y",
+               "-f", "image2pipe", "-c:v", "mjpeg", "-framerate", str(self.fps), "-i", "-"]
+        if self.codec == "mjpeg":
+            cmd += ["-c:v", "copy"]
+        else:
+            cmd += ["-c:v", "libx264", "-preset", "veryfast", "-b:v", self.bitrate,
+                    "-pix_fmt", "yuv420p"]
+        cmd += [segment.path + self.DATA_EXT]
+        return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def _write_data(self, segment, data, frame):
+        if self.backend == "opencv":
+            image = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if data[0] is None:
+                fourcc = cv2.VideoWriter_fourcc(*("MJPG" if self.codec == "mjpeg" else "H264"))
+                data[0] = cv2.VideoWriter(segment.path + self.DATA_EXT, fourcc, self.fps,
+                                          (image.shape[1], image.shape[0]))
+            data[0].write(image)
+        else:
+            data.stdin.write(frame)
+        # The frame number in the segment
+        return len(segment.frame_ids), len(frame)
+
+    def _close_data(self, data):
+        if self.backend == "opencv":
+            if data[0] is not None:
+                data[0].release()
+        else:
+            data.stdin.close()
+            data.wait()
+
+    def _read(self, segment, i):
+        capture = self.captures.get(segment.path)
+        if capture is None or capture[1] != i:
+            if capture is not None:
+                capture[0].release()
+            video = cv2.VideoCapture(segment.path + self.DATA_EXT)
+            video.set(cv2.CAP_PROP_POS_FRAMES, segment.offsets[i])
+        else:
+            # Reading the next frame, keep decoding from here
+            video = capture[0]
+        ok, image = video.read()
+        if not ok:
+            video.release()
+            self.captures.pop(segment.path, None)
+            return None
+        self.captures[segment.path] = (video, i + 1)
+        return cv2.imencode(".jpeg", image)[1].tobytes()
+
+    def _drop(self, camera_name, segment):
+        capture = self.captures.pop(segment.path, None)
+        if capture is not None:
+            capture[0].release()
+        super()._drop(camera_name, segment)
+
+    def close(self):
+        super().close()
+        for video, _ in self.captures.values():
+            video.release()
+        self.captures = {}
+
+
+class FrameWriter:
+    """
+    mode 'draw' writes the frames with the boxes drawn in, mode 'raw' writes
+    the received JPEG bytes untouched and appends the boxes to the sidecar
+    annotation file of the camera, see render_frame. Mode 'segment' is 'raw'
+    with the frames appended to a SegmentStore instead of a file per frame
+    and the annotations kept per segment, so retention deletes them along;
+    mode 'video' encodes them into a VideoSegmentStore, configured by video.
+    """
+
+    def __init__(self, basedir="videoStore", font="./FiraCode-Regular.otf", mode="draw",
+                 segment_seconds=60, retention=None, video=None):
+        self.logger = logging.getLogger(__name__)
+        self.font = ImageFont.truetype(font, 24)
+        self.basedir = basedir
+        self.mode = mode
+        self.sidecars = {}
+        self.store = None
+        if mode == "segment":
+            self.store = SegmentStore(basedir, segment_seconds, retention)
+        elif mode == "video":
+            self.store = VideoSegmentStore(basedir, segment_seconds, retention, **(video or {}))
+
+    def write(self, recv_obj):
+        camera_name, frame_id, frame, bboxes = recv_obj
+        if self.store is not None:
+            self.store.append(camera_name, frame_id, frame,
+                              annotations=encode_annotations(frame_id, bboxes))
+            return True
+        filename = self.check_path(camera_name, frame_id)
+        if not filename:
+            return False
+        if self.mode == "raw":
+            self.write_raw(camera_name, filename, frame_id, frame, bboxes)
+        else:
+            self.draw_frame(filename, frame, bboxes)
+        return True
+
+    @timing
+    def draw_frame(self, filename, frame, bboxes):
+        image = draw_bboxes(Image.open(io.BytesIO(frame)), bboxes, self.font)
+        image.save(filename, "JPEG")
+        self.logger.debug("Successfully write %s" % filename)
+
+    @timing
+    def write_raw(self, camera_name, filename, frame_id, frame, bboxes):
+        with open(filename, "wb") as f:
+            f.write(frame)
+        self.write_annotations(camera_name, frame_id, bboxes)
+        self.logger.debug("Successfully write %s" % filename)
+
+    def write_annotations(self, camera_name, frame_id, bboxes):
+        # A camera is only written by one worker, the sidecar needs no lock
+        if camera_name not in self.sidecars:
+            frame_dir = os.path.join(self.basedir, camera_name)
+            index_path = os.path.join(frame_dir, ANNOTATION_INDEX_FILE)
+            self.sidecars[camera_name] = (
+                open(os.path.join(frame_dir, ANNOTATION_FILE), "ab"),
+                open(index_path, "r+b" if os.path.exists(index_path) else "w+b"))
+        sidecar, index = self.sidecars[camera_name]
+        offset = sidecar.tell()
+        sidecar.write(encode_annotations(frame_id, bboxes))
+        sidecar.flush()
+        # Written after the record, so the index never points past the sidecar
+        index.seek(frame_id * ANNOTATION_INDEX.size)
+        index.write(ANNOTATION_INDEX.pack(offset + 1))
+        index.flush()
+
+    def close(self):
+        for sidecar, index in self.sidecars.values():
+            sidecar.close()
+            index.close()
+        self.sidecars = {}
+        if self.store is not None:
+            self.store.close()
+
+    def check_path(self, camera_name, frame_id, overwrite=True):
+        frame_dir = os.path.join(self.basedir, camera_name)
+        if not os.path.isdir(frame_dir) and not createDir(frame_dir, self.logger):
+            return False
+        frame_path = os.path.join(frame_dir, "%06d.jpeg" % frame_id)
+        if not overwrite and os.path.exists(frame_path):
+            self.logger.error("File %s exists!" % frame_path)
+            return False
+        return frame_path
+
+
+def createDir(dir, logger):
+    try:
+        os.makedirs(dir)
+    except FileExistsError:
+        logger.warning("%s already exists" % dir)
+        return True
+    except Exception as e:
+        logger.fatal("Exception occurred when creating directory %s: %s" % (dir, e))
+        return False
+    return True
+
+
+def storage_worker(addr, queue_size, taken, written, basedir, mode, segment_seconds,
+                   retention, video):
+    """
+    Worker process: pulls the pickled frames of its cameras from addr and
+    unpickles and writes them in the order they were received, until it gets
+    an empty message.
+    """
+    # A context of its own, a zmq context does not survive a fork
+    context = zmq.Context()
+    socket = context.socket(zmq.PULL)
+    socket.setsockopt(zmq.RCVHWM, queue_size)
+    socket.connect(addr)
+    writer = FrameWriter(basedir, mode=mode, segment_seconds=segment_seconds,
+                         retention=retention, video=video)
+    while True:
+        message = socket.recv(copy=False)
+        if len(message) == 0:
+            writer.close()
+            break
+        with taken.get_lock():
+            taken.value += 1
+        try:
+            if writer.write(pickle.loads(message.buffer)):
+                with written.get_lock():
+                    written.value += 1
+        except Exception as e:
+            writer.logger.error("Failed to write a frame: %s" % e)
+    socket.close()
+    context.term()
 
 
 class VideoStorageServer:
-    colorNames = ['aqua', 'black', 'blue', 'fuchsia',
-                  'gray', 'green', 'lime', 'maroon',
-                  'navy', 'olive', 'purple', 'red',
-                  'silver', 'teal', 'white', 'yellow']
+    """
+    The polling thread receives the frames and forwards the pickled payload,
+    untouched, to a pool of worker processes which decode, draw and write
+    them. Each camera is always handled by the same worker, so the frames of
+    a camera are written in order. A worker is fed through an ipc PUSH/PULL
+    pair: the received zmq frame is sent on with copy=False, so the payload
+    is never copied in Python, only by the kernel on its way to the worker.
+    The pairs are bounded by queue_size on either end: when they are full
+    the polling thread stops receiving and the frames queue up in zmq.
+    """
 
-    def __init__(self, addr="tcp://*:1429", basedir="videoStore"):
+    def __init__(self, addr="tcp://*:1429", basedir="videoStore", queue_size=64,
+                 metrics_interval=10, mode="draw", segment_seconds=60, retention=None,
+                 video=None, query_addr=None, cache_bytes=256 * 1024 * 1024):
         self.logger = logging.getLogger(__name__)
 
-        self.font = ImageFont.truetype("./FiraCode-Regular.otf", 24)
         self.basedir = basedir
-        if not self.createDir(self.basedir):
+        if not createDir(self.basedir, self.logger):
             sys.exit(-1)
+        self.queue_size = queue_size
+        self.mode = mode
+        self.segment_seconds = segment_seconds
+        self.retention = retention
+        # VideoSegmentStore options of the video mode: codec, bitrate, fps, backend
+        self.video = video
+        self.metrics_interval = metrics_interval
 
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.DEALER)
+        # ROUTER, to acknowledge the frames of the reliable clients
+        self.socket = self.context.socket(zmq.ROUTER)
+        # identity -> recent sequence numbers of a reliable client, to drop
+        # the frames it sends again
+        self.seen = {}
+        self.seen_frames = 4096
         self.socket.bind(addr)
+        self.query_server = None
+        if query_addr is not None:
+            self.query_server = VideoQueryServer(query_addr, basedir, cache_bytes=cache_bytes,
+                                                 context=self.context)
 
-    def run(self, threads=2):
-        self.fps = FPS()
-        self.workers = []
+    def run(self, workers=2):
         self.polling_stopped = False
-        self.rcvd_objs = []
-        for i in range(0, threads):
-            thread = Thread(target=self.listen_thread)
-            self.workers.append(thread)
-            thread.start()
+        self.ipc_dir = tempfile.mkdtemp(prefix="video-storage-")
+        self.queues = []
+        self.forwarded = []
+        self.taken = []
+        self.written = []
+        self.workers = []
+        for i in range(0, workers):
+            addr = "ipc://%s/worker-%d" % (self.ipc_dir, i)
+            work_queue = self.context.socket(zmq.PUSH)
+            work_queue.setsockopt(zmq.SNDHWM, self.queue_size)
+            work_queue.bind(addr)
+            taken = mp.Value('L', 0)
+            written = mp.Value('L', 0)
+            process = mp.Process(target=storage_worker,
+                                 args=(addr, self.queue_size, taken, written, self.basedir,
+                                       self.mode, self.segment_seconds, self.retention,
+                                       self.video),
+                                 daemon=True)
+            self.queues.append(work_queue)
+            self.forwarded.append(0)
+            self.taken.append(taken)
+            self.written.append(written)
+            self.workers.append(process)
+            process.start()
+        self.received = registry.meter('video_storage_frames_received')
+        for i in range(0, workers):
+            labels = {'worker': str(i)}
+            registry.gauge('video_storage_queue_depth', labels,
+                           fn=lambda i=i: self.metrics()["queue_depth"][i])
+            registry.gauge('video_storage_frames_written', labels,
+                           fn=lambda i=i: self.written[i].value)
         self.polling_thread = Thread(target=self.polling)
         self.polling_thread.start()
+        self.metrics_thread = Thread(target=self.metrics_loop, daemon=True)
+        self.metrics_thread.start()
+        if self.query_server is not None:
+            self.query_server.run()
 
     def exit(self):
         self.polling_stopped = True
         self.polling_thread.join()
-        for thread in self.workers:
-            thread.join()
+        if self.query_server is not None:
+            self.query_server.exit()
+        for work_queue in self.queues:
+            work_queue.send(b"")
+        for process in self.workers:
+            process.join()
+        for work_queue in self.queues:
+            work_queue.close()
+        shutil.rmtree(self.ipc_dir, ignore_errors=True)
+
+    def worker_of(self, camera_name):
+        # crc32 instead of hash(), which is salted per process
+        return zlib.crc32(camera_name) % len(self.queues)
 
     def polling(self):
         poller = zmq.Poller()
         poller.register(self.socket, zmq.POLLIN)
         while not self.polling_stopped:
             events = dict(poller.poll(100))
-            if len(events) == 0:
-                continue
             if self.socket not in events:
                 continue
-            while True:
+            while not self.polling_stopped:
                 try:
-                    recv_obj = self.socket.recv_pyobj(flags=zmq.NOBLOCK)
+                    frames = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
                 except zmq.ZMQError:
                     break
-                self.rcvd_objs.append(recv_obj)
-
-    def listen_thread(self):
-        while len(self.rcvd_objs) > 0 or not self.polling_stopped:
-            if len(self.rcvd_objs) > 0:
-                recv_obj = self.rcvd_objs.pop()
-                camera_name, frame_id, frame, bboxes = recv_obj
-                filename = self.check_path(camera_name, frame_id)
-                if not filename:
+                self.received.mark()
+                identity, frames = frames[0], frames[1:]
+                if len(frames) == 3 and self.duplicate(identity.bytes, frames[2].bytes):
+                    # Resent by a reliable client, taken already
+                    self.socket.send_multipart([identity, frames[2]], copy=False)
                     continue
+                if len(frames) == 1:
+                    # Clients before the camera name was sent separately
+                    camera_name = pickle.loads(frames[0].buffer)[0].encode()
+                else:
+                    camera_name = frames[0].bytes
+                # Sent on as the received zmq frame, without a copy
+                payload = frames[0] if len(frames) == 1 else frames[1]
+                if not self.forward(self.worker_of(camera_name), payload):
+                    break
+                if len(frames) == 3:
+                    # Reliable client, acknowledge the sequence number
+                    self.remember(identity.bytes, frames[2].bytes)
+                    self.socket.send_multipart([identity, frames[2]], copy=False)
 
-                self.draw_frame(filename, frame, bboxes)
-                self.logger.debug("FPS: %.2f" % self.fps())
+    def duplicate(self, identity, seq):
+        seen = self.seen.get(identity)
+        return seen is not None and seq in seen[1]
 
-    @timing
-    def draw_frame(self, filename, frame, bboxes):
-        image = Image.open(io.BytesIO(frame))
-        draw = ImageDraw.Draw(image)
-        for bbox in bboxes:
-            x1, y1, x2, y2, vid = bbox
-            color = self.colorNames[int(vid) % len(self.colorNames)]
-            draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
-            draw.text([x1, y1], str(vid), fill="red", font=self.font)
-        image.save(filename, "JPEG")
-        self.logger.debug("Successfully write %s" % filename)
+    def remember(self, identity, seq):
+        # The latest seen_frames sequence numbers of every reliable client
+        order, seen = self.seen.setdefault(identity, (collections.deque(), set()))
+        order.append(seq)
+        seen.add(seq)
+        if len(order) > self.seen_frames:
+            seen.discard(order.popleft())
 
-    def check_path(self, camera_name, frame_id, overwrite=True):
+    def forward(self, worker, message):
+        work_queue = self.queues[worker]
+        while not self.polling_stopped:
+            if work_queue.poll(100, zmq.POLLOUT):
+                work_queue.send(message, copy=False)
+                self.forwarded[worker] += 1
+                return True
+            self.logger.debug("Queue of worker %d is full" % worker)
+        return False
+
+    def metrics(self):
+        depth = [forwarded - taken.value for forwarded, taken in zip(self.forwarded, self.taken)]
+        return {"queue_depth": depth,
+                "frames_written": [w.value for w in self.written]}
+
+    def metrics_loop(self):
+        last = sum(w.value for w in self.written)
+        while not self.polling_stopped:
+            time.sleep(self.metrics_interval)
+            metrics = self.metrics()
+            total = sum(metrics["frames_written"])
+            self.logger.info("Queue depth: %s, written: %.2f frames/s"
+                             % (metrics["queue_depth"], (total - last) / self.metrics_interval))
+            last = total
+
+
+class FrameReader:
+    """
+    Reads the stored frames of any storage mode, the stores are reloaded when
+    a frame is not found, and keeps an LRU cache of cache_bytes of frames.
+    """
+
+    def __init__(self, basedir="videoStore", cache_bytes=256 * 1024 * 1024):
+        self.basedir = basedir
+        self.stores = [SegmentStore(basedir), VideoSegmentStore(basedir)]
+        self.cache = collections.OrderedDict()
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, camera_name, frame_id):
+        key = (camera_name, frame_id)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+        self.misses += 1
+        frame = self._read(camera_name, frame_id)
+        if frame is not None:
+            self._cache(key, frame)
+        return frame
+
+    def _read(self, camera_name, frame_id):
+        path = os.path.join(self.basedir, camera_name, "%06d.jpeg" % frame_id)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+        for store in self.stores:
+            if frame_id not in store.frames.get(camera_name, {}):
+                store.reload(camera_name)
+            frame = store.get(camera_name, frame_id)
+            if frame is not None:
+                return bytes(frame)
+        return None
+
+    def _cache(self, key, frame):
+        self.cache[key] = frame
+        self.cached_bytes += len(frame)
+        while self.cached_bytes > self.cache_bytes and len(self.cache) > 0:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+
+    def frame_ids(self, camera_name, first, last):
+        """
+        The stored frame ids of a camera with first <= frame_id <= last.
+        """
+        found = set()
+        for store in self.stores:
+            store.reload(camera_name)
+            found.update(f for f in store.frames.get(camera_name, {}) if first <= f <= last)
         frame_dir = os.path.join(self.basedir, camera_name)
-        if not os.path.isdir(frame_dir) and not self.createDir(frame_dir):
-            return False
-        frame_path = os.path.join(frame_dir, "%06d.jpeg" % frame_id)
-        if not overwrite and os.path.exists(frame_path):
-            self.logger.error("File %s exists!" % frame_path)
-            return False
-        return frame_path
+        if os.path.isdir(frame_dir):
+            for f in os.listdir(frame_dir):
+                if f.endswith(".jpeg") and first <= int(f[:-5]) <= last:
+                    found.add(int(f[:-5]))
+        return sorted(found)
 
-    def createDir(self, dir):
-        try:
-            os.makedirs(dir)
-        except FileExistsError:
-            self.logger.warning("%s already exists" % dir)
-            return True
-        except Exception as e:
-            self.logger.fatal("Exception occurred when creating directory %s: %s" % (dir, e))
-            return False
-        return True
+    def time_range(self, camera_name, start, end):
+        """
+        The stored frame ids of a camera with start <= timestamp < end.
+        """
+        found = []
+        for store in self.stores:
+            store.reload(camera_name)
+            for segment in store.segments.get(camera_name, []):
+                if segment.start >= end or segment.start + store.segment_seconds <= start:
+                    continue
+                found += [f for f, t in zip(segment.frame_ids, segment.timestamps) if start <= t < end]
+        return found
+
+
+def parse_index(index):
+    """
+    The (first, last) frame ids of the index property of a TrajectoryGraph
+    detection, "first-last".
+    """
+    first, last = index.split("-")
+    return int(first), int(last)
+
+
+class VideoQueryServer:
+    """
+    Serves the stored frames on a ROUTER socket. A request is a JSON object
+    with the camera and one of
+
+        {"frame_id": 10}                 a frame
+        {"first": 10, "last": 20}        the frames of a frame_id range
+        {"index": "10-20"}               the same, from a TrajectoryGraph detection
+        {"start": t0, "end": t1}         the frames of a time range
+
+    The reply is a JSON header {"frame_ids": [...], "next": ...} followed by a
+    frame per JPEG. A reply holds at most chunk_frames frames: when "next" is
+    not null, the rest is requested with {"after": next} added to the same
+    request, so neither side buffers a whole clip. The "id" of a request, if
+    any, is echoed in the header. Requests are framed like
+    REQ messages (an empty delimiter frame), so REQ and DEALER clients work.
+    """
+
+    def __init__(self, addr="tcp://*:1430", basedir="videoStore", chunk_frames=16,
+                 cache_bytes=256 * 1024 * 1024, context=None):
+        self.logger = logging.getLogger(__name__)
+        self.addr = addr
+        self.chunk_frames = chunk_frames
+        self.reader = FrameReader(basedir, cache_bytes)
+        self.context = context if context is not None else zmq.Context()
+        self.stopped = False
+
+    def run(self):
+        self.thread = Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def exit(self):
+        self.stopped = True
+        self.thread.join()
+
+    def serve(self):
+        socket = self.context.socket(zmq.ROUTER)
+        socket.bind(self.addr)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        while not self.stopped:
+            if socket not in dict(poller.poll(100)):
+                continue
+            frames = socket.recv_multipart()
+            envelope, request = frames[:-1], frames[-1]
+            request_id = None
+            try:
+                request = json.loads(request)
+                request_id = request.get("id")
+                header, jpegs = self.handle(request)
+            except Exception as e:
+                self.logger.error("Failed to handle %s: %s" % (request, e))
+                header, jpegs = {"error": str(e)}, []
+            # Echoed, so a client can tell a late reply from the one it waits for
+            header["id"] = request_id
+            socket.send_multipart(envelope + [json.dumps(header).encode()] + jpegs, copy=False)
+
+    def handle(self, request):
+        camera_name = request["camera"]
+        if "frame_id" in request:
+            frame_ids = [request["frame_id"]]
+        elif "start" in request:
+            frame_ids = self.reader.time_range(camera_name, request["start"], request["end"])
+        else:
+            if "index" in request:
+                first, last = parse_index(request["index"])
+            else:
+                first, last = request["first"], request["last"]
+            frame_ids = self.reader.frame_ids(camera_name, first, last)
+        if "after" in request:
+            frame_ids = frame_ids[frame_ids.index(request["after"]) + 1:] \
+                if request["after"] in frame_ids else []
+        chunk = frame_ids[:self.chunk_frames]
+        next_id = chunk[-1] if len(frame_ids) > len(chunk) else None
+
+        found, jpegs = [], []
+        for frame_id in chunk:
+            frame = self.reader.get(camera_name, frame_id)
+            if frame is not None:
+                found.append(frame_id)
+                jpegs.append(frame)
+        return {"camera": camera_name, "frame_ids": found, "next": next_id}, jpegs
+
+
+class VideoQueryClient:
+    def __init__(self, addr, context=zmq.Context(), timeout=5.0):
+        self.logger = logging.getLogger(__name__)
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.connect(addr)
+        self.timeout = timeout
+        self.request_id = 0
+
+    def request(self, request):
+        self.request_id += 1
+        request = dict(request, id=self.request_id)
+        self.socket.send_multipart([b"", json.dumps(request).encode()])
+        deadline = time.time() + self.timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.socket.poll(remaining * 1000):
+                raise TimeoutError("No reply from the video query server")
+            frames = self.socket.recv_multipart()
+            header = json.loads(frames[1])
+            if header.get("id") == self.request_id:
+                break
+            # The late reply of a request which timed out
+            self.logger.debug("Discarded the reply of request %s" % header.get("id"))
+        if "error" in header:
+            raise RuntimeError(header["error"])
+        return header, frames[2:]
+
+    def stream(self, request):
+        """
+        Iterate over the (frame_id, jpeg) of a request, chunk by chunk.
+        """
+        request = dict(request)
+        while True:
+            header, jpegs = self.request(request)
+            for frame_id, jpeg in zip(header["frame_ids"], jpegs):
+                yield frame_id, jpeg
+            if header["next"] is None:
+                return
+            request["after"] = header["next"]
+
+    def get_frame(self, camera_name, frame_id):
+        _, jpegs = self.request({"camera": camera_name, "frame_id": frame_id})
+        return jpegs[0] if len(jpegs) > 0 else None
+
+    def get_frames(self, camera_name, first, last):
+        return self.stream({"camera": camera_name, "first": first, "last": last})
+
+    def get_detection(self, camera_name, index):
+        return self.stream({"camera": camera_name, "index": index})
+
+    def get_time_range(self, camera_name, start, end):
+        return self.stream({"camera": camera_name, "start": start, "end": end})
+
+    def export_clip(self, frames, path, fps=10):
+        """
+        Write the (frame_id, jpeg) of get_frames/get_detection/get_time_range
+        into an MJPEG AVI clip. return the number of frames written.
+        """
+        writer = None
+        count = 0
+        for _, jpeg in frames:
+            image = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if writer is None:
+                writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps,
+                                         (image.shape[1], image.shape[0]))
+            writer.write(image)
+            count += 1
+        if writer is not None:
+            writer.release()
+        return count
 
 
 if __name__ == "__main__":